@@ -1,66 +1,551 @@
 # -*- coding: utf-8 -*-
 
-import requests
-import anthropic
-import openai
+import asyncio
+import json
+import threading
+import time
+from async_core import iterate_in_thread
+from conversation import content_text, estimate_tokens
+from metrics import metrics
+from resilience import ProviderError, default_guard
+from singleflight import FlightAbandoned, default_flights, make_key as make_flight_key
+from transport import default_transport
 
-class DeepseekClient:
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.api_url = "https://api.deepseek.com/v1/chat/completions"
-        
-    def get_response(self, message):
+
+def iter_sse_data(lines):
+    """解析 Server-Sent Events 流，逐个产出 data 字段（遇到 [DONE] 结束）"""
+    data_lines = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\r")
+        if not line:
+            # 空行表示一个事件结束
+            if data_lines:
+                data = "\n".join(data_lines)
+                data_lines = []
+                if data == "[DONE]":
+                    return
+                yield data
+            continue
+        if line.startswith(":"):
+            continue  # 注释 / 心跳
+        field, _, value = line.partition(":")
+        if field == "data":
+            data_lines.append(value[1:] if value.startswith(" ") else value)
+    if data_lines and "\n".join(data_lines) != "[DONE]":
+        yield "\n".join(data_lines)
+
+
+def normalize_messages(messages):
+    """接受单条文本或 [{"role", "content"}, ...] 形式的多轮消息列表"""
+    if isinstance(messages, str):
+        return [{"role": "user", "content": messages}]
+    return list(messages)
+
+
+def split_system_messages(messages):
+    """Claude 的 system 提示不放在消息列表中，需要单独传入"""
+    system = "\n\n".join(content_text(m["content"]) for m in messages if m["role"] == "system")
+    return system, [m for m in messages if m["role"] != "system"]
+
+
+class Usage:
+    """服务商返回的 token 用量
+
+    _stream / _astream 可以在最后产出一个 Usage 对象，由 ChatClient 取出记录，不会传给调用方。
+    input_tokens 是全部输入 token（含缓存读取和写入的部分）。
+    """
+
+    __slots__ = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")
+
+    def __init__(self, input_tokens=0, output_tokens=0, cache_read_tokens=0, cache_write_tokens=0):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cache_read_tokens = cache_read_tokens
+        self.cache_write_tokens = cache_write_tokens
+
+    @classmethod
+    def from_openai(cls, usage):
+        """OpenAI 格式的 usage；DeepSeek 的上下文缓存命中数在 prompt_cache_hit_tokens 中"""
+        details = usage.get("prompt_tokens_details") or {}
+        return cls(
+            input_tokens=usage.get("prompt_tokens") or 0,
+            output_tokens=usage.get("completion_tokens") or 0,
+            cache_read_tokens=usage.get("prompt_cache_hit_tokens") or details.get("cached_tokens") or 0
+        )
+
+    @classmethod
+    def from_anthropic(cls, usage):
+        # Anthropic 的 input_tokens 不含缓存读取和写入的部分
+        read = getattr(usage, "cache_read_input_tokens", None) or 0
+        write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return cls(
+            input_tokens=usage.input_tokens + read + write,
+            output_tokens=usage.output_tokens,
+            cache_read_tokens=read,
+            cache_write_tokens=write
+        )
+
+
+# Claude 提示缓存：前缀短于这个长度时不会被缓存，标记断点只会多付写入费用
+CLAUDE_CACHE_MIN_TOKENS = 1024
+EPHEMERAL_CACHE = {"type": "ephemeral"}
+
+
+def with_cache_control(content):
+    """把消息内容转为内容块，并在最后一块上标记缓存断点（不修改原消息）"""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": EPHEMERAL_CACHE}]
+    blocks = [dict(block) for block in content]
+    if blocks:
+        blocks[-1]["cache_control"] = EPHEMERAL_CACHE
+    return blocks
+
+
+def add_cache_breakpoints(options, provider, min_tokens=CLAUDE_CACHE_MIN_TOKENS):
+    """在对话的稳定前缀上放置 Claude 缓存断点（每个请求最多 4 个，这里最多用 3 个）
+
+    - system 提示足够长时单独缓存，换了问题也能命中
+    - 最新一条用户消息：写入包含整段对话的缓存，下一轮从这里读取
+    - 上一条用户消息：上一轮写入的位置，本轮从这里命中
+    Conversation 的裁剪点只在超出预算时才后移，所以这些前缀在多轮之间保持不变。
+    """
+    messages = options["messages"]
+    system = options.get("system")
+    system_tokens = estimate_tokens(system, provider) if system else 0
+    total = system_tokens + sum(estimate_tokens(m["content"], provider) for m in messages)
+    if total < min_tokens:
+        return options
+
+    if system and system_tokens >= min_tokens:
+        options["system"] = with_cache_control(system)
+
+    user_positions = [index for index, message in enumerate(messages) if message["role"] == "user"]
+    marked = list(messages)
+    for index in user_positions[-2:]:
+        marked[index] = dict(messages[index], content=with_cache_control(messages[index]["content"]))
+    options["messages"] = marked
+    return options
+
+
+class ChatClient:
+    """AI 客户端公共接口：stream_response 逐块产出文本，get_response 返回完整回复
+
+    messages 可以是单条文本，也可以是包含历史轮次的消息列表。
+    子类只需实现 _stream（以及可选的原生异步 _astream），出错时直接抛出异常；
+    缺少密钥、响应缓存、限流、重试和熔断都在这里统一处理，失败时抛出 ProviderError；
+    每次请求的首 token 时间、总耗时和 token 数记录到 metrics。
+    同时进行的相同请求只向上游发送一次，其余请求重放它的输出（见 singleflight）。
+
+    所有客户端共用同一个 HttpTransport（连接池、keep-alive、超时）。
+    """
+
+    provider = None
+    model = None
+    missing_key_message = ""
+    # 预热连接时使用的地址
+    endpoint = None
+    # 影响输出的采样参数，参与缓存键的计算
+    sampling_params = {}
+    # ResponseCache 实例，由应用统一设置
+    cache = None
+    # ProviderGuard 实例（限流、重试、熔断），未设置时使用该服务商的默认实例
+    guard = None
+    # SingleFlight 实例（合并同时进行的相同请求），未设置时使用进程内共享的实例
+    flights = None
+
+    def get_response(self, messages, use_cache=True):
+        return "".join(self.stream_response(messages, use_cache))
+
+    def stream_response(self, messages, use_cache=True):
+        messages = self.check_request(messages)
+        timer = metrics.request(self.provider)
+        try:
+            key = self.cache_key(messages) if use_cache else None
+            if key is not None:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    timer.finish(0, 0, outcome="cache_hit")
+                    yield cached
+                    return
+
+            # 相同的请求正在进行时不再重复发送，直接重放它的输出
+            flights = self.flights or default_flights()
+            flight_key = self.flight_key(messages)
+            while True:
+                flight, leader = flights.join(flight_key)
+                if leader:
+                    break
+                replayed = False
+                try:
+                    for chunk in flight.replay():
+                        replayed = True
+                        yield chunk
+                except ProviderError as e:
+                    timer.fail(e.kind)
+                    raise
+                except FlightAbandoned:
+                    if replayed:
+                        timer.fail("connection")
+                        raise ProviderError(self.provider, "connection", "共享的请求已中断")
+                    continue  # 发起方还没有输出就退出了，由自己重新发起
+                timer.finish(0, 0, outcome="coalesced")
+                return
+
+            try:
+                for chunk in self._upstream(messages, key, timer):
+                    flight.publish(chunk)
+                    yield chunk
+                flight.finish()
+            except ProviderError as e:
+                flight.finish(e)
+                raise
+            except BaseException:
+                flight.finish(FlightAbandoned())
+                raise
+            finally:
+                flights.leave(flight_key, flight)
+        finally:
+            timer.close()
+
+    def _upstream(self, messages, key, timer):
+        guard = self.guard or default_guard(self.provider)
+        tokens = self.estimate_input_tokens(messages)
+        chunks = []
+        attempt = 0
+        probe = None
+        try:
+            while True:
+                attempt += 1
+                wait, probe = guard.before_request(tokens)
+                time.sleep(wait)
+                usage = None
+                try:
+                    for chunk in self._stream(messages):
+                        if isinstance(chunk, Usage):
+                            usage = chunk
+                            continue
+                        timer.chunk()
+                        chunks.append(chunk)
+                        yield chunk
+                    break
+                except Exception as e:
+                    error, delay = guard.on_failure(e, attempt, streamed=bool(chunks))
+                    if delay is None:
+                        timer.fail(error.kind)
+                        raise error from e
+                    time.sleep(delay)
+            output_tokens = self.record_usage(timer, usage, tokens, chunks)
+            guard.on_success(output_tokens)
+        finally:
+            # 被取消（CancelledError / GeneratorExit）的试探请求没有结果，归还试探名额
+            guard.release_probe(probe)
+        self.store_response(key, chunks)
+
+    async def aget_response(self, messages, use_cache=True):
+        chunks = []
+        async for chunk in self.astream_response(messages, use_cache):
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    async def astream_response(self, messages, use_cache=True):
+        loop = asyncio.get_running_loop()
+        messages = self.check_request(messages)
+        timer = metrics.request(self.provider)
+        try:
+            key = self.cache_key(messages) if use_cache else None
+            if key is not None:
+                cached = await loop.run_in_executor(None, self.cache.get, key)
+                if cached is not None:
+                    timer.finish(0, 0, outcome="cache_hit")
+                    yield cached
+                    return
+
+            # 相同的请求正在进行时不再重复发送，直接重放它的输出
+            flights = self.flights or default_flights()
+            flight_key = self.flight_key(messages)
+            while True:
+                flight, leader = flights.join(flight_key)
+                if leader:
+                    break
+                replayed = False
+                try:
+                    async for chunk in flight.areplay():
+                        replayed = True
+                        yield chunk
+                except ProviderError as e:
+                    timer.fail(e.kind)
+                    raise
+                except FlightAbandoned:
+                    if replayed:
+                        timer.fail("connection")
+                        raise ProviderError(self.provider, "connection", "共享的请求已中断")
+                    continue  # 发起方还没有输出就退出了，由自己重新发起
+                timer.finish(0, 0, outcome="coalesced")
+                return
+
+            stream = self._aupstream(loop, messages, key, timer)
+            try:
+                async for chunk in stream:
+                    flight.publish(chunk)
+                    yield chunk
+                flight.finish()
+            except ProviderError as e:
+                flight.finish(e)
+                raise
+            except BaseException:
+                flight.finish(FlightAbandoned())
+                raise
+            finally:
+                flights.leave(flight_key, flight)
+                await stream.aclose()
+        finally:
+            timer.close()
+
+    async def _aupstream(self, loop, messages, key, timer):
+        guard = self.guard or default_guard(self.provider)
+        tokens = self.estimate_input_tokens(messages)
+        chunks = []
+        attempt = 0
+        probe = None
+        try:
+            while True:
+                attempt += 1
+                wait, probe = guard.before_request(tokens)
+                await asyncio.sleep(wait)
+                usage = None
+                try:
+                    async for chunk in self._astream(messages):
+                        if isinstance(chunk, Usage):
+                            usage = chunk
+                            continue
+                        timer.chunk()
+                        chunks.append(chunk)
+                        yield chunk
+                    break
+                except Exception as e:
+                    error, delay = guard.on_failure(e, attempt, streamed=bool(chunks))
+                    if delay is None:
+                        timer.fail(error.kind)
+                        raise error from e
+                    await asyncio.sleep(delay)
+            output_tokens = self.record_usage(timer, usage, tokens, chunks)
+            guard.on_success(output_tokens)
+        finally:
+            # 被取消（CancelledError / GeneratorExit）的试探请求没有结果，归还试探名额
+            guard.release_probe(probe)
+        await loop.run_in_executor(None, self.store_response, key, chunks)
+
+    def check_request(self, messages):
         if not self.api_key:
-            return "请先设置 DeepSeek API 密钥"
-            
+            raise ProviderError(self.provider, "missing_key", self.missing_key_message)
+        return normalize_messages(messages)
+
+    def record_usage(self, timer, usage, estimated_input, chunks):
+        """记录 token 用量（有服务商报告的用量时以它为准），返回输出 token 数"""
+        if usage is None:
+            output_tokens = self.estimate_output_tokens(chunks)
+            timer.finish(estimated_input, output_tokens)
+            return output_tokens
+        timer.finish(usage.input_tokens, usage.output_tokens)
+        timer.prompt_cache(usage.input_tokens, usage.cache_read_tokens, usage.cache_write_tokens)
+        return usage.output_tokens
+
+    def estimate_input_tokens(self, messages):
+        return sum(estimate_tokens(message["content"], self.provider) for message in messages)
+
+    def estimate_output_tokens(self, chunks):
+        return estimate_tokens("".join(chunks), self.provider)
+
+    def flight_key(self, messages):
+        return make_flight_key(self.provider, self.model, messages, self.sampling_params, self.endpoint)
+
+    def cache_key(self, messages):
+        if self.cache is None:
+            return None
+        return self.cache.make_key(self.provider, self.model, messages, self.sampling_params, self.endpoint)
+
+    def store_response(self, key, chunks):
+        # 只缓存完整结束的回复；中途出错或被取消的不会走到这里
+        response = "".join(chunks)
+        if key is not None and response:
+            self.cache.put(key, response)
+
+    def prepare(self):
+        """提前加载服务商 SDK 等耗时资源（在后台线程中调用），默认无需准备"""
+
+    def _stream(self, messages):
+        raise NotImplementedError
+
+    async def _astream(self, messages):
+        # 默认实现：在线程池中驱动同步流，子类可提供原生异步实现
+        async for chunk in iterate_in_thread(iter(self._stream(messages))):
+            yield chunk
+
+
+class DeepseekClient(ChatClient):
+    provider = "DeepSeek"
+    model = "deepseek-chat"
+    missing_key_message = "请先设置 DeepSeek API 密钥"
+
+    def __init__(self, api_key, api_url=None, transport=None):
+        self.api_key = api_key
+        self.api_url = api_url or "https://api.deepseek.com/v1/chat/completions"
+        self.endpoint = self.api_url
+        self.transport = transport or default_transport()
+
+    def _stream(self, messages):
         headers = {
             "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
         }
-        
+
+        # DeepSeek 自动缓存相同的消息前缀（上下文硬盘缓存），命中数在最后一块的 usage 中返回
         data = {
-            "model": "deepseek-chat",
-            "messages": [{"role": "user", "content": message}]
+            "model": self.model,
+            "messages": messages,
+            "stream": True,
+            "stream_options": {"include_usage": True}
         }
-        
-        try:
-            response = requests.post(self.api_url, headers=headers, json=data)
-            return response.json()["choices"][0]["message"]["content"]
-        except Exception as e:
-            return f"错误: {str(e)}"
 
-class OpenAIClient:
-    def __init__(self, api_key):
+        with self.transport.stream_post(self.api_url, headers=headers, json=data) as response:
+            response.raise_for_status()
+            lines = response.iter_lines()
+            usage = None
+            for payload in iter_sse_data(lines):
+                event = json.loads(payload)
+                choices = event.get("choices") or []
+                if choices:
+                    content = choices[0].get("delta", {}).get("content")
+                    if content:
+                        yield content
+                if event.get("usage"):
+                    usage = Usage.from_openai(event["usage"])
+            # 读完 [DONE] 之后的剩余部分，连接才能放回连接池复用
+            for _ in lines:
+                pass
+            if usage is not None:
+                yield usage
+
+class OpenAIClient(ChatClient):
+    provider = "OpenAI"
+    model = "gpt-3.5-turbo"
+    missing_key_message = "请先设置 OpenAI API 密钥"
+
+    def __init__(self, api_key, api_base=None, transport=None):
         self.api_key = api_key
-        openai.api_key = api_key
-        
-    def get_response(self, message):
-        if not self.api_key:
-            return "请先设置 OpenAI API 密钥"
-            
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": message}]
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"错误: {str(e)}"
-
-class ClaudeClient:
-    def __init__(self, api_key):
+        self.transport = transport or default_transport()
+        self.endpoint = api_base or "https://api.openai.com/v1"
+
+    def sdk(self):
+        """首次使用时才导入 openai SDK，并设置密钥和地址"""
+        import openai
+        openai.api_key = self.api_key
+        openai.api_base = self.endpoint
+        # 让 openai SDK 复用共享连接池
+        openai.requestssession = self.transport.session
+        return openai
+
+    def prepare(self):
+        self.sdk()
+
+    def _stream(self, messages):
+        response = self.sdk().ChatCompletion.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            request_timeout=self.transport.timeout
+        )
+        for chunk in response:
+            if chunk.choices:
+                content = chunk.choices[0].delta.get("content")
+                if content:
+                    yield content
+            if chunk.get("usage"):
+                # OpenAI 对较长的相同前缀自动缓存，命中数在 prompt_tokens_details.cached_tokens 中
+                yield Usage.from_openai(chunk["usage"])
+
+    async def _astream(self, messages):
+        # 第一次导入 SDK 较慢，放到线程池中进行，避免阻塞事件循环
+        openai = await asyncio.get_running_loop().run_in_executor(None, self.sdk)
+        response = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            request_timeout=self.transport.timeout
+        )
+        async for chunk in response:
+            if chunk.choices:
+                content = chunk.choices[0].delta.get("content")
+                if content:
+                    yield content
+            if chunk.get("usage"):
+                yield Usage.from_openai(chunk["usage"])
+
+class ClaudeClient(ChatClient):
+    provider = "Claude"
+    model = "claude-3-sonnet-20240229"
+    missing_key_message = "请先设置 Claude API 密钥"
+    sampling_params = {"max_tokens": 4096}
+    # 在对话的稳定前缀上放置 cache_control 断点
+    prompt_caching = True
+
+    def __init__(self, api_key, base_url=None, transport=None):
         self.api_key = api_key
-        self.client = anthropic.Anthropic(api_key=api_key) if api_key else None
-        
-    def get_response(self, message):
-        if not self.api_key:
-            return "请先设置 Claude API 密钥"
-            
-        try:
-            response = self.client.messages.create(
-                model="claude-3-sonnet-20240229",
-                messages=[{"role": "user", "content": message}]
-            )
-            return response.content[0].text
-        except Exception as e:
-            return f"错误: {str(e)}" 
\ No newline at end of file
+        self.transport = transport or default_transport()
+        self.base_url = base_url
+        self.endpoint = base_url or "https://api.anthropic.com"
+        self._clients = None
+        self._lock = threading.Lock()
+
+    def sdk_clients(self):
+        """首次使用时才导入 anthropic SDK，返回 (同步客户端, 异步客户端)"""
+        with self._lock:
+            if self._clients is None:
+                import anthropic
+                # anthropic SDK 自带基于 httpx 的连接池；客户端实例在设置未变时会被复用，连接也随之保持
+                timeout = anthropic.Timeout(self.transport.read_timeout, connect=self.transport.connect_timeout)
+                # 重试由 ProviderGuard 统一处理，关闭 SDK 自带的重试
+                self._clients = (
+                    anthropic.Anthropic(api_key=self.api_key, base_url=self.base_url, timeout=timeout, max_retries=0),
+                    anthropic.AsyncAnthropic(api_key=self.api_key, base_url=self.base_url, timeout=timeout, max_retries=0)
+                )
+            return self._clients
+
+    def prepare(self):
+        self.sdk_clients()
+
+    def request_options(self, messages):
+        system, messages = split_system_messages(messages)
+        options = dict(self.sampling_params, model=self.model, messages=messages)
+        if system:
+            options["system"] = system
+        if self.prompt_caching:
+            add_cache_breakpoints(options, self.provider)
+        return options
+
+    def _stream(self, messages):
+        client, _ = self.sdk_clients()
+        with client.messages.stream(**self.request_options(messages)) as stream:
+            for text in stream.text_stream:
+                yield text
+            yield Usage.from_anthropic(stream.get_final_message().usage)
+
+    async def _astream(self, messages):
+        _, async_client = await asyncio.get_running_loop().run_in_executor(None, self.sdk_clients)
+        async with async_client.messages.stream(**self.request_options(messages)) as stream:
+            async for text in stream.text_stream:
+                yield text
+            yield Usage.from_anthropic((await stream.get_final_message()).usage)
+
+
+# 服务商名称 -> (客户端类, 密钥配置项, 可选的地址配置项)
+PROVIDERS = {
+    "DeepSeek": (DeepseekClient, "deepseek_api_key", "deepseek_api_url"),
+    "OpenAI": (OpenAIClient, "openai_api_key", "openai_api_base"),
+    "Claude": (ClaudeClient, "claude_api_key", "claude_base_url"),
+}
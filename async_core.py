@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+
+
+class AsyncRunner:
+    """在单个后台线程中运行的 asyncio 事件循环
+
+    Tk 线程通过 submit() 提交协程，得到 concurrent.futures.Future；
+    协程中需要更新界面时，仍然通过 root.after 回到 Tk 线程。
+    """
+
+    def __init__(self, name="ai-event-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """阻塞等待协程结果（仅在非 Tk 线程中使用）"""
+        return self.submit(coro).result(timeout)
+
+    def stop(self, timeout=2):
+        if not self.loop.is_running():
+            return
+
+        async def shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            self.submit(shutdown()).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+async def iterate_in_thread(iterator):
+    """把同步迭代器（如阻塞的流式响应）转为异步迭代器，每次 next() 在线程池中执行
+
+    被取消时关闭同步迭代器（流式响应随之关闭连接）；如果 next() 还在线程中执行，
+    由那个线程在 next() 返回后关闭。
+    """
+    loop = asyncio.get_running_loop()
+    sentinel = object()
+    close = getattr(iterator, "close", None)
+    closing = threading.Event()
+
+    def step():
+        item = next(iterator, sentinel)
+        if closing.is_set() and close is not None:
+            close()
+        return item
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, step)
+            if item is sentinel:
+                return
+            yield item
+    finally:
+        closing.set()
+        if close is not None:
+            try:
+                await loop.run_in_executor(None, close)
+            except ValueError:
+                pass  # next() 仍在执行，返回后由 step() 关闭
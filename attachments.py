@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+
+"""文件 / 目录附件：内存映射读取、按 token 预算分段、map-reduce 提问
+
+    python attachments.py server.log                       # 查看分段情况
+    python attachments.py src/ --question "有哪些潜在的 bug？" --model Claude
+
+文件通过 mmap 读取，任何时候只有正在处理的几段文本在内存中；分段边界（字节偏移和
+token 数）按文件内容的 SHA-256 缓存在 cache/chunks.db，文件未变时不会重新分段，
+大小和修改时间也未变时连哈希都不用重新计算。
+"""
+
+import argparse
+import array
+import asyncio
+import hashlib
+import mmap
+import os
+import sqlite3
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from conversation import CONTEXT_WINDOWS, DEFAULT_TOKEN_RATE, RESERVED_OUTPUT_TOKENS, TOKEN_RATES, estimate_tokens
+from resilience import ProviderError
+
+# 每段默认的 token 上限，实际还受模型上下文窗口限制
+DEFAULT_CHUNK_TOKENS = 6000
+DEFAULT_CONCURRENCY = 4
+# 提示词和段落标题占用的 token
+PROMPT_OVERHEAD_TOKENS = 300
+# 计算哈希时每次映射读取的字节数
+HASH_WINDOW = 16 * 1024 * 1024
+# 首次猜测每个 token 对应的字节数，之后按实际估计值修正
+BYTES_PER_TOKEN_GUESS = 3
+# 开头出现 NUL 字节的文件视为二进制文件，不作为附件
+SNIFF_BYTES = 8192
+# 分段时直接按 UTF-8 字节估计 token：续字节不算字符，三字节字符（中日韩文字所在区段）按中文计
+CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+THREE_BYTE_LEADS = bytes(range(0xE0, 0xF0))
+# 处理完的部分每隔这么多字节从进程内存中释放（仅支持 madvise 的系统）
+RELEASE_WINDOW = 16 * 1024 * 1024
+SKIP_DIRS = {".git", ".hg", ".svn", "__pycache__", "node_modules", ".venv", "venv", ".mypy_cache", ".pytest_cache"}
+
+# 一段附件内容：所在文件、文件内序号、字节范围和估计的 token 数
+Chunk = namedtuple("Chunk", ["path", "index", "start", "end", "tokens"])
+
+MAP_PROMPT = (
+    "You are reading part {part} of {parts} of the user's attached files. "
+    "Extract everything in this part that helps answer the question, citing file names and line content "
+    "where useful. If nothing is relevant, reply with \"(nothing relevant)\". "
+    "Reply in the language of the question.\n\n"
+    "Question: {question}\n\n{text}"
+)
+REDUCE_PROMPT = (
+    "Below are notes taken from different parts of the user's attached files. "
+    "Merge them into one set of notes, keeping every detail that helps answer the question "
+    "and dropping duplicates and \"(nothing relevant)\" entries. Reply in the language of the question.\n\n"
+    "Question: {question}\n\n{text}"
+)
+ANSWER_PROMPT = (
+    "Answer the question using the notes below, which were taken from the user's attached files. "
+    "Say so if the notes do not contain the answer.\n\n"
+    "Question: {question}\n\n{text}"
+)
+DIRECT_PROMPT = "{question}\n\nAttached files:\n\n{text}"
+
+
+@contextmanager
+def mapped(path):
+    """只读映射整个文件；空文件返回 b\"\""""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buffer
+        finally:
+            buffer.close()
+
+
+def is_text_file(path):
+    try:
+        with open(path, "rb") as f:
+            return b"\0" not in f.read(SNIFF_BYTES)
+    except OSError:
+        return False
+
+
+def collect_files(paths):
+    """展开目录，返回 (文本文件列表, 跳过的文件列表)；目录内按路径排序"""
+    files = []
+    skipped = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirs, names in os.walk(path):
+                subdirs[:] = sorted(d for d in subdirs if d not in SKIP_DIRS and not d.startswith("."))
+                for name in sorted(names):
+                    if name.startswith("."):
+                        continue
+                    full = os.path.join(directory, name)
+                    (files if is_text_file(full) else skipped).append(full)
+        elif os.path.isfile(path) and is_text_file(path):
+            files.append(path)
+        else:
+            skipped.append(path)
+    return files, skipped
+
+
+def release_pages(buffer, start, end):
+    """告诉系统已读过的映射页面不再需要，扫描大文件时常驻内存不会随文件增长"""
+    if not hasattr(buffer, "madvise") or not hasattr(mmap, "MADV_DONTNEED"):
+        return
+    start -= start % mmap.PAGESIZE
+    if end > start:
+        buffer.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with mapped(path) as buffer:
+        view = memoryview(buffer)
+        try:
+            for start in range(0, len(buffer), HASH_WINDOW):
+                digest.update(view[start:start + HASH_WINDOW])
+                release_pages(buffer, start, min(len(buffer), start + HASH_WINDOW))
+        finally:
+            view.release()
+    return digest.hexdigest()
+
+
+def estimate_bytes_tokens(data, provider):
+    """与 estimate_tokens 相同的估算，但直接统计 UTF-8 字节，不需要解码"""
+    cjk_rate, other_rate = TOKEN_RATES.get(provider, DEFAULT_TOKEN_RATE)
+    chars = len(data.translate(None, CONTINUATION_BYTES))
+    cjk = len(data) - len(data.translate(None, THREE_BYTE_LEADS))
+    return int(cjk * cjk_rate + (chars - cjk) * other_rate) + 1
+
+
+def _char_boundary(buffer, pos, floor):
+    # 不在 UTF-8 多字节字符中间切开（续字节为 0b10xxxxxx）
+    while pos > floor and buffer[pos] & 0xC0 == 0x80:
+        pos -= 1
+    return pos
+
+
+def chunk_boundaries(buffer, budget, provider):
+    """把映射的文件切成不超过 budget 个 token 的段，返回 [(起始, 结束, token 数)]
+
+    按上一段的字节 / token 比例猜结束位置，尽量退回到行尾，估计超出预算时按比例收缩重试；
+    通常每段只统计一次字节，总耗时与文件大小成线性关系。
+    """
+    size = len(buffer)
+    boundaries = []
+    bytes_per_token = BYTES_PER_TOKEN_GUESS
+    released = 0
+    pos = 0
+    while pos < size:
+        # 目标略低于预算，避免估计稍有偏差就要重试
+        end = min(size, pos + max(1, int(budget * 0.97 * bytes_per_token)))
+        while True:
+            if end < size:
+                # 尽量在行尾切开，但不让一段短于目标的一半；没有换行时不切开多字节字符
+                newline = buffer.rfind(b"\n", pos + (end - pos) // 2, end)
+                end = newline + 1 if newline >= 0 else _char_boundary(buffer, end, pos + 1)
+            tokens = estimate_bytes_tokens(buffer[pos:end], provider)
+            if tokens <= budget or end - pos <= 1:
+                break
+            end = pos + max(1, int((end - pos) * budget / tokens * 0.95))
+        boundaries.append((pos, end, tokens))
+        bytes_per_token = max(1.0, (end - pos) / max(1, tokens))
+        pos = end
+        if pos - released >= RELEASE_WINDOW:
+            release_pages(buffer, released, pos)
+            released = pos
+    return boundaries
+
+
+class ChunkIndex:
+    """附件分段缓存：(路径, 大小, 修改时间) -> 内容哈希，(哈希, 预算, 服务商) -> 分段边界"""
+
+    def __init__(self, path=os.path.join("cache", "chunks.db")):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "sha256 TEXT NOT NULL, budget INTEGER NOT NULL, provider TEXT NOT NULL, boundaries BLOB NOT NULL, "
+            "PRIMARY KEY (sha256, budget, provider))"
+        )
+        self._conn.commit()
+        self.counters = {"hashed": 0, "chunked": 0, "cached": 0}
+
+    def fingerprint(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime_ns, sha256 FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        sha256 = hash_file(path)
+        self.counters["hashed"] += 1
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, sha256)
+            )
+            self._conn.commit()
+        return sha256
+
+    def chunks(self, path, budget, provider):
+        sha256 = self.fingerprint(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT boundaries FROM chunks WHERE sha256 = ? AND budget = ? AND provider = ?",
+                (sha256, budget, provider)
+            ).fetchone()
+        if row is not None:
+            self.counters["cached"] += 1
+            flat = array.array("q")
+            flat.frombytes(row[0])
+            triples = zip(flat[0::3], flat[1::3], flat[2::3])
+        else:
+            with mapped(path) as buffer:
+                triples = chunk_boundaries(buffer, budget, provider)
+            self.counters["chunked"] += 1
+            flat = array.array("q", (value for triple in triples for value in triple))
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO chunks (sha256, budget, provider, boundaries) VALUES (?, ?, ?, ?)",
+                    (sha256, budget, provider, flat.tobytes())
+                )
+                self._conn.commit()
+        return [Chunk(path, index, start, end, tokens) for index, (start, end, tokens) in enumerate(triples)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def chunk_budget(provider, chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    window = CONTEXT_WINDOWS.get(provider, min(CONTEXT_WINDOWS.values()))
+    return max(500, min(chunk_tokens, window - RESERVED_OUTPUT_TOKENS - PROMPT_OVERHEAD_TOKENS))
+
+
+def plan_chunks(paths, provider, index, chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    """展开附件并分段（读文件、算哈希，应在后台线程调用），返回 (段列表, 跳过的文件)"""
+    files, skipped = collect_files(paths)
+    budget = chunk_budget(provider, chunk_tokens)
+    chunks = []
+    for path in files:
+        chunks.extend(index.chunks(path, budget, provider))
+    return chunks, skipped
+
+
+def pack_chunks(chunks, budget):
+    """把相邻的小段（通常来自小文件）合并到同一个请求中，每组总 token 不超过 budget"""
+    groups = []
+    current = []
+    used = 0
+    for chunk in chunks:
+        if current and used + chunk.tokens > budget:
+            groups.append(current)
+            current, used = [], 0
+        current.append(chunk)
+        used += chunk.tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def read_chunk(chunk):
+    with mapped(chunk.path) as buffer:
+        return str(buffer[chunk.start:chunk.end], "utf-8", "replace")
+
+
+def render_group(group):
+    """一组段落的文本，每段前标明文件和字节范围"""
+    parts = []
+    for chunk in group:
+        parts.append(f"=== {chunk.path} (bytes {chunk.start}-{chunk.end}) ===\n{read_chunk(chunk)}")
+    return "\n\n".join(parts)
+
+
+def group_notes(notes, budget, provider):
+    """把要点分组合并；每组至少两条，保证每一层合并后要点数至少减半"""
+    groups = []
+    current = []
+    used = 0
+    for note in notes:
+        cost = estimate_tokens(note, provider)
+        if len(current) >= 2 and used + cost > budget:
+            groups.append(current)
+            current, used = [], 0
+        current.append(note)
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
+
+
+class AttachmentQuery:
+    """对附件提问：map 阶段每组段落单独提取要点，reduce 阶段逐层合并要点，最后流式输出回答
+
+    附件一次就能放下时直接把全文和问题发出去。同时进行的请求不超过 concurrency 个，
+    工作协程从段落组的迭代器中按需取活，每组的文本在轮到它时才从映射中读出，
+    所以内存中只有 concurrency 组文本和已得到的要点。某一组失败不会中止整个任务，
+    失败的组在要点中注明。
+    """
+
+    def __init__(self, client, question, chunks, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                 concurrency=DEFAULT_CONCURRENCY, use_cache=True, on_progress=None):
+        self.client = client
+        self.provider = client.provider
+        self.question = question
+        self.chunks = chunks
+        self.budget = chunk_budget(self.provider, chunk_tokens)
+        # 要点由模型写成、篇幅有限，合并时可以用满整个上下文窗口
+        self.reduce_budget = chunk_budget(self.provider, sys.maxsize)
+        self.concurrency = max(1, concurrency)
+        self.use_cache = use_cache
+        self.on_progress = on_progress  # on_progress(阶段, 已完成, 总数)
+        self.failed = 0
+
+    def _progress(self, stage, done, total):
+        if self.on_progress is not None:
+            self.on_progress(stage, done, total)
+
+    async def stream(self):
+        groups = pack_chunks(self.chunks, self.budget)
+        loop = asyncio.get_running_loop()
+        if len(groups) <= 1:
+            text = await loop.run_in_executor(None, render_group, groups[0]) if groups else ""
+            prompt = DIRECT_PROMPT.format(question=self.question, text=text)
+            async for chunk in self.client.astream_response(prompt, self.use_cache):
+                yield chunk
+            return
+
+        notes = await self._map(groups, lambda group: loop.run_in_executor(None, render_group, group), MAP_PROMPT, "map")
+        level = 0
+        while len(notes) > 1 and sum(estimate_tokens(note, self.provider) for note in notes) > self.reduce_budget:
+            # 要点太多放不进一次请求时逐层合并
+            level += 1
+            note_groups = group_notes(notes, self.reduce_budget, self.provider)
+            notes = await self._map(note_groups, self._join_notes, REDUCE_PROMPT, f"reduce{level}")
+
+        prompt = ANSWER_PROMPT.format(question=self.question, text=await self._join_notes(notes))
+        async for chunk in self.client.astream_response(prompt, self.use_cache):
+            yield chunk
+
+    @staticmethod
+    async def _join_notes(notes):
+        return "\n\n".join(f"--- notes {number} ---\n{note}" for number, note in enumerate(notes, 1))
+
+    async def _map(self, items, render, template, stage):
+        results = [None] * len(items)
+        pending = iter(enumerate(items))
+        done = 0
+        total = len(items)
+        self._progress(stage, 0, total)
+
+        async def worker():
+            nonlocal done
+            for number, item in pending:
+                text = await render(item)
+                prompt = template.format(part=number + 1, parts=total, question=self.question, text=text)
+                try:
+                    results[number] = await self.client.aget_response(prompt, self.use_cache)
+                except ProviderError as e:
+                    self.failed += 1
+                    results[number] = f"(part {number + 1} could not be processed: {e})"
+                done += 1
+                self._progress(stage, done, total)
+
+        # 所有工作协程共享同一个迭代器，每次取下一组
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, total))))
+        if self.failed and self.failed == done and stage == "map":
+            raise ProviderError(self.provider, "unknown", "附件的所有部分都处理失败")
+        return results
+
+
+def main(argv=None):
+    from batch import build_clients, load_config
+    from transport import HttpTransport
+
+    parser = argparse.ArgumentParser(description="对文件或目录分段并提问")
+    parser.add_argument("paths", nargs="+", help="文件或目录")
+    parser.add_argument("--question", help="要问的问题；不指定时只显示分段情况")
+    parser.add_argument("--model", default="DeepSeek", choices=sorted(CONTEXT_WINDOWS))
+    parser.add_argument("--chunk-tokens", type=int, default=DEFAULT_CHUNK_TOKENS)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--no-cache", action="store_true", help="不使用响应缓存")
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args(argv)
+
+    index = ChunkIndex()
+    try:
+        chunks, skipped = plan_chunks(args.paths, args.model, index, args.chunk_tokens)
+    finally:
+        index.close()
+    files = len({chunk.path for chunk in chunks})
+    total_tokens = sum(chunk.tokens for chunk in chunks)
+    print(
+        f"{files} 个文件，{len(chunks)} 段，约 {total_tokens} token"
+        f"（重新分段 {index.counters['chunked']}，使用缓存 {index.counters['cached']}，跳过 {len(skipped)}）",
+        file=sys.stderr
+    )
+    if not args.question:
+        return 0
+
+    config = load_config(args.config)
+    transport = HttpTransport(
+        connect_timeout=config.get("http_connect_timeout", 5.0),
+        read_timeout=config.get("http_read_timeout", 120.0),
+        pool_maxsize=max(16, args.concurrency)
+    )
+    cache = None
+    if not args.no_cache:
+        from response_cache import ResponseCache
+        cache = ResponseCache(os.path.join("cache", "responses.db"))
+    client = build_clients(config, transport, cache)[args.model]
+
+    def progress(stage, done, total):
+        print(f"{stage}: {done}/{total}", file=sys.stderr, end="\n" if done == total else "\r", flush=True)
+
+    async def run():
+        query = AttachmentQuery(
+            client, args.question, chunks, args.chunk_tokens, args.concurrency,
+            use_cache=not args.no_cache, on_progress=progress
+        )
+        async for chunk in query.stream():
+            print(chunk, end="", flush=True)
+        print()
+        return query.failed
+
+    try:
+        failed = asyncio.run(run())
+    except ProviderError as e:
+        print(f"\n{e}", file=sys.stderr)
+        return 1
+    finally:
+        transport.close()
+        if cache is not None:
+            cache.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""无界面批量模式：把 JSONL 文件中的问题并发发送给各个模型
+
+    python batch.py prompts.jsonl results.jsonl --concurrency 8 --limit Claude=2
+
+输入每行一个 JSON 对象：
+    {"id": "q1", "prompt": "..."}                       单条问题
+    {"id": "q2", "messages": [{"role": ..., ...}]}      多轮消息
+    可选 "model"（DeepSeek / OpenAI / Claude）覆盖 --model，可选 "system" 作为系统提示
+
+输出每行一条结果：{"line", "id", "model", "response", "error", "elapsed"}，
+error 为 null 或结构化错误 {"kind", "status", "attempts", "detail", ...}；
+每完成一条就写入。<输出文件>.checkpoint 记录已全部完成的最大输入行号，
+加上 --resume 重新运行时跳过已完成的行并继续追加输出。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ai_clients import PROVIDERS
+from metrics import metrics
+from resilience import ProviderError, ProviderGuard
+from response_cache import ResponseCache
+from singleflight import default_flights
+from transport import HttpTransport
+
+# 已读入但尚未全部完成的输入行数上限，保证内存占用与输入文件大小无关
+DEFAULT_WINDOW = 1000
+CHECKPOINT_INTERVAL = 1.0
+
+
+def load_config(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def build_clients(config, transport, cache=None):
+    clients = {}
+    for name, (client_class, key_option, url_option) in PROVIDERS.items():
+        clients[name] = client_class(config.get(key_option, ""), config.get(url_option), transport=transport)
+        clients[name].cache = cache
+        clients[name].guard = ProviderGuard.from_config(name, config)
+    return clients
+
+
+def request_messages(item):
+    if "messages" in item:
+        messages = list(item["messages"])
+    else:
+        messages = [{"role": "user", "content": item["prompt"]}]
+    if item.get("system"):
+        messages.insert(0, {"role": "system", "content": item["system"]})
+    return messages
+
+
+def checkpoint_path(output_path):
+    return output_path + ".checkpoint"
+
+
+def read_checkpoint(output_path):
+    """返回 (已全部完成的最大行号, 该行号之后已写出的行号集合)"""
+    try:
+        with open(checkpoint_path(output_path), "r", encoding="utf-8") as f:
+            watermark = json.load(f)["line"]
+    except (FileNotFoundError, ValueError, KeyError):
+        watermark = 0
+
+    # 检查点之后、崩溃之前写出的结果也算完成；逐行读取，不把整个输出载入内存
+    done = set()
+    try:
+        with open(output_path, "r", encoding="utf-8") as f:
+            for raw in f:
+                try:
+                    line = json.loads(raw)["line"]
+                except (ValueError, KeyError, TypeError):
+                    continue  # 崩溃时写了一半的行
+                if line > watermark:
+                    done.add(line)
+    except FileNotFoundError:
+        pass
+    return watermark, done
+
+
+def write_checkpoint(output_path, watermark):
+    path = checkpoint_path(output_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"line": watermark}, f)
+    os.replace(tmp_path, path)
+
+
+class BatchRunner:
+    """按服务商限制并发，逐行读取输入、逐条写出结果
+
+    每个服务商有自己的队列和 limit 个工作协程；读取协程把每行放入对应队列，
+    队列满时等待。已读入但未完成的行数不超过 window，所以内存占用恒定。
+    """
+
+    def __init__(self, clients, output, limits, default_model="DeepSeek", window=DEFAULT_WINDOW,
+                 use_cache=False, progress=sys.stderr):
+        self.clients = clients
+        self.output = output
+        self.output_path = output.name
+        self.limits = limits
+        self.default_model = default_model
+        self.window = window
+        self.use_cache = use_cache
+        self.progress = progress
+        self.watermark = 0
+        self.done = set()  # watermark 之后已完成的行号
+        self.counters = {"ok": 0, "failed": 0, "skipped": 0}
+        self._last_checkpoint = 0.0
+
+    async def run(self, lines, watermark=0, done=()):
+        self.watermark = watermark
+        self.done = set(done)
+        self._advance()
+        self._progressed = asyncio.Condition()
+        self._started = time.perf_counter()
+
+        queues = {name: asyncio.Queue(maxsize=limit * 2) for name, limit in self.limits.items()}
+        workers = [
+            asyncio.create_task(self._worker(name, queues[name]))
+            for name, limit in self.limits.items() for _ in range(limit)
+        ]
+        try:
+            await self._read(lines, queues)
+            for queue in queues.values():
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._checkpoint(force=True)
+        self._report(final=True)
+        return self.counters
+
+    async def _read(self, lines, queues):
+        for number, raw in enumerate(lines, 1):
+            if number <= self.watermark or number in self.done:
+                self.counters["skipped"] += 1
+                continue
+            # 最早未完成的行与当前行相距太远时等待，避免已完成行号的集合无限增长
+            async with self._progressed:
+                await self._progressed.wait_for(lambda: number - self.watermark <= self.window)
+
+            raw = raw.strip()
+            if not raw:
+                await self._finish(number, None, None, "", {"kind": "bad_input", "detail": "空行"}, 0.0)
+                continue
+            try:
+                item = json.loads(raw)
+                messages = request_messages(item)
+            except (ValueError, KeyError, TypeError) as e:
+                await self._finish(number, None, None, "", {"kind": "bad_input", "detail": f"无法解析输入: {e}"}, 0.0)
+                continue
+            model = item.get("model") or self.default_model
+            if model not in queues:
+                await self._finish(number, item.get("id"), model, "", {"kind": "bad_input", "detail": f"未知模型: {model}"}, 0.0)
+                continue
+            await queues[model].put((number, item.get("id", number), messages))
+
+    async def _worker(self, model, queue):
+        client = self.clients[model]
+        while True:
+            number, item_id, messages = await queue.get()
+            start = time.perf_counter()
+            try:
+                response, error = await client.aget_response(messages, self.use_cache), None
+            except ProviderError as e:
+                response, error = "", e.to_dict()
+            except Exception as e:
+                response, error = "", {"kind": "unknown", "detail": str(e)}
+            try:
+                await self._finish(number, item_id, model, response, error, time.perf_counter() - start)
+            finally:
+                queue.task_done()
+
+    async def _finish(self, number, item_id, model, response, error, elapsed):
+        record = {
+            "line": number,
+            "id": item_id if item_id is not None else number,
+            "model": model,
+            "response": response,
+            "error": error,
+            "elapsed": round(elapsed, 3),
+        }
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.output.flush()
+        self.counters["failed" if error else "ok"] += 1
+
+        self.done.add(number)
+        self._advance()
+        async with self._progressed:
+            self._progressed.notify_all()
+        self._checkpoint()
+
+    def _advance(self):
+        while self.watermark + 1 in self.done:
+            self.watermark += 1
+            self.done.discard(self.watermark)
+
+    def _checkpoint(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self._last_checkpoint < CHECKPOINT_INTERVAL:
+            return
+        self._last_checkpoint = now
+        # 先保证结果已落盘，检查点才能前移
+        os.fsync(self.output.fileno())
+        write_checkpoint(self.output_path, self.watermark)
+        if not force:
+            self._report()
+
+    def _report(self, final=False):
+        if self.progress is None:
+            return
+        finished = self.counters["ok"] + self.counters["failed"]
+        elapsed = time.perf_counter() - self._started
+        rate = finished / elapsed if elapsed else 0.0
+        print(
+            f"完成 {finished}（失败 {self.counters['failed']}，跳过 {self.counters['skipped']}），"
+            f"{rate:.1f} 条/秒，检查点 {self.watermark}",
+            file=self.progress, end="\n" if final else "\r", flush=True
+        )
+        if final and default_flights().counters["coalesced"]:
+            # 同时进行的重复问题只请求了一次
+            print(f"合并重复请求 {default_flights().counters['coalesced']} 次", file=self.progress)
+
+
+def parse_limits(concurrency, overrides):
+    limits = {name: concurrency for name in PROVIDERS}
+    for override in overrides or []:
+        name, _, value = override.partition("=")
+        if name not in limits or not value.isdigit() or int(value) < 1:
+            raise argparse.ArgumentTypeError(f"无效的并发设置: {override}")
+        limits[name] = int(value)
+    return limits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量发送 JSONL 中的问题")
+    parser.add_argument("input", help="输入 JSONL 文件")
+    parser.add_argument("output", help="输出 JSONL 文件")
+    parser.add_argument("--model", default="DeepSeek", choices=sorted(PROVIDERS), help="默认模型")
+    parser.add_argument("--concurrency", type=int, default=4, help="每个服务商的并发请求数")
+    parser.add_argument("--limit", action="append", metavar="MODEL=N", help="单独设置某个服务商的并发数")
+    parser.add_argument("--resume", action="store_true", help="从检查点继续，跳过已完成的行")
+    parser.add_argument("--use-cache", action="store_true", help="使用响应缓存")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="最多同时未完成的输入行数")
+    parser.add_argument("--metrics", metavar="FILE", help="结束时导出延迟和 token 统计（.jsonl 或 Prometheus 文本）")
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args(argv)
+
+    try:
+        limits = parse_limits(args.concurrency, args.limit)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    if args.resume:
+        watermark, done = read_checkpoint(args.output)
+    else:
+        watermark, done = 0, set()
+        if os.path.exists(args.output):
+            parser.error(f"{args.output} 已存在；使用 --resume 继续，或换一个输出文件")
+
+    config = load_config(args.config)
+    total_concurrency = sum(limits.values())
+    transport = HttpTransport(
+        connect_timeout=config.get("http_connect_timeout", 5.0),
+        read_timeout=config.get("http_read_timeout", 120.0),
+        pool_maxsize=max(16, total_concurrency),
+        http2=config.get("http2", False)
+    )
+    cache = None
+    if args.use_cache:
+        cache = ResponseCache(
+            os.path.join("cache", "responses.db"),
+            ttl=config.get("cache_ttl_hours", 168) * 3600,
+            max_disk_bytes=config.get("cache_max_mb", 50) * 1024 * 1024
+        )
+    clients = build_clients(config, transport, cache)
+
+    async def run():
+        # 同步客户端的流在线程池中读取，线程数要够所有并发请求使用
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=total_concurrency + 4))
+        with open(args.input, "r", encoding="utf-8") as lines, \
+                open(args.output, "a", encoding="utf-8") as output:
+            runner = BatchRunner(
+                clients, output, limits, default_model=args.model, window=args.window,
+                use_cache=args.use_cache
+            )
+            return await runner.run(lines, watermark, done)
+
+    try:
+        counters = asyncio.run(run())
+    except KeyboardInterrupt:
+        print("\n已中断，使用 --resume 继续", file=sys.stderr)
+        return 130
+    finally:
+        transport.close()
+        if cache is not None:
+            cache.close()
+        if args.metrics:
+            metrics.export(args.metrics)
+    return 1 if counters["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""对比旧的多遍正则分段与单遍增量分段器在不同长度回复上的耗时
+
+    python -m benchmarks.bench_markdown --sizes 25 50 100 200
+"""
+
+import argparse
+import json
+import re
+import time
+
+from markdown_stream import MarkdownTokenizer, tokenize
+
+SAMPLE_BLOCK = """## 第 {n} 节
+
+下面给出公式 $E = mc^2$ 以及 \\(a^2 + b^2 = c^2\\)，并用 `numpy` 验证：
+
+$$
+\\int_0^1 x^{n} \\, dx = \\frac{{1}}{{n + 1}}
+$$
+
+- 第一步：计算 \\[\\sum_{{i=1}}^{{n}} i = \\frac{{n(n+1)}}{{2}}\\]
+- 第二步：比较结果
+1. 导入依赖
+2. 运行代码
+
+```python
+import numpy as np
+print(np.arange({n}).sum())
+```
+
+Plain English text follows here so that the reply is not only formulas and code.
+
+"""
+
+
+def make_reply(size_kb):
+    blocks = []
+    total = 0
+    n = 0
+    while total < size_kb * 1024:
+        block = SAMPLE_BLOCK.format(n=n)
+        blocks.append(block)
+        total += len(block.encode("utf-8"))
+        n += 1
+    return "".join(blocks)
+
+
+def legacy_split_latex(text):
+    # 旧实现：四个定界符各做一遍 re.split
+    patterns = [
+        r'(\$\$[^$]+\$\$)',
+        r'(\$[^$]+\$)',
+        r'(\\\[[^\]]+\\\])',
+        r'(\\\([^)]+\\\))'
+    ]
+    segments = [text]
+    for pattern in patterns:
+        new_segments = []
+        for segment in segments:
+            if any(segment.startswith(delim) for delim in ['$', '\\[']):
+                new_segments.append(segment)
+            else:
+                for part in re.split(pattern, segment):
+                    if part and not part.isspace():
+                        new_segments.append(part)
+        segments = new_segments
+    return [s for s in segments if s]
+
+
+def legacy_format_markdown(text):
+    # 旧实现：代码块占位替换后，每一行都要遍历所有占位符
+    code_blocks = {}
+
+    def replace_code_block(match):
+        key = f"CODE_BLOCK_{len(code_blocks)}"
+        code_blocks[key] = match.group(1)
+        return key
+
+    text = re.sub(r'```(?:\w+)?\n(.*?)```', replace_code_block, text, flags=re.DOTALL)
+    inline_code_blocks = {}
+
+    def replace_inline_code(match):
+        key = f"INLINE_CODE_{len(inline_code_blocks)}"
+        inline_code_blocks[key] = match.group(1)
+        return key
+
+    text = re.sub(r'`([^`]+)`', replace_inline_code, text)
+    formatted_lines = []
+    for line in text.split('\n'):
+        if line.startswith('# '):
+            formatted_lines.append(('heading1', line[2:]))
+        elif line.startswith('## '):
+            formatted_lines.append(('heading2', line[3:]))
+        elif line.startswith('### '):
+            formatted_lines.append(('heading3', line[4:]))
+        elif line.startswith('- ') or line.startswith('* '):
+            formatted_lines.append(('list_item', '• ' + line[2:]))
+        elif line.startswith('1. '):
+            formatted_lines.append(('list_item', line))
+        else:
+            formatted_lines.append(('normal', line))
+
+    result = []
+    for tag, line in formatted_lines:
+        for key, code in code_blocks.items():
+            if key in line:
+                result.append(('code', code))
+                break
+        else:
+            for key, code in inline_code_blocks.items():
+                if key in line:
+                    line = line.replace(key, f'`{code}`')
+            result.append((tag, line))
+    return result
+
+
+def legacy_render(text):
+    result = []
+    for segment in legacy_split_latex(text):
+        if any(segment.startswith(delim) for delim in ['$', '\\[']):
+            result.append(('latex', segment))
+        else:
+            result.extend(legacy_format_markdown(segment))
+    return result
+
+
+def legacy_streamed(text, step):
+    # 旧实现要增量显示只能每隔一段重新解析全部已收到的文本
+    for end in range(step, len(text) + step, step):
+        legacy_render(text[:end])
+
+
+def streamed(text, chunk_size):
+    tokenizer = MarkdownTokenizer()
+    segments = []
+    for start in range(0, len(text), chunk_size):
+        segments.extend(tokenizer.feed(text[start:start + chunk_size]))
+    segments.extend(tokenizer.finish())
+    return segments
+
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(sizes=(25, 50, 100, 200), chunk_size=16, repeat=3, reparse_step=4096):
+    results = []
+    for size_kb in sizes:
+        text = make_reply(size_kb)
+        row = {"size_kb": size_kb}
+        for name, func in (
+            ("legacy_ms", lambda: legacy_render(text)),
+            ("single_pass_ms", lambda: tokenize(text)),
+            ("streamed_ms", lambda: streamed(text, chunk_size)),
+            ("legacy_streamed_ms", lambda: legacy_streamed(text, reparse_step)),
+        ):
+            elapsed = best_of(func, repeat)
+            row[name] = round(elapsed * 1000, 2)
+            row[name.replace("_ms", "_us_per_kb")] = round(elapsed * 1e6 / size_kb, 1)
+        results.append(row)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Markdown/LaTeX 分段基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[25, 50, 100, 200], help="回复大小（KB）")
+    parser.add_argument("--chunk-size", type=int, default=16, help="流式输入每块的字符数")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reparse-step", type=int, default=4096, help="旧实现增量显示时每隔多少字符重新解析")
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.sizes, args.chunk_size, args.repeat, args.reparse_step), indent=2))
+
+
+if __name__ == "__main__":
+    main()
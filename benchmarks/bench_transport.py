@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""对比每次新建连接与共享连接池的请求延迟
+
+    python -m benchmarks.bench_transport --requests 50 --connect-delay 0.05
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+import requests
+
+from ai_clients import DeepseekClient, iter_sse_data
+from mock_server import MockLLMServer
+from transport import HttpTransport
+
+
+def fresh_connection_request(url):
+    # 旧实现：模块级 requests.post，每次都重新建立连接
+    data = {"model": "deepseek-chat", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    with requests.post(url, json=data, stream=True) as response:
+        return "".join(
+            json.loads(payload)["choices"][0]["delta"].get("content") or ""
+            for payload in iter_sse_data(response.iter_lines())
+        )
+
+
+def measure(func, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "median_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+        "total_s": round(sum(latencies), 3),
+    }
+
+
+def run(count=50, connect_delay=0.05):
+    with MockLLMServer(ttft=0, tokens_per_second=0, connect_delay=connect_delay) as server:
+        url = server.chat_completions_url
+        transport = HttpTransport()
+        client = DeepseekClient("benchmark", url, transport=transport)
+        transport.prewarm([url])[0].join()
+
+        results = {
+            "fresh_connection": measure(lambda: fresh_connection_request(url), count),
+            "pooled_keepalive": measure(lambda: client.get_response("hi"), count),
+        }
+        transport.close()
+    results["speedup"] = round(results["fresh_connection"]["median_ms"] / results["pooled_keepalive"]["median_ms"], 2)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="连接池基准测试")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--connect-delay", type=float, default=0.05, help="模拟的握手延迟（秒）")
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.requests, args.connect_delay), indent=2))
+
+
+if __name__ == "__main__":
+    main()
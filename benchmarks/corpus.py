@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""基准测试用的合成回复语料，同样的参数总是生成完全相同的文本
+
+    code   代码为主：多种语言的代码块、行内代码和少量说明
+    math   公式为主：行内 / 独立公式、列表和推导说明
+    prose  中英文混排的长篇文字：标题、段落和列表
+"""
+
+import random
+
+CODE_SNIPPETS = {
+    "python": [
+        "def fib(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n    return a\n",
+        "import numpy as np\n\nmatrix = np.arange({n}).reshape(-1, 1)\nprint(matrix.T @ matrix)\n",
+        "class Cache:\n    def __init__(self, size={n}):\n        self.size = size\n        self.items = {{}}\n\n"
+        "    def get(self, key):\n        return self.items.get(key)\n",
+    ],
+    "javascript": [
+        "const total = items.reduce((sum, item) => sum + item.price * {n}, 0);\nconsole.log(`total: ${{total}}`);\n",
+        "async function load(url) {{\n  const response = await fetch(url);\n  return response.json();\n}}\n",
+    ],
+    "bash": [
+        "for file in *.log; do\n  grep -c ERROR \"$file\"\ndone | sort -n | tail -{n}\n",
+        "pip install -r requirements.txt\npython -m benchmarks.suite run --output baseline.json\n",
+    ],
+}
+
+LATEX_EXPRESSIONS = [
+    "E = mc^2",
+    "a^2 + b^2 = c^2",
+    "\\int_0^1 x^{n} \\, dx = \\frac{1}{n + 1}",
+    "\\sum_{i=1}^{n} i = \\frac{n(n+1)}{2}",
+    "\\lim_{x \\to 0} \\frac{\\sin x}{x} = 1",
+    "\\frac{\\partial f}{\\partial x} + \\frac{\\partial f}{\\partial y}",
+    "\\sqrt{\\alpha^2 + \\beta^2}",
+    "e^{i\\pi} + 1 = 0",
+    "\\prod_{k=1}^{n} (1 + x_k)",
+    "\\mathbf{A}\\mathbf{x} = \\lambda \\mathbf{x}",
+]
+
+ZH_SENTENCES = [
+    "这个问题可以分成几个步骤来解决。",
+    "首先需要确认输入数据的格式是否正确。",
+    "在大多数情况下，缓存可以显著减少重复计算。",
+    "如果遇到网络错误，程序会自动重试。",
+    "下面的例子展示了如何在实际项目中使用它。",
+    "性能瓶颈通常出现在频繁的内存分配上。",
+    "我们建议先写测试，再进行重构。",
+]
+
+EN_SENTENCES = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Streaming responses let the user read the answer while it is being generated.",
+    "A connection pool avoids paying for a new TLS handshake on every request.",
+    "Keep the main thread free so that the window stays responsive.",
+    "Each step below builds on the result of the previous one.",
+    "Measure before optimizing, and measure again afterwards.",
+]
+
+KINDS = ("code", "math", "prose")
+
+
+def _paragraph(rng, sentences=4):
+    parts = []
+    for _ in range(sentences):
+        parts.append(rng.choice(ZH_SENTENCES) if rng.random() < 0.5 else rng.choice(EN_SENTENCES) + " ")
+    return "".join(parts).strip() + "\n"
+
+
+def _code_block(rng, n):
+    lang = rng.choice(sorted(CODE_SNIPPETS))
+    body = "".join(rng.choice(CODE_SNIPPETS[lang]).format(n=n + i) for i in range(rng.randint(1, 3)))
+    return f"```{lang}\n{body}```\n"
+
+
+def _inline_math(rng):
+    expression = rng.choice(LATEX_EXPRESSIONS).replace("{n}", str(rng.randint(2, 9)))
+    return f"${expression}$" if rng.random() < 0.5 else f"\\({expression}\\)"
+
+
+def _display_math(rng):
+    expression = rng.choice(LATEX_EXPRESSIONS).replace("{n}", str(rng.randint(2, 9)))
+    if rng.random() < 0.5:
+        return f"$$\n{expression}\n$$\n"
+    return f"\\[{expression}\\]\n"
+
+
+def _code_section(rng, n):
+    return (
+        f"## 示例 {n}\n\n"
+        f"调用 `load()` 之前先检查 `config.json`，then run the snippet:\n\n"
+        + _code_block(rng, n)
+        + "\n" + _paragraph(rng, 2) + "\n"
+        + _code_block(rng, n + 1) + "\n"
+    )
+
+
+def _math_section(rng, n):
+    return (
+        f"### 推导 {n}\n\n"
+        f"由 {_inline_math(rng)} 可得 {_inline_math(rng)}，因此：\n\n"
+        + _display_math(rng)
+        + f"- 第一步：代入 {_inline_math(rng)}\n"
+        + f"- 第二步：化简得到 {_inline_math(rng)}\n"
+        + "1. Check the boundary conditions.\n\n"
+        + _display_math(rng) + "\n"
+    )
+
+
+def _prose_section(rng, n):
+    return (
+        f"# 第 {n} 章 Chapter {n}\n\n"
+        + _paragraph(rng, 6) + "\n"
+        + _paragraph(rng, 5) + "\n"
+        + "".join(f"- {rng.choice(ZH_SENTENCES)} {rng.choice(EN_SENTENCES)}\n" for _ in range(3))
+        + "\n" + _paragraph(rng, 4) + "\n"
+    )
+
+
+SECTIONS = {"code": _code_section, "math": _math_section, "prose": _prose_section}
+
+
+def make_reply(kind, size_kb, seed=0):
+    """生成约 size_kb KB（UTF-8）的回复文本"""
+    rng = random.Random(f"{kind}:{seed}")
+    section = SECTIONS[kind]
+    parts = []
+    total = 0
+    n = 0
+    while total < size_kb * 1024:
+        text = section(rng, n)
+        parts.append(text)
+        total += len(text.encode("utf-8"))
+        n += 1
+    return "".join(parts)
+
+
+def make_corpora(size_kb, seed=0):
+    """{类型: 回复文本}"""
+    return {kind: make_reply(kind, size_kb, seed) for kind in KINDS}
+
+
+def latex_expressions(count, seed=0):
+    """公式渲染基准使用的表达式（去掉定界符）"""
+    rng = random.Random(f"latex:{seed}")
+    return [
+        rng.choice(LATEX_EXPRESSIONS).replace("{n}", str(rng.randint(2, 99)))
+        for _ in range(count)
+    ]
@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+"""可重复的基准测试套件：Markdown 分段、文本框渲染、公式渲染、代码高亮、会话存储、相关对话索引和三个客户端
+
+    python -m benchmarks.suite run --output baseline.json
+    python -m benchmarks.suite run --output current.json --compare baseline.json
+    python -m benchmarks.suite compare baseline.json current.json --threshold 0.15
+
+无界面的 Linux 上可在 Xvfb 中运行（xvfb-run python -m benchmarks.suite run），
+没有显示器时自动改用记录调用的桩文本框，只测 Python 侧开销。
+结果中的 meta 记录了运行参数，对比时参数不同会给出提示。
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import latex_expressions, make_corpora
+
+GROUPS = ("markdown", "render", "latex", "highlight", "storage", "related", "clients")
+FIELDS = ("median_ms", "min_ms", "mean_ms", "p95_ms")
+
+
+class StubTextbox:
+    """没有显示器时代替 Tk 文本框：保存插入的文本，其余操作只计数"""
+
+    def __init__(self):
+        self.parts = []
+        self.calls = 0
+
+    def insert(self, index, text, tags=None):
+        self.calls += 1
+        self.parts.append(text)
+
+    def delete(self, start, end=None):
+        self.calls += 1
+        if start == "1.0":
+            self.parts.clear()
+
+    def _call(self, *args, **kwargs):
+        self.calls += 1
+
+    mark_set = mark_gravity = mark_unset = tag_add = tag_config = image_create = see = _call
+
+    def index(self, index):
+        self.calls += 1
+        return "1.0"
+
+    def update_idletasks(self):
+        pass
+
+
+class RenderTarget:
+    """AIChatApp.render_segments 用到的最少属性；公式只插入占位符，代码不加高亮，二者单独测量"""
+
+    def __init__(self, textbox):
+        self.chat_history = textbox
+        self.typewriter = None
+
+    def render_latex(self, latex_code, index="end"):
+        self.chat_history.insert(index, "￼", "latex")
+
+    def insert_code(self, segment, index="end"):
+        self.chat_history.insert(index, segment.text, segment.tag)
+
+
+def make_textbox(mode):
+    """返回 (文本框, 实际类型, 清理函数)；mode 为 auto / tk / stub"""
+    if mode != "stub":
+        import tkinter as tk
+        try:
+            root = tk.Tk()
+        except tk.TclError:
+            if mode == "tk":
+                raise
+        else:
+            root.withdraw()
+            textbox = tk.Text(root, wrap="word", width=100, height=40)
+            textbox.pack()
+            # 与聊天窗口相同的标签，换行和字体测量的开销才接近实际
+            textbox.tag_configure("heading1", font=("Helvetica", 24, "bold"))
+            textbox.tag_configure("heading2", font=("Helvetica", 20, "bold"))
+            textbox.tag_configure("heading3", font=("Helvetica", 16, "bold"))
+            textbox.tag_configure("code", font=("Courier", 12), background="#2b2b2b")
+            textbox.tag_configure("inline_code", font=("Courier", 12))
+            textbox.tag_configure("list_item", lmargin1=20, lmargin2=40)
+            textbox.tag_configure("latex", justify="center")
+            return textbox, "tk", root.destroy
+    return StubTextbox(), "stub", lambda: None
+
+
+def measure(func, repeat, setup=None, warmup=1):
+    """执行 warmup + repeat 次，返回后 repeat 次的耗时（秒）；setup 的返回值传给 func，不计时"""
+    samples = []
+    for index in range(warmup + repeat):
+        argument = setup() if setup is not None else None
+        started = time.perf_counter()
+        if setup is not None:
+            func(argument)
+        else:
+            func()
+        elapsed = time.perf_counter() - started
+        if index >= warmup:
+            samples.append(elapsed)
+    return samples
+
+
+def summarize(samples, **extra):
+    ordered = sorted(samples)
+    summary = {
+        "runs": len(ordered),
+        "median_ms": round(statistics.median(ordered) * 1000, 4),
+        "min_ms": round(ordered[0] * 1000, 4),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "p95_ms": round(ordered[max(0, int(len(ordered) * 0.95 + 0.5) - 1)] * 1000, 4),
+        "stdev_ms": round(statistics.pstdev(ordered) * 1000, 4),
+    }
+    summary.update(extra)
+    return summary
+
+
+def streamed(text, chunk_size):
+    from markdown_stream import MarkdownTokenizer
+    tokenizer = MarkdownTokenizer()
+    segments = []
+    for start in range(0, len(text), chunk_size):
+        segments.extend(tokenizer.feed(text[start:start + chunk_size]))
+    segments.extend(tokenizer.finish())
+    return segments
+
+
+def bench_markdown(corpora, repeat, chunk_size=16):
+    from markdown_stream import tokenize
+    results = {}
+    for kind, text in corpora.items():
+        results[f"markdown.tokenize.{kind}"] = summarize(measure(lambda: tokenize(text), repeat))
+        results[f"markdown.streamed.{kind}"] = summarize(
+            measure(lambda: streamed(text, chunk_size), repeat), chunk_size=chunk_size
+        )
+    return results
+
+
+def bench_render(corpora, repeat, textbox):
+    from main import AIChatApp
+    from markdown_stream import tokenize
+    target = RenderTarget(textbox)
+    results = {}
+    for kind, text in corpora.items():
+        segments = tokenize(text)
+
+        def render():
+            AIChatApp.render_segments(target, segments)
+            # 让 Tk 完成换行和布局计算，否则开销会被推迟到下一次刷新
+            textbox.update_idletasks()
+
+        def clear():
+            textbox.delete("1.0", "end")
+
+        results[f"render.segments.{kind}"] = summarize(
+            measure(lambda _: render(), repeat, setup=clear), segments=len(segments)
+        )
+    textbox.delete("1.0", "end")
+    return results
+
+
+def bench_latex(count, repeat):
+    from latex_renderer import rasterize_latex
+    expressions = latex_expressions(count)
+    samples = measure(
+        lambda: [rasterize_latex(expression, False, "dark", 96) for expression in expressions], repeat
+    )
+    return {"latex.rasterize": summarize(samples, expressions=count)}
+
+
+def bench_highlight(corpora, repeat, textbox):
+    """代码块的词法分析（工作进程中的开销）和添加颜色标签（Tk 线程中按帧分摊的开销）"""
+    from highlighter import SyntaxHighlighter, lex_spans
+    from markdown_stream import tokenize
+    blocks = [segment for segment in tokenize(corpora["code"]) if segment.tag == "code" and segment.lang]
+    results = {
+        "highlight.lex": summarize(
+            measure(lambda: [lex_spans(block.lang, block.text) for block in blocks], repeat), blocks=len(blocks)
+        )
+    }
+
+    class Root:
+        # 同步执行 after 回调，测的是添加全部标签的总耗时
+        def after(self, delay, func):
+            func()
+
+    highlighter = SyntaxHighlighter(Root(), frame_budget=float("inf"))
+    spans = [lex_spans(block.lang, block.text) for block in blocks]
+
+    def apply():
+        for block, block_spans in zip(blocks, spans):
+            textbox.mark_set("bench_code", "end-1c")
+            textbox.mark_gravity("bench_code", "left")
+            textbox.insert("end", block.text, "code")
+            highlighter.apply(textbox, "bench_code", block_spans)
+        textbox.update_idletasks()
+
+    results["highlight.apply"] = summarize(
+        measure(lambda _: apply(), repeat, setup=lambda: textbox.delete("1.0", "end")),
+        spans=sum(len(values) // 4 for block_spans in spans if block_spans for values in block_spans.values())
+    )
+    textbox.delete("1.0", "end")
+    return results
+
+
+def bench_storage(corpora, messages, repeat):
+    from chat_store import ChatStore
+    from history_index import HistoryIndex
+
+    # 问答交替，回答取自语料的不同片段（每条约 2KB）
+    replies = []
+    for text in corpora.values():
+        replies.extend(text[start:start + 2048] for start in range(0, len(text), 2048))
+    records = []
+    for index in range(messages):
+        if index % 2 == 0:
+            records.append(("user", f"问题 {index}: how do I cache results?", None))
+        else:
+            records.append(("assistant", replies[index % len(replies)], "DeepSeek"))
+
+    directories = []
+
+    def open_store():
+        directory = tempfile.mkdtemp(prefix="bench_store_")
+        directories.append(directory)
+        store = ChatStore(directory, flush_interval=0.01, index=HistoryIndex(directory))
+        return store, store.new_conversation()
+
+    def append_all(state):
+        store, conversation_id = state
+        for role, content, model in records:
+            store.append(conversation_id, role, content, model=model)
+        store.flush()
+        store.close()
+
+    results = {"storage.append_flush": summarize(measure(append_all, repeat, setup=open_store), messages=messages)}
+
+    store, conversation_id = open_store()
+    append_all((store, conversation_id))
+    index = store.index
+    pages = (messages + 19) // 20
+    results["storage.read_pages"] = summarize(
+        measure(lambda: [index.read_page(conversation_id, page) for page in range(pages)], repeat), pages=pages
+    )
+    results["storage.search"] = summarize(measure(lambda: index.search("缓存 cache"), repeat))
+    index.close()
+
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_related(corpora, conversations, repeat, queries=20):
+    import random
+    from chat_store import make_record
+    from related import RelatedIndex
+
+    # 每个会话一问一答，回答取自语料的不同片段（约 1KB），问题带上编号使各会话互不相同
+    pieces = []
+    for text in corpora.values():
+        pieces.extend(text[start:start + 1024] for start in range(0, len(text), 1024))
+    directory = tempfile.mkdtemp(prefix="bench_related_")
+    conversation_ids = []
+    for number in range(conversations):
+        conversation_id = f"bench_{number:06d}"
+        conversation_ids.append(conversation_id)
+        with open(os.path.join(directory, f"{conversation_id}.jsonl"), "w", encoding="utf-8") as f:
+            for record in (
+                make_record("user", f"问题 {number}: {pieces[number * 7 % len(pieces)][:80]}"),
+                make_record("assistant", pieces[number % len(pieces)], "DeepSeek"),
+            ):
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    rng = random.Random("related")
+    texts = [rng.choice(pieces) for _ in range(queries)]
+    texts = [text[start:start + 24] for text in texts for start in [rng.randrange(max(1, len(text) - 24))]]
+
+    def build():
+        index = RelatedIndex(directory, filename="bench.npz")
+        index.sync(conversation_ids)
+        return index
+
+    results = {"related.build": summarize(measure(build, max(1, repeat // 2), warmup=0), conversations=conversations)}
+    index = build()
+    results["related.query"] = summarize(
+        measure(lambda: [index.query(text, 5) for text in texts], repeat), queries=len(texts)
+    )
+
+    def append():
+        # 当前会话追加一条消息（写线程中的增量更新）
+        conversation_id = conversation_ids[0]
+        size = index.sizes[conversation_id]
+        record = make_record("user", rng.choice(pieces)[:200])
+        index.add_records(conversation_id, [(size, 200, record)], size + 200)
+
+    results["related.update"] = summarize(measure(append, repeat))
+    shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_clients(corpora, requests, ttft, tokens_per_second, reply_kb=4):
+    from ai_clients import ClaudeClient, DeepseekClient, OpenAIClient
+    from mock_server import MockLLMServer
+    from transport import HttpTransport
+
+    reply = corpora["prose"][:reply_kb * 1024]
+    results = {}
+    with MockLLMServer(ttft=ttft, tokens_per_second=tokens_per_second, reply=reply) as server:
+        transport = HttpTransport()
+        clients = {
+            "DeepSeek": DeepseekClient("benchmark", server.chat_completions_url, transport=transport),
+            "OpenAI": OpenAIClient("benchmark", server.base_url + "/v1", transport=transport),
+            "Claude": ClaudeClient("benchmark", server.base_url, transport=transport),
+        }
+        for thread in transport.prewarm([server.base_url]):
+            thread.join()
+
+        for name, client in clients.items():
+            first_tokens = []
+            totals = []
+            # 第一次请求包含客户端初始化，不计入
+            client.get_response("warmup", use_cache=False)
+            for index in range(requests):
+                started = time.perf_counter()
+                first = None
+                for _ in client.stream_response(f"benchmark request {index}", use_cache=False):
+                    if first is None:
+                        first = time.perf_counter() - started
+                totals.append(time.perf_counter() - started)
+                first_tokens.append(first if first is not None else totals[-1])
+            key = name.lower()
+            results[f"clients.{key}.ttft"] = summarize(first_tokens)
+            results[f"clients.{key}.total"] = summarize(totals, reply_chars=len(reply))
+        transport.close()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(groups=GROUPS, size_kb=50, repeat=5, textbox_mode="auto", latex_count=20, messages=200,
+        requests=20, ttft=0.0, tokens_per_second=0.0, conversations=2000, log=print):
+    corpora = make_corpora(size_kb)
+    config = {
+        "size_kb": size_kb, "repeat": repeat, "latex_count": latex_count, "messages": messages,
+        "requests": requests, "ttft": ttft, "tokens_per_second": tokens_per_second,
+        "conversations": conversations,
+    }
+    results = {}
+    textbox_kind = None
+    for group in groups:
+        log(f"running {group} ...")
+        if group == "markdown":
+            results.update(bench_markdown(corpora, repeat))
+        elif group == "render":
+            textbox, textbox_kind, cleanup = make_textbox(textbox_mode)
+            try:
+                results.update(bench_render(corpora, repeat, textbox))
+            finally:
+                cleanup()
+        elif group == "latex":
+            results.update(bench_latex(latex_count, repeat))
+        elif group == "highlight":
+            textbox, textbox_kind, cleanup = make_textbox(textbox_mode)
+            try:
+                results.update(bench_highlight(corpora, repeat, textbox))
+            finally:
+                cleanup()
+        elif group == "storage":
+            results.update(bench_storage(corpora, messages, repeat))
+        elif group == "related":
+            results.update(bench_related(corpora, conversations, repeat))
+        elif group == "clients":
+            results.update(bench_clients(corpora, requests, ttft, tokens_per_second))
+    config["textbox"] = textbox_kind
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": config,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.10, min_delta_ms=0.1, field="median_ms"):
+    """逐项对比两份结果，返回 [(名称, 基线, 当前, 比值, 状态)]
+
+    当前值比基线慢 threshold 以上、且绝对差值超过 min_delta_ms 时为 regression，
+    快同样幅度为 improved；只在一份结果中出现的项目标记为 added / removed。
+    """
+    rows = []
+    base_results = baseline["results"]
+    current_results = current["results"]
+    for name in sorted(set(base_results) | set(current_results)):
+        if name not in current_results:
+            rows.append((name, base_results[name][field], None, None, "removed"))
+            continue
+        if name not in base_results:
+            rows.append((name, None, current_results[name][field], None, "added"))
+            continue
+        before = base_results[name][field]
+        after = current_results[name][field]
+        ratio = after / before if before else None
+        status = "ok"
+        if abs(after - before) > min_delta_ms and ratio is not None:
+            if ratio > 1 + threshold:
+                status = "regression"
+            elif ratio < 1 / (1 + threshold):
+                status = "improved"
+        rows.append((name, before, after, ratio, status))
+    return rows
+
+
+def config_differences(baseline, current):
+    before = baseline.get("meta", {}).get("config", {})
+    after = current.get("meta", {}).get("config", {})
+    return sorted(key for key in set(before) | set(after) if before.get(key) != after.get(key))
+
+
+def format_comparison(rows):
+    lines = [f"{'benchmark':<32} {'baseline':>12} {'current':>12} {'ratio':>7}  status"]
+    for name, before, after, ratio, status in rows:
+        before_text = f"{before:.3f}ms" if before is not None else "-"
+        after_text = f"{after:.3f}ms" if after is not None else "-"
+        ratio_text = f"{ratio:.2f}x" if ratio is not None else "-"
+        marker = "  <<<" if status == "regression" else ""
+        lines.append(f"{name:<32} {before_text:>12} {after_text:>12} {ratio_text:>7}  {status}{marker}")
+    return "\n".join(lines)
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def report_comparison(baseline, current, threshold, min_delta_ms, field="median_ms"):
+    """打印对比结果，返回退出码：有性能回退时为 1"""
+    differences = config_differences(baseline, current)
+    if differences:
+        print(f"注意：两次运行的参数不同（{', '.join(differences)}），结果可能不可比")
+    rows = compare(baseline, current, threshold, min_delta_ms, field)
+    print(format_comparison(rows))
+    regressions = [row[0] for row in rows if row[4] == "regression"]
+    if regressions:
+        print(f"\n{len(regressions)} 项性能回退（阈值 {threshold:.0%}）: {', '.join(regressions)}")
+        return 1
+    print(f"\n没有超过 {threshold:.0%} 的性能回退")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="渲染、存储和客户端热路径的基准测试")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="运行基准测试并保存 JSON 结果")
+    run_parser.add_argument("--output", help="结果文件；不指定时输出到标准输出")
+    run_parser.add_argument("--compare", metavar="BASELINE", help="运行后与基线对比")
+    run_parser.add_argument("--only", nargs="+", choices=GROUPS, default=list(GROUPS), help="只运行指定的测试组")
+    run_parser.add_argument("--size-kb", type=int, default=50, help="每类语料的大小（KB）")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--textbox", choices=("auto", "tk", "stub"), default="auto",
+                            help="auto：有显示器时用 Tk 文本框，否则用桩对象")
+    run_parser.add_argument("--latex-count", type=int, default=20, help="每轮渲染的公式数")
+    run_parser.add_argument("--messages", type=int, default=200, help="存储测试写入的消息数")
+    run_parser.add_argument("--requests", type=int, default=20, help="每个客户端的请求数")
+    run_parser.add_argument("--conversations", type=int, default=2000, help="相关对话索引测试的会话数")
+    run_parser.add_argument("--ttft", type=float, default=0.0, help="模拟服务器首 token 延迟（秒）")
+    run_parser.add_argument("--tokens-per-second", type=float, default=0.0, help="模拟服务器输出速度，0 表示不限速")
+    run_parser.add_argument("--threshold", type=float, default=0.10, help="超过基线多少比例算回退")
+    run_parser.add_argument("--min-delta-ms", type=float, default=0.1, help="小于该绝对差值的变化视为噪声")
+    run_parser.add_argument("--field", choices=FIELDS, default="median_ms", help="对比使用的统计量")
+
+    compare_parser = commands.add_parser("compare", help="对比两份结果，有回退时退出码为 1")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10)
+    compare_parser.add_argument("--min-delta-ms", type=float, default=0.1)
+    compare_parser.add_argument("--field", choices=FIELDS, default="median_ms",
+                                help="min_ms 受系统负载干扰最小，适合在不稳定的机器上使用")
+
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        return report_comparison(
+            load_results(args.baseline), load_results(args.current), args.threshold, args.min_delta_ms, args.field
+        )
+
+    result = run(
+        args.only, args.size_kb, args.repeat, args.textbox, args.latex_count, args.messages,
+        args.requests, args.ttft, args.tokens_per_second, args.conversations,
+        log=lambda text: print(text, file=sys.stderr)
+    )
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        return report_comparison(load_results(args.compare), result, args.threshold, args.min_delta_ms, args.field)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from history_index import HistoryIndex
+
+logger = logging.getLogger(__name__)
+
+# 旧版 .txt 记录中每条消息的标题行，例如 "[12:34:56] DeepSeek: ..."
+LEGACY_HEADER_PATTERN = re.compile(r'^\[(\d{2}:\d{2}:\d{2})\] ([^:\n]+): ?(.*)$')
+
+LEGACY_ROLES = {
+    "你": "user",
+    "You": "user",
+    "系统": "system",
+    "错误": "error",
+    "Error": "error",
+}
+
+
+def make_record(role, content, model=None, timestamp=None):
+    """构造一条会话记录"""
+    return {
+        "role": role,
+        "model": model,
+        "ts": timestamp or datetime.now().isoformat(timespec="seconds"),
+        "content": content,
+    }
+
+
+class ChatStore:
+    """追加写入的会话存储：每个会话一个 JSONL 日志，写入在后台线程中批量完成
+
+    写入或更新索引失败时记录日志，并在写入线程中调用 on_error(消息)，由应用提示用户。
+    """
+
+    def __init__(self, history_dir, flush_interval=0.5, max_batch=256, index=None, extra_indexes=(),
+                 on_error=None):
+        self.history_dir = history_dir
+        self.on_error = on_error
+        self.index = index
+        # 所有随写入增量更新的索引（接口与 HistoryIndex 相同：add_records / remove / sync）
+        self.indexes = [item for item in (index, *extra_indexes) if item is not None]
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        os.makedirs(self.history_dir, exist_ok=True)
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def add_index(self, index):
+        """在运行中加入一个索引，此后写入的记录也会交给它"""
+        self.indexes = self.indexes + [index]
+
+    def new_conversation(self):
+        # 会话 ID 以时间开头，按文件名排序即按时间排序
+        return datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6]
+
+    def path_for(self, conversation_id):
+        return os.path.join(self.history_dir, f"{conversation_id}.jsonl")
+
+    def append(self, conversation_id, role, content, model=None, timestamp=None):
+        """把一条消息放入写队列，立即返回，不阻塞 Tk 线程"""
+        if self._closed:
+            raise RuntimeError("ChatStore 已关闭")
+        record = make_record(role, content, model, timestamp)
+        self._queue.put((conversation_id, record))
+        return record
+
+    def flush(self, timeout=None):
+        """等待此前入队的记录全部落盘"""
+        done = threading.Event()
+        self._queue.put((None, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=5):
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join(timeout)
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            # 攒一批：第一条到达后，在 flush_interval 内继续收集
+            batch = [item]
+            stop = False
+            while batch[-1][0] is not None and len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        pending = {}
+        waiters = []
+        for conversation_id, record in batch:
+            if conversation_id is None:
+                waiters.append(record)
+                continue
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            pending.setdefault(conversation_id, []).append((line, record))
+
+        for conversation_id, lines in pending.items():
+            try:
+                with open(self.path_for(conversation_id), "ab") as f:
+                    offset = f.tell()
+                    f.write(b"".join(line for line, _ in lines))
+            except OSError as e:
+                logger.error("写入聊天记录失败: %s", e)
+                self._report(f"{conversation_id}: {e}")
+                continue
+
+            if self.indexes:
+                # 记录每条消息的字节偏移，供历史窗口按页读取
+                entries = []
+                for line, record in lines:
+                    entries.append((offset, len(line), record))
+                    offset += len(line)
+                for index in self.indexes:
+                    try:
+                        index.add_records(conversation_id, entries, offset)
+                    except Exception as e:
+                        logger.exception("更新历史索引失败")
+                        self._report(f"{type(index).__name__}: {e}")
+
+        for waiter in waiters:
+            waiter.set()
+
+    def _report(self, message):
+        if self.on_error is not None:
+            try:
+                self.on_error(message)
+            except Exception:
+                logger.exception("on_error 回调出错")
+
+    def list_conversations(self):
+        """返回所有会话 ID，按时间从新到旧"""
+        return sorted(
+            (f[:-len(".jsonl")] for f in os.listdir(self.history_dir) if f.endswith(".jsonl")),
+            reverse=True
+        )
+
+    def read_messages(self, conversation_id):
+        """逐条读取会话记录，跳过末尾写了一半的行"""
+        try:
+            with open(self.path_for(conversation_id), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            return
+
+    def compact(self, conversation_id):
+        """重写会话日志，丢弃损坏或不完整的行"""
+        path = self.path_for(conversation_id)
+        records = list(self.read_messages(conversation_id))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+        for index in self.indexes:
+            index.remove(conversation_id)
+            index.sync([conversation_id])
+        return len(records)
+
+
+def parse_legacy_transcript(text, date):
+    """把旧版文本框转储解析为记录列表"""
+    records = []
+    for line in text.splitlines():
+        match = LEGACY_HEADER_PATTERN.match(line)
+        if match:
+            clock, sender, content = match.groups()
+            role = LEGACY_ROLES.get(sender, "assistant")
+            records.append(make_record(
+                role,
+                content,
+                model=sender if role == "assistant" else None,
+                timestamp=f"{date}T{clock}"
+            ))
+        elif records:
+            records[-1]["content"] += "\n" + line
+
+    for record in records:
+        record["content"] = record["content"].strip()
+    return records
+
+
+def migrate_txt_history(history_dir, delete=False):
+    """把旧版的 .txt 全量转储合并为 JSONL 会话
+
+    旧版每发一条消息就把整个文本框写入一个新文件，所以同一会话的后一个文件
+    总是包含前一个文件的内容。这里只保留每条链上的最后一个文件进行转换，
+    原文件移入 legacy_txt/（或在 delete=True 时删除）。
+    """
+    names = sorted(f for f in os.listdir(history_dir) if f.endswith(".txt"))
+    legacy_dir = os.path.join(history_dir, "legacy_txt")
+
+    # 把文件按“前缀包含”关系串成会话链
+    chains = []
+    previous_text = None
+    for name in names:
+        with open(os.path.join(history_dir, name), "r", encoding="utf-8") as f:
+            text = f.read().rstrip()
+        if chains and previous_text is not None and text.startswith(previous_text):
+            chains[-1][1] = text
+        else:
+            chains.append([name, text])
+        previous_text = text
+
+    migrated = 0
+    for first_name, text in chains:
+        stem = first_name[:-len(".txt")]
+        try:
+            date = datetime.strptime(stem[:15], "%Y%m%d_%H%M%S").date().isoformat()
+        except ValueError:
+            date = datetime.now().date().isoformat()
+        records = parse_legacy_transcript(text, date)
+        if not records:
+            continue
+        target = os.path.join(history_dir, f"{stem}_legacy.jsonl")
+        with open(target, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        migrated += 1
+
+    if names and not delete:
+        os.makedirs(legacy_dir, exist_ok=True)
+    for name in names:
+        path = os.path.join(history_dir, name)
+        if delete:
+            os.remove(path)
+        else:
+            shutil.move(path, os.path.join(legacy_dir, name))
+
+    return len(names), migrated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="聊天记录存储维护工具")
+    parser.add_argument("--history-dir", default="chat_history")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="把旧版 .txt 记录合并为 JSONL 会话")
+    migrate_parser.add_argument("--delete", action="store_true", help="转换后删除原 .txt 文件")
+
+    subparsers.add_parser("compact", help="重写所有 JSONL 会话，清除损坏的行")
+
+    args = parser.parse_args(argv)
+    index = HistoryIndex(args.history_dir)
+    store = ChatStore(args.history_dir, index=index)
+
+    if args.command == "migrate":
+        total, migrated = migrate_txt_history(args.history_dir, delete=args.delete)
+        index.sync(store.list_conversations())
+        print(f"处理了 {total} 个 .txt 文件，生成 {migrated} 个会话")
+    elif args.command == "compact":
+        for conversation_id in store.list_conversations():
+            count = store.compact(conversation_id)
+            print(f"{conversation_id}: {count} 条记录")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from history_index import CJK_PATTERN
+
+# 各服务商模型的上下文窗口（token）
+CONTEXT_WINDOWS = {
+    "DeepSeek": 64000,
+    "OpenAI": 16385,
+    "Claude": 200000,
+}
+
+# 为模型回复预留的 token
+RESERVED_OUTPUT_TOKENS = 4096
+
+# 每个字符对应的 token 数估计：(中日韩文字, 其他字符)
+TOKEN_RATES = {
+    "DeepSeek": (0.6, 0.3),
+    "OpenAI": (1.0, 0.25),
+    "Claude": (1.1, 0.29),
+}
+DEFAULT_TOKEN_RATE = (1.0, 0.3)
+
+# 每条消息的格式开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 截断后给早期对话留的摘要长度
+SUMMARY_LINE_CHARS = 80
+SUMMARY_MAX_TOKENS = 1000
+
+# 超出预算时多裁掉一些，使保留部分的开头在接下来几轮保持不变
+TRIM_TARGET_RATIO = 0.75
+
+
+def content_text(content):
+    """消息内容可能是文本，也可能是 [{"type": "text", "text": ...}, ...] 形式的内容块"""
+    if isinstance(content, str):
+        return content
+    return "\n".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def estimate_tokens(text, provider):
+    """按字符类别粗略估计 token 数，不依赖各家的分词器"""
+    text = content_text(text)
+    cjk_rate, other_rate = TOKEN_RATES.get(provider, DEFAULT_TOKEN_RATE)
+    cjk = sum(len(run) for run in CJK_PATTERN.findall(text))
+    return int(cjk * cjk_rate + (len(text) - cjk) * other_rate) + 1
+
+
+class Message:
+    """一条对话消息，按服务商缓存 token 数"""
+
+    __slots__ = ("role", "content", "model", "_tokens")
+
+    def __init__(self, role, content, model=None):
+        self.role = role
+        self.content = content
+        self.model = model
+        self._tokens = {}
+
+    def tokens(self, provider):
+        count = self._tokens.get(provider)
+        if count is None:
+            count = estimate_tokens(self.content, provider) + MESSAGE_OVERHEAD_TOKENS
+            self._tokens[provider] = count
+        return count
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+
+class Conversation:
+    """多轮对话状态与 token 预算管理
+
+    build_messages() 从最新一轮往前累加 token，装不下的早期消息被裁掉，
+    并用一条 system 摘要消息代替。裁剪点只会向后移动且每次多裁一些，
+    这样发送给模型的消息前缀在多轮之间保持稳定。
+    """
+
+    def __init__(self, system_prompt=None, context_windows=None, reserved_output=RESERVED_OUTPUT_TOKENS):
+        self.system_prompt = system_prompt
+        self.context_windows = dict(CONTEXT_WINDOWS, **(context_windows or {}))
+        self.reserved_output = reserved_output
+        self.messages = []
+        self._system = Message("system", system_prompt) if system_prompt else None
+        self._cut = {}  # 每个服务商当前的裁剪位置
+        self._summaries = {}  # 服务商 -> (裁剪位置, 摘要消息)
+
+    def add(self, role, content, model=None):
+        message = Message(role, content, model)
+        self.messages.append(message)
+        return message
+
+    def clear(self):
+        self.messages = []
+        self._cut = {}
+        self._summaries = {}
+
+    def budget(self, provider):
+        return self.context_windows.get(provider, min(CONTEXT_WINDOWS.values())) - self.reserved_output
+
+    def build_messages(self, provider, budget=None):
+        """返回符合 provider 上下文预算的消息列表"""
+        budget = budget or self.budget(provider)
+        head = []
+        if self._system is not None:
+            head.append(self._system)
+            budget -= self._system.tokens(provider)
+
+        cut = self._cut.get(provider, 0)
+        total = sum(message.tokens(provider) for message in self.messages[cut:])
+        if cut:
+            total += self._summary(provider, cut).tokens(provider)
+
+        if total > budget:
+            cut, total = self._advance_cut(provider, cut, budget)
+
+        result = head
+        if cut:
+            result.append(self._summary(provider, cut))
+        result.extend(self.messages[cut:])
+        return [message.to_dict() for message in result]
+
+    def _advance_cut(self, provider, cut, budget):
+        # 裁到预算的 TRIM_TARGET_RATIO 以下（摘要按上限计），但至少保留最新一条消息
+        target = budget * TRIM_TARGET_RATIO - SUMMARY_MAX_TOKENS
+        kept = sum(message.tokens(provider) for message in self.messages[cut:])
+        while cut < len(self.messages) - 1 and kept > target:
+            kept -= self.messages[cut].tokens(provider)
+            cut += 1
+        # 回复必须以用户消息开头（Claude 要求），所以让保留部分从 user 开始
+        while cut < len(self.messages) - 1 and self.messages[cut].role != "user":
+            kept -= self.messages[cut].tokens(provider)
+            cut += 1
+        self._cut[provider] = cut
+        return cut, kept + self._summary(provider, cut).tokens(provider)
+
+    def _summary(self, provider, cut):
+        cached = self._summaries.get(provider)
+        if cached is None or cached[0] != cut:
+            cached = (cut, Message("system", self._summarize(self.messages[:cut], provider)))
+            self._summaries[provider] = cached
+        return cached[1]
+
+    def _summarize(self, messages, provider):
+        """抽取式摘要：每条早期消息取开头一段，总长度受 SUMMARY_MAX_TOKENS 限制"""
+        lines = ["[此前对话摘要 / Summary of earlier conversation]"]
+        used = 0
+        for message in reversed(messages):
+            text = " ".join(message.content.split())
+            if len(text) > SUMMARY_LINE_CHARS:
+                text = text[:SUMMARY_LINE_CHARS] + "..."
+            line = f"{message.role}: {text}"
+            cost = estimate_tokens(line, provider)
+            if used + cost > SUMMARY_MAX_TOKENS:
+                break
+            lines.insert(1, line)
+            used += cost
+        return "\n".join(lines)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import multiprocessing
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import metrics
+
+# 代码块背景固定为深色（见 main.py 中的 code 标签），所以始终使用深色配色
+STYLE = "monokai"
+TAG_PREFIX = "hl_"
+NON_BMP = re.compile("[\U00010000-\U0010ffff]")
+
+
+def lex_spans(lang, code, style=STYLE, utf16=False):
+    """对代码做词法分析（在工作进程中执行），返回 {颜色: array('I')}；不认识的语言返回 None
+
+    每个区间是相对代码开头的 (起始行, 起始列, 结束行, 结束列) 四个数。相邻的同色 token
+    合并为一个区间（中间的空白一起覆盖，不影响显示），没有颜色或与普通文本同色的 token 不输出，
+    所以区间数远少于 token 数。utf16=True 时列号按 UTF-16 单元计算（Tk 8.6 把 emoji 等
+    BMP 以外的字符算作两个字符）。
+    """
+    from pygments.lexers import get_lexer_by_name
+    from pygments.styles import get_style_by_name
+    from pygments.token import Token
+    from pygments.util import ClassNotFound
+
+    try:
+        # 保留首尾空行，token 拼起来与原文完全一致，行列号才对得上
+        lexer = get_lexer_by_name(lang, stripnl=False, ensurenl=False)
+    except ClassNotFound:
+        return None
+    style = get_style_by_name(style)
+    # 与普通文本同色的 token 不需要标签
+    plain = style.style_for_token(Token.Text)["color"]
+    if utf16 and NON_BMP.search(code):
+        def width(text):
+            return len(text) + len(NON_BMP.findall(text))
+    else:
+        width = len
+    colors = {}
+    spans = {}
+    run = None  # [颜色, 起始行, 起始列, 结束行, 结束列]
+    line = column = 0
+    for token_type, value in lexer.get_tokens(code):
+        newlines = value.count("\n")
+        if newlines:
+            end_line = line + newlines
+            end_column = width(value[value.rfind("\n") + 1:])
+        else:
+            end_line = line
+            end_column = column + width(value)
+        if not value.isspace():
+            color = colors.get(token_type)
+            if color is None:
+                color = style.style_for_token(token_type)["color"]
+                color = colors[token_type] = "" if color == plain else color or ""
+            if run is not None and run[0] == color:
+                run[3], run[4] = end_line, end_column
+            else:
+                if run is not None and run[0]:
+                    spans.setdefault(run[0], array("I")).extend(run[1:])
+                run = [color, line, column, end_line, end_column]
+        line, column = end_line, end_column
+    if run is not None and run[0]:
+        spans.setdefault(run[0], array("I")).extend(run[1:])
+    return spans
+
+
+class SyntaxHighlighter:
+    """代码块语法高亮
+
+    - 代码块先按普通代码样式显示；词法分析在单独的工作进程中完成，不占用 Tk 线程的 GIL
+    - 结果按 (语言, 代码哈希) 在内存中按 LRU 缓存，重新显示同一代码块或重复的代码片段时
+      不再分析；同一代码同时被请求多次时只分析一次
+    - 标签按帧分批添加，每帧不超过 frame_budget 秒，很长的代码块也不会卡住界面
+    """
+
+    FRAME_MS = 16
+    BATCH = 64  # 每次读取标记位置后添加的区间数
+
+    def __init__(self, root, memory_entries=256, frame_budget=0.004, workers=1):
+        self.root = root
+        self.memory_entries = memory_entries
+        self.frame_budget = frame_budget
+        self.workers = workers
+
+        self._spans = OrderedDict()  # 键 -> lex_spans 的结果
+        self._pending = {}  # 键 -> 等待结果的回调列表
+        self._lock = threading.Lock()
+        self._process_pool = None
+        self._thread_pool = None
+        self._jobs = deque()
+        self._job = None
+        self._configured = {}  # 文本框 -> 已配置的标签
+        self._utf16 = None
+        self.counters = {"memory_hits": 0, "lexed": 0, "failed": 0}
+
+    @staticmethod
+    def make_key(lang, code):
+        return lang.lower(), hashlib.sha1(code.encode("utf-8")).hexdigest()
+
+    def highlight(self, textbox, mark, lang, code, alive=None, done=None):
+        """为 mark 处的代码块加上高亮
+
+        alive() 返回 False 时（代码块已从文本框删除）放弃剩余的标签；
+        done() 在完成或放弃后调用一次，调用方在这里释放 mark。
+        """
+        self.request(lang, code, lambda spans: self.apply(textbox, mark, spans, alive, done))
+
+    def apply(self, textbox, mark, spans, alive=None, done=None):
+        """把 lex_spans 的结果排队，按帧分批添加到 mark 开始的代码块上"""
+        if not spans or (alive is not None and not alive()):
+            if done is not None:
+                done()
+            return
+        self._jobs.append([textbox, mark, self._flatten(textbox, spans), 0, alive, done])
+        self._schedule()
+
+    def request(self, lang, code, callback):
+        """取得代码的高亮区间；callback(spans) 在 Tk 线程中调用，已缓存时立即同步回调"""
+        key = self.make_key(lang, code)
+        with self._lock:
+            if key in self._spans:
+                self._spans.move_to_end(key)
+                spans = self._spans[key]
+                self.counters["memory_hits"] += 1
+            else:
+                waiters = self._pending.get(key)
+                if waiters is not None:
+                    waiters.append(callback)
+                    return
+                self._pending[key] = [callback]
+                spans = False
+        if spans is not False:
+            metrics.inc("highlight_requests_total", source="memory")
+            callback(spans)
+            return
+        self._submit(key, lang, code)
+
+    def utf16(self):
+        """Tk 的列号是否按 UTF-16 单元计算（Tk 8.6 是，Tk 9 按字符计算）"""
+        if self._utf16 is None:
+            try:
+                self._utf16 = self.root.tk.call("string", "length", "\U0001f600") == 2
+            except Exception:
+                self._utf16 = False
+        return self._utf16
+
+    def _submit(self, key, lang, code):
+        started = time.perf_counter()
+        utf16 = self.utf16()
+        try:
+            if self._process_pool is None:
+                # spawn 方式不会复制 Tk 和后台线程的状态，在各平台上行为一致
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            future = self._process_pool.submit(lex_spans, lang, code, STYLE, utf16)
+        except (BrokenProcessPool, RuntimeError):
+            # 工作进程不可用时退回到后台线程
+            self._process_pool = None
+            future = self._fallback_pool().submit(lex_spans, lang, code, STYLE, utf16)
+        future.add_done_callback(lambda future: self._finished(key, lang, code, utf16, future, started))
+
+    def _fallback_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="highlight")
+        return self._thread_pool
+
+    def _finished(self, key, lang, code, utf16, future, started):
+        try:
+            spans = future.result()
+        except BrokenProcessPool:
+            self._process_pool = None
+            future = self._fallback_pool().submit(lex_spans, lang, code, STYLE, utf16)
+            future.add_done_callback(lambda future: self._finished(key, lang, code, utf16, future, started))
+            return
+        except Exception:
+            spans = None
+
+        if spans is None:
+            self.counters["failed"] += 1
+            metrics.inc("highlight_requests_total", source="failed")
+        else:
+            self.counters["lexed"] += 1
+            metrics.inc("highlight_requests_total", source="lexed")
+            metrics.observe("highlight_lex_seconds", time.perf_counter() - started)
+        # 不认识的语言也缓存，下次不再提交
+        with self._lock:
+            self._spans[key] = spans
+            self._spans.move_to_end(key)
+            while len(self._spans) > self.memory_entries:
+                self._spans.popitem(last=False)
+        try:
+            self.root.after(0, lambda: self._deliver(key, spans))
+        except RuntimeError:
+            pass  # 主循环已结束
+
+    def _deliver(self, key, spans):
+        with self._lock:
+            callbacks = self._pending.pop(key, [])
+        for callback in callbacks:
+            callback(spans)
+
+    def _flatten(self, textbox, spans):
+        """{颜色: 区间} -> [(标签, 区间数组, 下标)]，并确保标签已配置"""
+        configured = self._configured.setdefault(textbox, set())
+        ranges = []
+        for color, values in spans.items():
+            tag = TAG_PREFIX + color
+            if tag not in configured:
+                textbox.tag_config(tag, foreground=f"#{color}")
+                configured.add(tag)
+            ranges.extend((tag, values, offset) for offset in range(0, len(values), 4))
+        return ranges
+
+    def _schedule(self):
+        if self._job is None:
+            self._job = self.root.after(self.FRAME_MS, self._frame)
+
+    def _frame(self):
+        self._job = None
+        started = time.perf_counter()
+        deadline = started + self.frame_budget
+        while self._jobs and time.perf_counter() < deadline:
+            job = self._jobs[0]
+            textbox, mark, ranges, position, alive, done = job
+            if alive is not None and not alive():
+                self._jobs.popleft()
+                if done is not None:
+                    done()
+                continue
+            # 每批重新读取标记位置：上方的消息被删除或插入时行号会变化
+            base_line, base_column = map(int, textbox.index(mark).split("."))
+            end = min(len(ranges), position + self.BATCH)
+            for tag, values, offset in ranges[position:end]:
+                start_line, start_column, end_line, end_column = values[offset:offset + 4]
+                if start_line == 0:
+                    start_column += base_column
+                if end_line == 0:
+                    end_column += base_column
+                textbox.tag_add(
+                    tag, f"{base_line + start_line}.{start_column}", f"{base_line + end_line}.{end_column}"
+                )
+            job[3] = end
+            if end == len(ranges):
+                self._jobs.popleft()
+                if done is not None:
+                    done()
+        metrics.observe("highlight_frame_seconds", time.perf_counter() - started)
+        if self._jobs:
+            self._schedule()
+
+    def close(self):
+        if self._job is not None:
+            try:
+                self.root.after_cancel(self._job)
+            except Exception:
+                pass
+            self._job = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
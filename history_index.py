@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL DEFAULT '',
+    model TEXT,
+    started TEXT,
+    updated TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    role TEXT,
+    model TEXT,
+    ts TEXT,
+    PRIMARY KEY (conversation_id, seq)
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    terms,
+    conversation_id UNINDEXED,
+    seq UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+# 索引格式版本，变化时重建索引
+SCHEMA_VERSION = 2
+
+TITLE_LENGTH = 40
+SNIPPET_RADIUS = 40
+# 只对最近的这么多条命中计算相关度，保证常见词的查询也能在毫秒级返回
+RANK_CANDIDATES = 2000
+
+# 中日韩文字的连续片段，或不含中日韩文字的单词
+CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+CJK_PATTERN = re.compile(f"[{CJK_RANGES}]+")
+TOKEN_PATTERN = re.compile(f"[{CJK_RANGES}]+|[^\\W_{CJK_RANGES}]+")
+
+
+def search_terms(text, query=False):
+    """把中英混合文本切分为检索词：英文按单词，中文按相邻两字（bigram）
+
+    中文没有空格分词，用 bigram 可以在不依赖分词词典的情况下匹配任意词语。
+    建索引时每段中文的最后一个字另外作为单字词，这样单字查询（按前缀匹配）也能命中它。
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if CJK_PATTERN.fullmatch(token) and len(token) > 1:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+            if not query:
+                terms.append(token[-1])
+        else:
+            terms.append(token)
+    return terms
+
+
+def build_match_query(query):
+    """把用户输入转为 FTS5 查询：所有词都要出现，最后一个词按前缀匹配（边输入边搜）"""
+    words = TOKEN_PATTERN.findall(query.lower())
+    if not words:
+        return None
+    clauses = []
+    for position, word in enumerate(words):
+        is_last = position == len(words) - 1
+        for term in search_terms(word, query=True):
+            if len(term) == 1 and CJK_PATTERN.fullmatch(term):
+                clauses.append(f'"{term}"*')  # 单个汉字：匹配以它开头的 bigram
+            elif is_last and not CJK_PATTERN.fullmatch(term):
+                clauses.append(f'"{term}"*')
+            else:
+                clauses.append(f'"{term}"')
+    return " AND ".join(clauses)
+
+
+def make_snippet(content, query):
+    """截取命中位置附近的片段，返回 (片段, 命中区间列表)"""
+    words = TOKEN_PATTERN.findall(query.lower())
+    lowered = content.lower()
+    hits = []
+    for word in words:
+        start = lowered.find(word)
+        while start != -1:
+            hits.append((start, start + len(word)))
+            start = lowered.find(word, start + len(word))
+    hits.sort()
+
+    center = hits[0][0] if hits else 0
+    begin = max(0, center - SNIPPET_RADIUS)
+    end = min(len(content), center + SNIPPET_RADIUS * 2)
+    snippet = content[begin:end].replace("\n", " ")
+    prefix = "..." if begin > 0 else ""
+    suffix = "..." if end < len(content) else ""
+    spans = [
+        (s - begin + len(prefix), min(e, end) - begin + len(prefix))
+        for s, e in hits if s >= begin and s < end
+    ]
+    return prefix + snippet + suffix, spans
+
+
+def read_entries(path, start, end=None):
+    """读取日志 [start, end) 中的完整行，返回 ((offset, length, record) 列表, 读到的位置)"""
+    entries = []
+    offset = start
+    with open(path, "rb") as f:
+        f.seek(start)
+        for line in f:
+            if not line.endswith(b"\n") or (end is not None and offset + len(line) > end):
+                break  # 写了一半的行，等下次再补
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if record is not None:
+                entries.append((offset, len(line), record))
+            offset += len(line)
+    return entries, offset
+
+
+class HistoryIndex:
+    """会话索引：记录每个会话的标题、模型、时间范围以及每条消息在日志中的字节偏移
+
+    索引保存在 SQLite 中，每个线程使用自己的连接（WAL 模式允许边写边读）。
+    """
+
+    def __init__(self, history_dir, filename="index.db"):
+        self.history_dir = history_dir
+        self.path = os.path.join(history_dir, filename)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._setup(self.connection())
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _setup(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # 旧格式的索引直接丢弃，启动时的 sync 会从日志重建
+            conn.executescript(
+                "DROP TABLE IF EXISTS messages_fts;"
+                "DROP TABLE IF EXISTS messages;"
+                "DROP TABLE IF EXISTS conversations;"
+            )
+        conn.executescript(SCHEMA)
+        try:
+            conn.executescript(FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            # 当前 SQLite 未编译 FTS5，搜索不可用但索引仍可使用
+            self.has_fts = False
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+    def add_records(self, conversation_id, entries, size):
+        """登记新追加的记录
+
+        entries 是 (offset, length, record) 列表，size 是写入后日志文件的大小。
+        """
+        if not entries:
+            return
+        with self._write_lock:
+            start = self.indexed_size(conversation_id)
+            if size <= start:
+                return  # sync 已经读到了这些记录
+            if entries[0][0] != start:
+                # 与已索引部分不衔接（如首次建索引时 sync 还没读到这个会话），从日志补读
+                entries, size = read_entries(self.log_path(conversation_id), start, size)
+            self._add_records(conversation_id, entries, size)
+
+    def _add_records(self, conversation_id, entries, size):
+        if not entries:
+            return
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT title, model, started, message_count FROM conversations WHERE id = ?",
+            (conversation_id,)
+        ).fetchone()
+        title, model, started, count = row if row else ("", None, None, 0)
+
+        rows = []
+        fts_rows = []
+        for offset, length, record in entries:
+            if not title and record.get("role") == "user":
+                title = " ".join(record.get("content", "").split())[:TITLE_LENGTH]
+            if record.get("model"):
+                model = record["model"]
+            started = started or record.get("ts")
+            rows.append((
+                conversation_id, count, offset, length,
+                record.get("role"), record.get("model"), record.get("ts")
+            ))
+            fts_rows.append((" ".join(search_terms(record.get("content", ""))), conversation_id, count))
+            count += 1
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        if self.has_fts:
+            conn.executemany(
+                "INSERT INTO messages_fts (terms, conversation_id, seq) VALUES (?, ?, ?)", fts_rows
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (conversation_id, title, model, started, entries[-1][2].get("ts"), count, size)
+        )
+        conn.commit()
+
+    def indexed_size(self, conversation_id):
+        row = self.connection().execute(
+            "SELECT size FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return row["size"] if row else 0
+
+    def log_path(self, conversation_id):
+        return os.path.join(self.history_dir, f"{conversation_id}.jsonl")
+
+    def sync(self, conversation_ids):
+        """把索引之外新增的日志内容补录进索引，只扫描每个文件的未索引部分"""
+        for conversation_id in conversation_ids:
+            path = self.log_path(conversation_id)
+            # 与 add_records 串行：写入线程同时登记新记录时不会重复或遗漏
+            with self._write_lock:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                start = self.indexed_size(conversation_id)
+                if size == start:
+                    continue
+                if size < start:
+                    # 文件被压缩或替换过，整体重建
+                    self._remove(conversation_id)
+                    start = 0
+                entries, end = read_entries(path, start)
+                self._add_records(conversation_id, entries, end)
+
+    def remove(self, conversation_id):
+        with self._write_lock:
+            self._remove(conversation_id)
+
+    def _remove(self, conversation_id):
+        conn = self.connection()
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        if self.has_fts:
+            conn.execute("DELETE FROM messages_fts WHERE conversation_id = ?", (conversation_id,))
+        conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        conn.commit()
+
+    def recent_conversations(self, limit=50, offset=0):
+        """按最后更新时间倒序分页列出会话"""
+        return [dict(row) for row in self.connection().execute(
+            "SELECT * FROM conversations ORDER BY updated DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        )]
+
+    def get_conversation(self, conversation_id):
+        row = self.connection().execute(
+            "SELECT * FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def read_page(self, conversation_id, page, page_size=20):
+        """按字节偏移读取会话的一页消息，不读取文件其余部分"""
+        rows = self.connection().execute(
+            "SELECT offset, length FROM messages WHERE conversation_id = ? "
+            "ORDER BY seq LIMIT ? OFFSET ?",
+            (conversation_id, page_size, page * page_size)
+        ).fetchall()
+        if not rows:
+            return []
+
+        path = self.log_path(conversation_id)
+        records = []
+        with open(path, "rb") as f:
+            # 同一页的记录在文件中是连续的，一次读出
+            start = rows[0]["offset"]
+            end = rows[-1]["offset"] + rows[-1]["length"]
+            f.seek(start)
+            data = f.read(end - start)
+        for row in rows:
+            line = data[row["offset"] - start:row["offset"] - start + row["length"]]
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+    def search(self, query, limit=20):
+        """全文检索，按 BM25 相关度排序，返回带高亮区间的片段"""
+        match_query = build_match_query(query)
+        if not self.has_fts or not match_query:
+            return []
+        conn = self.connection()
+        # 先按 rowid 倒序取最近的候选（FTS5 可直接按 rowid 顺序遍历），再在候选范围内按 BM25 排序
+        row = conn.execute(
+            "SELECT min(rowid) FROM (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? "
+            "ORDER BY rowid DESC LIMIT ?)",
+            (match_query, RANK_CANDIDATES)
+        ).fetchone()
+        if row[0] is None:
+            return []
+        hits = conn.execute(
+            "SELECT f.conversation_id, f.seq, f.score, "
+            "m.offset, m.length, m.role, m.model, m.ts, c.title "
+            "FROM (SELECT conversation_id, seq, bm25(messages_fts) AS score FROM messages_fts "
+            "      WHERE messages_fts MATCH ? AND rowid >= ? ORDER BY score LIMIT ?) AS f "
+            "JOIN messages AS m ON m.conversation_id = f.conversation_id AND m.seq = f.seq "
+            "LEFT JOIN conversations AS c ON c.id = f.conversation_id "
+            "ORDER BY f.score",
+            (match_query, row[0], limit)
+        ).fetchall()
+
+        results = []
+        for hit in hits:
+            record = self.read_record(hit["conversation_id"], hit["offset"], hit["length"])
+            if record is None:
+                continue
+            snippet, spans = make_snippet(record.get("content", ""), query)
+            results.append({
+                "conversation_id": hit["conversation_id"],
+                "seq": hit["seq"],
+                "score": -hit["score"],
+                "role": hit["role"],
+                "model": hit["model"],
+                "ts": hit["ts"],
+                "title": hit["title"],
+                "snippet": snippet,
+                "spans": spans,
+            })
+        return results
+
+    def read_record(self, conversation_id, offset, length):
+        path = self.log_path(conversation_id)
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                return json.loads(f.read(length))
+        except (OSError, ValueError):
+            return None
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
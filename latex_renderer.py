@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import metrics
+
+THEME_COLORS = {
+    "dark": "#E6E6E6",
+    "light": "#1A1A1A",
+}
+
+
+def strip_delimiters(latex_code):
+    """去掉公式的定界符，返回 (公式内容, 是否为独立公式)"""
+    for opening, closing, display in (("$$", "$$", True), ("\\[", "\\]", True),
+                                      ("\\(", "\\)", False), ("$", "$", False)):
+        if latex_code.startswith(opening) and latex_code.endswith(closing) and len(latex_code) >= len(opening) + len(closing):
+            return latex_code[len(opening):-len(closing)].strip(), display
+    return latex_code.strip(), False
+
+
+def rasterize_latex(expression, display, theme, dpi):
+    """把公式渲染为透明背景的 PNG（在工作进程中执行）"""
+    from matplotlib import mathtext
+    from matplotlib.font_manager import FontProperties
+
+    buffer = io.BytesIO()
+    mathtext.math_to_image(
+        f"${expression}$",
+        buffer,
+        prop=FontProperties(size=16 if display else 14),
+        dpi=dpi,
+        format="png",
+        color=THEME_COLORS.get(theme, THEME_COLORS["dark"])
+    )
+    return buffer.getvalue()
+
+
+class LatexRenderer:
+    """带缓存的公式渲染器
+
+    - 键为 (公式, 独立/行内, 主题, DPI)
+    - 内存中按 LRU 保存 PNG 数据；PhotoImage 按引用计数保存，不再显示的才会被淘汰
+    - 磁盘缓存位于 cache_dir，重启后仍可直接使用
+    - 光栅化在单独的工作进程中完成，Tk 线程只负责把生成好的图片嵌入文本框
+    """
+
+    def __init__(self, root, cache_dir=os.path.join("cache", "latex"), memory_entries=512,
+                 idle_images=128, workers=1):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.memory_entries = memory_entries
+        self.idle_images = idle_images
+        self.workers = workers
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._png = OrderedDict()  # 键 -> PNG 数据
+        self._photos = {}  # 键 -> PhotoImage
+        self._refcounts = {}  # 键 -> 正在显示的次数
+        self._idle = OrderedDict()  # 未在显示中的 PhotoImage，按 LRU 淘汰
+        self._pending = {}  # 键 -> 等待结果的回调列表
+        self._lock = threading.Lock()
+        self._process_pool = None
+        self._io_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="latex-io")
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "rendered": 0, "failed": 0}
+
+    @staticmethod
+    def make_key(expression, display, theme, dpi):
+        raw = f"{expression}\0{int(display)}\0{theme}\0{int(dpi)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def request(self, expression, display, theme, dpi, callback):
+        """请求一个公式图片；callback(key, photo) 在 Tk 线程中调用，失败时 photo 为 None
+
+        内存中已有图片时立即同步回调。
+        """
+        key = self.make_key(expression, display, theme, dpi)
+        photo = self._photos.get(key)
+        if photo is None:
+            with self._lock:
+                png = self._png.get(key)
+                if png is not None:
+                    self._png.move_to_end(key)
+            if png is not None:
+                photo = self._make_photo(key, png)
+        if photo is not None:
+            self.counters["memory_hits"] += 1
+            metrics.inc("latex_requests_total", source="memory")
+            self._acquire(key)
+            callback(key, photo)
+            return key
+
+        # 同一公式同时被请求多次时只渲染一次
+        with self._lock:
+            waiters = self._pending.get(key)
+            if waiters is not None:
+                waiters.append(callback)
+                return key
+            self._pending[key] = [callback]
+        self._io_pool.submit(self._load, key, expression, display, theme, dpi)
+        return key
+
+    def release(self, key):
+        """图片不再显示时调用，引用计数归零后进入可淘汰队列"""
+        count = self._refcounts.get(key, 0) - 1
+        if count > 0:
+            self._refcounts[key] = count
+            return
+        self._refcounts.pop(key, None)
+        if key in self._photos:
+            self._idle[key] = True
+            self._idle.move_to_end(key)
+            while len(self._idle) > self.idle_images:
+                old_key, _ = self._idle.popitem(last=False)
+                self._photos.pop(old_key, None)
+
+    def _acquire(self, key):
+        self._refcounts[key] = self._refcounts.get(key, 0) + 1
+        self._idle.pop(key, None)
+
+    def _make_photo(self, key, png):
+        import tkinter as tk
+        photo = tk.PhotoImage(master=self.root, data=png)
+        self._photos[key] = photo
+        return photo
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def _load(self, key, expression, display, theme, dpi):
+        # 在 IO 线程中执行：先查磁盘，没有再交给工作进程渲染
+        png = None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                png = f.read()
+            self.counters["disk_hits"] += 1
+            metrics.inc("latex_requests_total", source="disk")
+        except OSError:
+            pass
+
+        if png is None:
+            try:
+                with metrics.timer("latex_render_seconds"):
+                    png = self._rasterize(expression, display, theme, dpi)
+                self.counters["rendered"] += 1
+                metrics.inc("latex_requests_total", source="rendered")
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(png)
+                os.replace(tmp_path, path)
+            except Exception:
+                png = None
+                self.counters["failed"] += 1
+                metrics.inc("latex_requests_total", source="failed")
+
+        if png is not None:
+            with self._lock:
+                self._png[key] = png
+                self._png.move_to_end(key)
+                while len(self._png) > self.memory_entries:
+                    self._png.popitem(last=False)
+
+        try:
+            self.root.after(0, lambda: self._deliver(key, png))
+        except RuntimeError:
+            pass  # 主循环已结束
+
+    def _rasterize(self, expression, display, theme, dpi):
+        if self._process_pool is None:
+            # spawn 方式不会复制 Tk 和后台线程的状态，在各平台上行为一致
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        try:
+            return self._process_pool.submit(rasterize_latex, expression, display, theme, dpi).result()
+        except BrokenProcessPool:
+            # 工作进程不可用时退回到当前线程渲染
+            self._process_pool = None
+            return rasterize_latex(expression, display, theme, dpi)
+
+    def _deliver(self, key, png):
+        with self._lock:
+            callbacks = self._pending.pop(key, [])
+        photo = None
+        if png is not None:
+            try:
+                photo = self._photos.get(key) or self._make_photo(key, png)
+            except Exception:
+                photo = None
+        for callback in callbacks:
+            if photo is not None:
+                self._acquire(key)
+            callback(key, photo)
+
+    def close(self):
+        self._io_pool.shutdown(wait=False, cancel_futures=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
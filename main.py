@@ -1,24 +1,325 @@
 # -*- coding: utf-8 -*-
 
+from startup_profiler import profiler
 import tkinter as tk
-from tkinter import ttk, scrolledtext
 import json
 import threading
-from datetime import datetime
+import asyncio
+import multiprocessing
+import time
 import customtkinter as ctk
-from ai_clients import DeepseekClient, OpenAIClient, ClaudeClient
+profiler.mark("import tkinter")
+from ai_clients import PROVIDERS
+from chat_store import ChatStore
+from history_index import HistoryIndex
+from typewriter import Typewriter
+from transport import HttpTransport
+from async_core import AsyncRunner
+from conversation import Conversation
+from response_cache import ResponseCache
+from resilience import ProviderGuard
+from router import AUTO_MODEL, Router
+from request_queue import RequestQueue
+from latex_renderer import LatexRenderer, strip_delimiters
+from highlighter import SyntaxHighlighter
+from markdown_stream import MarkdownTokenizer, tokenize
+from transcript import TranscriptView
+from session_snapshot import SessionSnapshot
+from attachments import DEFAULT_CHUNK_TOKENS, DEFAULT_CONCURRENCY, AttachmentQuery, ChunkIndex, plan_chunks
+from metrics import FrameMonitor, format_snapshot, metrics
 import os
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import re
-import time
-import markdown
-from markdown.extensions.fenced_code import FencedCodeExtension
-from markdown.extensions.tables import TableExtension
-from markdown.extensions.nl2br import Nl2BrExtension
-from PIL import Image
+import sqlite3
+profiler.mark("import app modules")
+
+class StatsWindow:
+    """性能统计窗口：每秒刷新一次各项延迟的分位数和计数器，可导出到文件"""
+    
+    REFRESH_MS = 1000
+    
+    def __init__(self, app):
+        self.app = app
+        self.texts = app.translations[app.current_language]
+        
+        self.window = ctk.CTkToplevel(app.root)
+        self.window.title(self.texts["stats"])
+        self.window.geometry("760x520")
+        self.window.lift()
+        
+        buttons = ctk.CTkFrame(self.window, fg_color="transparent")
+        buttons.pack(fill="x", padx=10, pady=(10, 0))
+        ctk.CTkButton(buttons, text=self.texts["export_metrics"], command=self.export, width=90).pack(side="left")
+        ctk.CTkButton(buttons, text=self.texts["reset_metrics"], command=self.reset, width=90).pack(side="left", padx=10)
+        self.status_label = ctk.CTkLabel(buttons, text="", font=("Helvetica", 12), text_color="gray60")
+        self.status_label.pack(side="left")
+        
+        self.textbox = ctk.CTkTextbox(self.window, wrap="none", font=("Courier", 13))
+        self.textbox.pack(fill="both", expand=True, padx=10, pady=10)
+        self.refresh()
+        
+    def refresh(self):
+        if not self.window.winfo_exists():
+            return
+        self.render()
+        self.window.after(self.REFRESH_MS, self.refresh)
+        
+    def render(self):
+        top, _ = self.textbox.yview()
+        self.textbox.configure(state="normal")
+        self.textbox.delete("1.0", "end")
+        self.textbox.insert("end", format_snapshot(metrics.snapshot()))
+        self.textbox.configure(state="disabled")
+        self.textbox.yview_moveto(top)
+        
+    def export(self):
+        path = self.app.metrics_path()
+        try:
+            metrics.export(path)
+            self.status_label.configure(text=self.texts["metrics_exported"].format(path=path))
+        except OSError as e:
+            self.status_label.configure(text=str(e))
+        
+    def reset(self):
+        metrics.reset()
+        self.render()
+
+
+class HistoryWindow:
+    """历史记录窗口：会话列表来自索引，消息按页在后台线程读取，滚动到底部时加载下一页"""
+    
+    LIST_PAGE_SIZE = 50
+    MESSAGE_PAGE_SIZE = 20
+    
+    def __init__(self, app):
+        self.app = app
+        self.index = app.history_index
+        self.texts = app.translations[app.current_language]
+        
+        self.window = ctk.CTkToplevel(app.root)
+        self.window.title(self.texts["history"])
+        self.window.geometry("1000x600")
+        self.window.lift()  # 将窗口提升到最上层
+        self.window.focus_force()  # 强制获取焦点
+        self.window.grab_set()  # 模态窗口，阻止与其他窗口的交互
+        
+        # 顶部搜索框，输入停顿后在后台检索
+        self.search_entry = ctk.CTkEntry(
+            self.window,
+            placeholder_text=self.texts["search_placeholder"],
+            font=("Helvetica", 14),
+            height=36
+        )
+        self.search_entry.pack(fill="x", padx=10, pady=(10, 0))
+        self.search_entry.bind("<KeyRelease>", lambda event: self.schedule_search())
+        self.search_entry.bind("<Return>", lambda event: self.run_search())
+        self.search_job = None
+        
+        # 左侧会话列表
+        self.list_frame = ctk.CTkScrollableFrame(self.window, width=280)
+        self.list_frame.pack(side="left", fill="y", padx=(10, 0), pady=10)
+        self.more_button = None
+        self.listed = 0
+        
+        # 右侧消息内容
+        self.history_text = ctk.CTkTextbox(
+            self.window,
+            wrap="word",
+            font=("Helvetica", 14)
+        )
+        self.history_text.pack(side="left", fill="both", expand=True, padx=10, pady=10)
+        self.history_text.configure(state="disabled")  # 设为只读
+        self.history_text.tag_config("search_match", background="#8a6d1a")
+        self.history_text.tag_config("search_title", foreground="#3B82F6")
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>", "<KeyRelease>"):
+            self.history_text.bind(sequence, lambda event: self.window.after(50, self.maybe_load_more), add="+")
+        
+        # 当前会话的分页状态；generation 用来丢弃切换会话后才返回的旧页
+        self.conversation_id = None
+        self.next_page = 0
+        self.loading = False
+        self.exhausted = True
+        self.generation = 0
+        
+        self.load_conversation_list()
+        
+    def run_in_background(self, work, callback, on_error=None):
+        """在后台线程执行 work()，结果交给 callback；出错时交给 on_error（默认显示在右侧文本框）"""
+        def worker():
+            try:
+                result = work()
+            except Exception as e:
+                # 日志被移动或压缩、数据库出错等：回到 Tk 线程提示，不让窗口一直等待
+                deliver = lambda error=e: (on_error or self.show_error)(error)
+            else:
+                deliver = lambda: callback(result)
+            try:
+                self.window.after(0, deliver)
+            except (RuntimeError, tk.TclError):
+                pass  # 窗口已关闭
+        threading.Thread(target=worker, daemon=True).start()
+        
+    def show_error(self, error):
+        if not self.window.winfo_exists():
+            return
+        self.history_text.configure(state="normal")
+        self.history_text.insert("end", self.texts["history_load_failed"].format(error=error) + "\n\n")
+        self.history_text.configure(state="disabled")
+        
+    def load_conversation_list(self):
+        offset = self.listed
+        self.run_in_background(
+            lambda: self.index.recent_conversations(self.LIST_PAGE_SIZE, offset),
+            self.show_conversation_list
+        )
+        
+    def show_conversation_list(self, conversations):
+        if not self.window.winfo_exists():
+            return
+        if self.more_button is not None:
+            self.more_button.destroy()
+            self.more_button = None
+        
+        if not conversations and self.listed == 0:
+            ctk.CTkLabel(self.list_frame, text=self.texts["no_history"]).pack(pady=10)
+            return
+        
+        for conversation in conversations:
+            started = (conversation["started"] or "").replace("T", " ")[:16]
+            title = conversation["title"] or conversation["id"]
+            ctk.CTkButton(
+                self.list_frame,
+                text=f"{started}\n{title}",
+                anchor="w",
+                fg_color="transparent",
+                border_width=1,
+                command=lambda cid=conversation["id"]: self.open_conversation(cid)
+            ).pack(fill="x", pady=2)
+        self.listed += len(conversations)
+        
+        if len(conversations) == self.LIST_PAGE_SIZE:
+            self.more_button = ctk.CTkButton(
+                self.list_frame,
+                text=self.texts["load_more"],
+                command=self.load_conversation_list
+            )
+            self.more_button.pack(fill="x", pady=5)
+            
+    def schedule_search(self):
+        if self.search_job is not None:
+            self.window.after_cancel(self.search_job)
+        self.search_job = self.window.after(250, self.run_search)
+        
+    def run_search(self):
+        self.search_job = None
+        query = self.search_entry.get().strip()
+        if not query:
+            return
+        # 搜索结果占用右侧文本框，旧的分页请求作废
+        self.generation += 1
+        self.exhausted = True
+        generation = self.generation
+        self.run_in_background(
+            lambda: self.index.search(query),
+            lambda results: self.show_search_results(generation, results)
+        )
+        
+    def show_search_results(self, generation, results):
+        if generation != self.generation or not self.window.winfo_exists():
+            return
+        self.history_text.configure(state="normal")
+        self.history_text.delete("1.0", "end")
+        if not results:
+            self.history_text.insert("end", self.texts["no_results"])
+        for number, result in enumerate(results):
+            tag = f"search_result_{number}"
+            timestamp = (result["ts"] or "").replace("T", " ")[:16]
+            sender = result["model"] or result["role"]
+            self.history_text.insert("end", f"{timestamp}  {result['title'] or result['conversation_id']}\n", ("search_title", tag))
+            self.history_text.insert("end", f"{sender}: ", (tag,))
+            
+            # 按命中区间插入片段，命中部分高亮
+            snippet = result["snippet"]
+            position = 0
+            for start, end in result["spans"]:
+                if start < position:
+                    continue
+                self.history_text.insert("end", snippet[position:start], (tag,))
+                self.history_text.insert("end", snippet[start:end], ("search_match", tag))
+                position = end
+            self.history_text.insert("end", snippet[position:] + "\n\n", (tag,))
+            
+            # 点击结果跳到所在会话的那一页
+            page = result["seq"] // self.MESSAGE_PAGE_SIZE
+            self.history_text.tag_bind(
+                tag, "<Button-1>",
+                lambda event, cid=result["conversation_id"], page=page: self.open_conversation(cid, page)
+            )
+        self.history_text.configure(state="disabled")
+        
+    def open_conversation(self, conversation_id, start_page=0):
+        self.generation += 1
+        self.conversation_id = conversation_id
+        self.next_page = start_page
+        self.loading = False
+        self.exhausted = False
+        
+        self.history_text.configure(state="normal")
+        self.history_text.delete("1.0", "end")
+        self.history_text.configure(state="disabled")
+        self.load_next_page()
+        
+    def load_next_page(self):
+        if self.loading or self.exhausted:
+            return
+        self.loading = True
+        generation = self.generation
+        conversation_id = self.conversation_id
+        page = self.next_page
+        self.run_in_background(
+            lambda: self.index.read_page(conversation_id, page, self.MESSAGE_PAGE_SIZE),
+            lambda records: self.render_page(generation, records),
+            lambda error: self.page_failed(generation, error)
+        )
+        
+    def page_failed(self, generation, error):
+        if generation != self.generation:
+            return
+        # 不再自动加载后续页，重新打开会话时再试
+        self.loading = False
+        self.exhausted = True
+        self.show_error(error)
+        
+    def render_page(self, generation, records):
+        if generation != self.generation or not self.window.winfo_exists():
+            return
+        self.loading = False
+        self.next_page += 1
+        if len(records) < self.MESSAGE_PAGE_SIZE:
+            self.exhausted = True
+        
+        self.history_text.configure(state="normal")
+        for record in records:
+            sender = record.get("model") or record.get("role", "")
+            timestamp = (record.get("ts") or "")[-8:]
+            self.history_text.insert("end", f"[{timestamp}] {sender}: {record.get('content', '')}\n\n")
+        self.history_text.configure(state="disabled")
+        
+        # 内容还没填满窗口时继续加载
+        self.window.after(50, self.maybe_load_more)
+        
+    def maybe_load_more(self):
+        if not self.window.winfo_exists():
+            return
+        if self.history_text.yview()[1] >= 0.9:
+            self.load_next_page()
+
 
 class AIChatApp:
+    # 对比模式下同时请求的模型
+    COMPARE_MODELS = ["DeepSeek", "OpenAI", "Claude"]
+    # 输入时推荐的相关历史会话个数和最低相似度
+    RELATED_LIMIT = 3
+    RELATED_MIN_SCORE = 0.05
+    
     def __init__(self, root):
         self.root = root
         self.root.title("AI 聊天助手")
@@ -48,19 +349,44 @@ class AIChatApp:
                 "text": "Claude",
                 "color": "#FF7F50",
                 "font": ("Helvetica", 40, "bold")
+            },
+            AUTO_MODEL: {
+                "text": "Auto",
+                "color": "#A855F7",
+                "font": ("Helvetica", 40, "bold")
             }
         }
         
         # 初始化历史记录
         self.history_dir = "chat_history"
         os.makedirs(self.history_dir, exist_ok=True)
+        self.history_index = HistoryIndex(self.history_dir)
+        self.chat_store = ChatStore(self.history_dir, index=self.history_index, on_error=self.report_storage_error)
+        
+        # 上次打开的会话从二进制快照恢复，没有快照时开始新会话
+        self.session = SessionSnapshot(os.path.join(self.history_dir, "session.snap"), on_error=self.report_storage_error)
+        restored = self.session.load()
+        if restored is not None:
+            self.conversation_id = restored.conversation_id
+        else:
+            self.conversation_id = self.chat_store.new_conversation()
+            self.session.start(self.conversation_id)
+        
+        # 多轮对话上下文，发送时按各模型的 token 预算裁剪
+        self.conversation = Conversation()
+        self.chat_generation = 0  # 每次开始新对话加一
+        self.attachments = []  # 随下一个问题发送的文件和目录
+        self.chunk_index = None  # 附件分段缓存，第一次使用时打开
+        if restored is not None:
+            for role, content, model in restored.context:
+                self.conversation.add(role, content, model)
         
-        # 初始化 Markdown 转换器
-        self.md = markdown.Markdown(extensions=[
-            FencedCodeExtension(),
-            TableExtension(),
-            Nl2BrExtension()
-        ])
+        # 在后台把旧版本写入、尚未建立索引的会话补录进索引，然后加载相关对话索引
+        self.related = None
+        self.related_text = ""
+        threading.Thread(target=self.sync_indexes, daemon=True).start()
+        
+        profiler.mark("history store")
         
         # 添加语言设置
         self.translations = {
@@ -80,7 +406,32 @@ class AIChatApp:
                 "watermark": "Created by Travisma2233",
                 "deepseek_key": "DeepSeek API 密钥",
                 "openai_key": "OpenAI API 密钥",
-                "claude_key": "Claude API 密钥"
+                "claude_key": "Claude API 密钥",
+                "load_more": "加载更多...",
+                "no_history": "暂无历史记录",
+                "search_placeholder": "搜索聊天记录...",
+                "no_results": "没有找到匹配的记录",
+                "history_load_failed": "读取聊天记录失败：{error}",
+                "compare": "对比模式",
+                "compare_total": "总耗时",
+                "bypass_cache": "跳过缓存",
+                "cache_stats": "缓存命中 {hits} / 未命中 {misses}（命中率 {rate:.0%}）",
+                "stats": "性能统计",
+                "export_metrics": "导出",
+                "reset_metrics": "清零",
+                "metrics_exported": "已导出到 {path}",
+                "stop": "停止",
+                "queued": "排队中",
+                "new_chat": "新对话",
+                "attach_files": "📎 文件",
+                "attach_folder": "📁 文件夹",
+                "attached": "附件：{names}",
+                "attachment_chunking": "正在读取附件...",
+                "attachment_map": "正在阅读附件 {done}/{total}",
+                "attachment_reduce": "正在合并要点 {done}/{total}",
+                "attachment_skipped": "已跳过 {count} 个非文本或无法读取的文件",
+                "storage_error": "⚠ 聊天记录保存失败：{error}",
+                "related": "相关对话："
             },
             "en": {
                 "title": "AI Chat Assistant",
@@ -98,7 +449,32 @@ class AIChatApp:
                 "watermark": "Created by Travisma2233",
                 "deepseek_key": "DeepSeek API Key",
                 "openai_key": "OpenAI API Key",
-                "claude_key": "Claude API Key"
+                "claude_key": "Claude API Key",
+                "load_more": "Load more...",
+                "no_history": "No history yet",
+                "search_placeholder": "Search chat history...",
+                "no_results": "No matching messages",
+                "history_load_failed": "Failed to load chat history: {error}",
+                "compare": "Compare",
+                "compare_total": "Total time",
+                "bypass_cache": "Bypass cache",
+                "cache_stats": "Cache hits {hits} / misses {misses} ({rate:.0%} hit rate)",
+                "stats": "Stats",
+                "export_metrics": "Export",
+                "reset_metrics": "Reset",
+                "metrics_exported": "Exported to {path}",
+                "stop": "Stop",
+                "queued": "Queued",
+                "new_chat": "New Chat",
+                "attach_files": "📎 Files",
+                "attach_folder": "📁 Folder",
+                "attached": "Attached: {names}",
+                "attachment_chunking": "Reading attachments...",
+                "attachment_map": "Reading attachments {done}/{total}",
+                "attachment_reduce": "Merging notes {done}/{total}",
+                "attachment_skipped": "Skipped {count} non-text or unreadable files",
+                "storage_error": "⚠ Failed to save chat history: {error}",
+                "related": "Related:"
             }
         }
         
@@ -106,18 +482,116 @@ class AIChatApp:
         
         # 配置界面布局
         self.create_widgets()
+        profiler.mark("widgets")
+        
+        if restored is not None:
+            self.restore_session(restored)
+            profiler.mark("restore session")
+        
+        # 所有 AI 请求都在这个后台事件循环中执行
+        self.async_runner = AsyncRunner()
         
         # 初始化 AI 客户端
         self.load_config()
         self.init_ai_clients()
         
+        # 提前与已配置密钥的服务商建立连接
+        self.transport.prewarm([client.endpoint for client in self.ai_clients.values() if client.api_key])
+        profiler.mark("config and AI clients")
+        
+        # 生成回答期间可以继续提问：问题按会话排队，同时执行的请求数有上限
+        self.request_queue = RequestQueue(
+            self.root, self.async_runner, self.start_request,
+            max_concurrency=self.config.get("max_concurrent_requests", 2),
+            on_change=self.update_queue_view
+        )
+        
+        # 服务商 SDK 在第一次使用时才导入；窗口显示后在后台提前加载当前模型的 SDK
+        self.root.after(1000, self.prepare_selected_client)
+        
+        # 关闭窗口前把未落盘的聊天记录写完
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+        # 界面卡顿检测和指标定期导出（config.json 中的 metrics_file）
+        self.frame_monitor = FrameMonitor(self.root, metrics)
+        self.frame_monitor.start()
+        self.schedule_metrics_export()
+        
+    def on_close(self):
+        self.frame_monitor.stop()
+        if self.config.get("metrics_file"):
+            self.export_metrics()
+        self.async_runner.stop()
+        self.chat_store.close()
+        if self.related is not None:
+            self.related.save()
+        self.session.close()
+        if self.chunk_index is not None:
+            self.chunk_index.close()
+        self.latex_renderer.close()
+        self.highlighter.close()
+        self.transport.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        self.root.destroy()
+        
+    def prepare_selected_client(self):
+        selected_model = self.model_var.get()
+        if selected_model == AUTO_MODEL:
+            # 自动模式可能用到排名前两位的服务商（对冲请求）
+            clients = [self.ai_clients[name] for name in self.router.rank()[:2]]
+        else:
+            clients = [self.ai_clients[selected_model]]
+        clients = [client for client in clients if client.api_key]
+        if not clients:
+            return
+        
+        def prepare():
+            for client in clients:
+                try:
+                    client.prepare()
+                except Exception:
+                    pass  # 缺少 SDK 等问题会在真正发送时以错误信息显示
+        threading.Thread(target=prepare, daemon=True).start()
+        
     def init_ai_clients(self):
-        self.ai_clients = {
-            "DeepSeek": DeepseekClient(self.config.get("deepseek_api_key", "")),
-            "OpenAI": OpenAIClient(self.config.get("openai_api_key", "")),
-            "Claude": ClaudeClient(self.config.get("claude_api_key", ""))
+        # 所有客户端共享一个传输层（连接池 + keep-alive），只在启动时创建
+        if not hasattr(self, "transport"):
+            self.transport = HttpTransport(
+                connect_timeout=self.config.get("http_connect_timeout", 5.0),
+                read_timeout=self.config.get("http_read_timeout", 120.0),
+                http2=self.config.get("http2", False)
+            )
+            # 相同问题的回复缓存（内存 + 磁盘），可在设置中关闭
+            self.response_cache = None
+            if self.config.get("response_cache", True):
+                self.response_cache = ResponseCache(
+                    os.path.join("cache", "responses.db"),
+                    ttl=self.config.get("cache_ttl_hours", 168) * 3600,
+                    max_disk_bytes=self.config.get("cache_max_mb", 50) * 1024 * 1024
+                )
+            # 每个服务商共享的限流、重试和熔断状态，客户端重建时保持不变
+            self.provider_guards = {name: ProviderGuard.from_config(name, self.config) for name in PROVIDERS}
+            self.ai_clients = {}
+            self.client_settings = {}
+            # 自动模式按各服务商的延迟和错误率选择，客户端字典原地更新，路由器无需重建
+            self.router = Router(self.ai_clients)
+        
+        # 可选的 *_api_url / *_base_url 配置用于指向代理或本地模拟服务器（mock_server.py）
+        settings = {
+            name: (client_class, self.config.get(key_option, ""), self.config.get(url_option))
+            for name, (client_class, key_option, url_option) in PROVIDERS.items()
         }
         
+        # 只重建设置发生变化的客户端，其余客户端及其连接保持不变
+        for name, (client_class, api_key, url) in settings.items():
+            if self.client_settings.get(name) == (api_key, url):
+                continue
+            self.ai_clients[name] = client_class(api_key, url, transport=self.transport)
+            self.ai_clients[name].cache = self.response_cache
+            self.ai_clients[name].guard = self.provider_guards[name]
+            self.client_settings[name] = (api_key, url)
+        
     def create_widgets(self):
         # 顶部工具栏
         toolbar = ctk.CTkFrame(self.main_frame, fg_color="transparent")
@@ -155,9 +629,11 @@ class AIChatApp:
         )
         theme_button.pack(side="left", padx=5)
         
-        # 设置和历史记录按钮
-        for text, command in [(self.translations[self.current_language]["settings"], self.show_settings), 
-                            (self.translations[self.current_language]["history"], self.show_history)]:
+        # 新对话、设置和历史记录按钮
+        for text, command in [(self.translations[self.current_language]["new_chat"], self.new_chat),
+                            (self.translations[self.current_language]["settings"], self.show_settings), 
+                            (self.translations[self.current_language]["history"], self.show_history),
+                            (self.translations[self.current_language]["stats"], self.show_stats)]:
             ctk.CTkButton(
                 buttons_frame,
                 text=text,
@@ -184,7 +660,7 @@ class AIChatApp:
         models_frame.pack(pady=(0, 20))
         
         self.model_var = ctk.StringVar(value="DeepSeek")
-        for model in ["DeepSeek", "OpenAI", "Claude"]:
+        for model in ["DeepSeek", "OpenAI", "Claude", AUTO_MODEL]:
             ctk.CTkRadioButton(
                 models_frame,
                 text=model,
@@ -196,6 +672,17 @@ class AIChatApp:
                 border_color=self.model_styles[model]["color"]
             ).pack(side="left", padx=20)
         
+        # 对比模式：同时向所有模型发送同一个问题，并排显示回答
+        self.compare_var = ctk.BooleanVar(value=False)
+        self.compare_switch = ctk.CTkSwitch(
+            models_frame,
+            text=self.translations[self.current_language]["compare"],
+            variable=self.compare_var,
+            command=self.toggle_compare_mode,
+            font=("Helvetica", 14)
+        )
+        self.compare_switch.pack(side="left", padx=20)
+        
         # 创建搜索框区域
         search_frame = ctk.CTkFrame(content_frame, fg_color="transparent")
         search_frame.pack(fill="x", padx=100, pady=(0, 30))
@@ -210,6 +697,7 @@ class AIChatApp:
         )
         self.input_box.pack(side="left", fill="x", expand=True, padx=(0, 10))
         self.input_box.bind("<Return>", lambda event: self.send_message())
+        self.input_box.bind("<KeyRelease>", lambda event: self.update_related())
         
         self.send_button = ctk.CTkButton(
             search_frame,
@@ -222,6 +710,79 @@ class AIChatApp:
         )
         self.send_button.pack(side="right")
         
+        # 停止按钮：取消当前会话正在生成的回答
+        self.stop_button = ctk.CTkButton(
+            search_frame,
+            text=self.translations[self.current_language]["stop"],
+            command=self.stop_generation,
+            width=80,
+            height=50,
+            corner_radius=25,
+            font=("Helvetica", 16),
+            fg_color="#B91C1C",
+            hover_color="#991B1B",
+            state="disabled"
+        )
+        self.stop_button.pack(side="right", padx=(0, 10))
+        
+        # 附件按钮：文件和目录随下一个问题一起发送
+        for key, command in (("attach_folder", self.attach_folder), ("attach_files", self.attach_files)):
+            ctk.CTkButton(
+                search_frame,
+                text=self.translations[self.current_language][key],
+                command=command,
+                width=90,
+                height=50,
+                corner_radius=25,
+                font=("Helvetica", 14)
+            ).pack(side="right", padx=(0, 10))
+        
+        # 排队中的问题，可调整顺序或删除；队列为空时隐藏
+        self.queue_frame = ctk.CTkFrame(content_frame, fg_color="transparent")
+        self.queue_anchor = search_frame
+        
+        # 输入时推荐的相关历史会话，点击在历史记录中打开；没有时隐藏
+        self.related_frame = ctk.CTkFrame(content_frame, fg_color="transparent")
+        self.related_label = ctk.CTkLabel(
+            self.related_frame,
+            text=self.translations[self.current_language]["related"],
+            font=("Helvetica", 12),
+            text_color="gray60"
+        )
+        self.related_label.pack(side="left")
+        self.related_buttons = [
+            ctk.CTkButton(self.related_frame, text="", height=24, font=("Helvetica", 12), fg_color="transparent", border_width=1)
+            for _ in range(self.RELATED_LIMIT)
+        ]
+        
+        # 缓存选项与命中统计
+        cache_frame = ctk.CTkFrame(content_frame, fg_color="transparent")
+        self.related_anchor = cache_frame
+        cache_frame.pack(fill="x", padx=100, pady=(0, 10))
+        self.bypass_cache_var = ctk.BooleanVar(value=False)
+        self.bypass_cache_checkbox = ctk.CTkCheckBox(
+            cache_frame,
+            text=self.translations[self.current_language]["bypass_cache"],
+            variable=self.bypass_cache_var,
+            font=("Helvetica", 12)
+        )
+        self.bypass_cache_checkbox.pack(side="left")
+        self.cache_stats_label = ctk.CTkLabel(cache_frame, text="", font=("Helvetica", 12), text_color="gray60")
+        self.cache_stats_label.pack(side="right")
+        
+        # 已选的附件（点击 ✕ 移除）和附件处理进度
+        self.attachment_label = ctk.CTkLabel(cache_frame, text="", font=("Helvetica", 12), text_color="gray60")
+        self.attachment_label.pack(side="left", padx=(20, 0))
+        self.clear_attachments_button = ctk.CTkButton(
+            cache_frame, text="✕", command=self.clear_attachments, width=24, height=24, font=("Helvetica", 12)
+        )
+        self.attachment_progress_label = ctk.CTkLabel(cache_frame, text="", font=("Helvetica", 12), text_color="gray60")
+        self.attachment_progress_label.pack(side="right", padx=(0, 20))
+        
+        # 聊天记录或快照写入失败时的提示（写入在后台线程中进行，失败不会中断对话）
+        self.storage_error_label = ctk.CTkLabel(cache_frame, text="", font=("Helvetica", 12), text_color="#d9534f")
+        self.storage_error_label.pack(side="right", padx=(0, 20))
+        
         # 聊天历史区域
         self.chat_history = ctk.CTkTextbox(
             content_frame,
@@ -232,6 +793,46 @@ class AIChatApp:
         )
         self.chat_history.pack(fill="both", expand=True, padx=20)
         
+        # 对比模式的并排视图，默认隐藏
+        self.compare_frame = ctk.CTkFrame(content_frame, fg_color="transparent")
+        self.compare_views = {}
+        for column, model in enumerate(self.COMPARE_MODELS):
+            self.compare_frame.grid_columnconfigure(column, weight=1, uniform="compare")
+            header = ctk.CTkFrame(self.compare_frame, fg_color="transparent")
+            header.grid(row=0, column=column, sticky="ew", padx=5)
+            ctk.CTkLabel(
+                header,
+                text=model,
+                font=("Helvetica", 16, "bold"),
+                text_color=self.model_styles[model]["color"]
+            ).pack(side="left")
+            status = ctk.CTkLabel(header, text="", font=("Helvetica", 12), text_color="gray60")
+            status.pack(side="right")
+            textbox = ctk.CTkTextbox(self.compare_frame, wrap="word", font=("Helvetica", 14), corner_radius=15)
+            textbox.grid(row=1, column=column, sticky="nsew", padx=5)
+            self.compare_views[model] = {
+                "textbox": textbox,
+                "status": status,
+                "typewriter": Typewriter(self.root, textbox)
+            }
+        self.compare_frame.grid_rowconfigure(1, weight=1)
+        self.compare_status = ctk.CTkLabel(self.compare_frame, text="", font=("Helvetica", 12), text_color="gray60")
+        self.compare_status.grid(row=2, column=0, columnspan=len(self.COMPARE_MODELS), pady=(5, 0))
+        
+        # 按帧调度的打字机渲染器，负责所有逐步出现的文本
+        self.typewriter = Typewriter(self.root, self.chat_history)
+        
+        # 公式渲染缓存，光栅化在工作进程中完成
+        self.latex_renderer = LatexRenderer(self.root)
+        self.latex_counter = 0
+        
+        # 代码块语法高亮，词法分析在工作进程中完成，标签按帧分批添加
+        self.highlighter = SyntaxHighlighter(self.root)
+        self.code_counter = 0
+        
+        # 文本框只显示最近的一部分消息，其余的滚动到附近时再插入
+        self.transcript = TranscriptView(self.root, self.chat_history, self.render_entry, self.latex_renderer.release)
+        
         # 初始化显示默认模型的标志
         self.update_model_logo()
         
@@ -242,6 +843,7 @@ class AIChatApp:
         self.chat_history.tag_config("bold", justify="left")
         self.chat_history.tag_config("italic", justify="left")
         self.chat_history.tag_config("code", background="#2d2d2d", foreground="#e6e6e6")
+        self.chat_history.tag_config("inline_code", background="#2d2d2d", foreground="#e6e6e6")
         self.chat_history.tag_config("heading1", justify="left")
         self.chat_history.tag_config("heading2", justify="left")
         self.chat_history.tag_config("heading3", justify="left")
@@ -342,166 +944,290 @@ class AIChatApp:
         # 显示保存成功消息
         self.append_message("系统", self.translations[self.current_language]["settings_updated"])
 
-    def show_history(self):
-        history_window = ctk.CTkToplevel(self.root)
-        history_window.title(self.translations[self.current_language]["history"])
-        history_window.geometry("800x600")
-        history_window.lift()  # 将窗口提升到最上层
-        history_window.focus_force()  # 强制获取焦点
-        history_window.grab_set()  # 模态窗口，阻止与其他窗口的交互
-        
-        # 历史记录列表
-        history_files = sorted(
-            [f for f in os.listdir(self.history_dir) if f.endswith('.txt')],
-            reverse=True
-        )
-        
-        # 创建滚动文本框显示历史记录
-        history_text = ctk.CTkTextbox(
-            history_window,
-            wrap="word",
-            font=("Helvetica", 14)
-        )
-        history_text.pack(fill="both", expand=True, padx=10, pady=10)
-        
-        # 读取最近的历史记录
-        for file in history_files[:10]:  # 显示最近10条记录
-            with open(os.path.join(self.history_dir, file), 'r', encoding='utf-8') as f:
-                history_text.insert("end", f"=== {file[:-4]} ===\n")
-                history_text.insert("end", f.read() + "\n\n")
-        
-        history_text.configure(state="disabled")  # 设为只读
+    def show_history(self, conversation_id=None):
+        window = HistoryWindow(self)
+        if conversation_id is not None:
+            window.open_conversation(conversation_id)
 
-    def save_chat_history(self, messages):
-        # 保存聊天记录到文件
-        filename = datetime.now().strftime("%Y%m%d_%H%M%S.txt")
-        filepath = os.path.join(self.history_dir, filename)
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(messages)
+    def sync_indexes(self):
+        """后台线程：补录历史索引，再加载并补录相关对话索引"""
+        self.history_index.sync(self.chat_store.list_conversations())
+        # numpy 导入较慢，放在后台线程中，不影响启动
+        from related import RelatedIndex
+        related = RelatedIndex(self.history_dir)
+        related.load()
+        # 先注册再补录：之后写入的记录由 ChatStore 交给索引，之前的由 sync 读取
+        self.chat_store.add_index(related)
+        related.sync(self.chat_store.list_conversations())
+        self.related = related
+
+    def update_related(self):
+        text = self.input_box.get().strip()
+        if text == self.related_text:
+            return
+        self.related_text = text
+        results = []
+        if self.related is not None and len(text) >= 2:
+            results = self.related.query(
+                text, self.RELATED_LIMIT, exclude=(self.conversation_id,), min_score=self.RELATED_MIN_SCORE
+            )
+        if not results:
+            self.related_frame.pack_forget()
+            return
+        for button, (conversation_id, score) in zip(self.related_buttons, results):
+            conversation = self.history_index.get_conversation(conversation_id) or {}
+            title = conversation.get("title") or conversation_id
+            if len(title) > 30:
+                title = title[:30] + "..."
+            button.configure(text=title, command=lambda cid=conversation_id: self.show_history(cid))
+            button.pack(side="left", padx=5)
+        for button in self.related_buttons[len(results):]:
+            button.pack_forget()
+        self.related_frame.pack(fill="x", padx=100, pady=(0, 10), before=self.related_anchor)
+
+    def show_stats(self):
+        StatsWindow(self)
+
+    def metrics_path(self):
+        # .jsonl 追加快照，其他扩展名写 Prometheus 文本格式
+        return self.config.get("metrics_file") or os.path.join("metrics", "metrics.prom")
+
+    def schedule_metrics_export(self):
+        interval = self.config.get("metrics_export_interval", 60)
+        if not self.config.get("metrics_file") or not interval:
+            return
+        self.root.after(int(interval * 1000), self.export_metrics_periodically)
+
+    def export_metrics_periodically(self):
+        # 写文件放在后台线程，不占用界面
+        threading.Thread(target=self.export_metrics, daemon=True).start()
+        self.schedule_metrics_export()
+
+    def export_metrics(self):
+        try:
+            metrics.export(self.metrics_path())
+        except OSError:
+            pass
+
+    def save_chat_history(self, role, content, model=None):
+        # 追加一条记录到当前会话日志，实际写盘在后台线程完成
+        self.chat_store.append(self.conversation_id, role, content, model=model)
 
     def append_message(self, sender, message, typing_effect=False):
-        timestamp = datetime.now().strftime("%H:%M:%S")
+        role, model = self.message_role(sender)
+        if typing_effect and role != "user":
+            # 打字效果：所有插入都交给按帧调度的渲染器，按顺序逐帧完成
+            self.typewriter.call(lambda: self.insert_message_header(sender))
+            segments = self.render_message_body(message, animate=True)
+            self.typewriter.call(lambda: self.finish_message(role, message, model, segments))
+            return
+        
+        # 直接插入前先写完尚未输出的内容，保证消息顺序
+        self.typewriter.cancel(flush=True)
+        self.insert_message_header(sender)
+        segments = self.render_message_body(message)
+        self.finish_message(role, message, model, segments)
+
+    def insert_message_header(self, sender):
+        # 新消息先登记到聊天记录模型，再插入标题
+        number = self.transcript.begin(sender)
+        self.chat_history.insert("end", self.message_header(self.transcript.entries[number]))
+
+    def message_header(self, entry):
+        sender = entry.sender
         # 翻译发送者名称
         if sender == "你" or sender == "You":
             sender = self.translations[self.current_language]["you"]
         elif sender == "错误" or sender == "Error":
             sender = self.translations[self.current_language]["error"]
             
-        header = f"[{timestamp}] {sender}: "
-        self.chat_history.insert("end", header)
-        
-        if typing_effect and sender != "你":
-            segments = self.split_latex(message)
-            for segment in segments:
-                if any(segment.startswith(delim) for delim in ['$', '\\[']):
-                    self.render_latex(segment)
+        return f"[{entry.timestamp}] {sender}: "
+
+    def render_entry(self, entry, index):
+        # 重新显示滚动回窗口内（或从快照恢复）的消息，优先使用保存的分段结果
+        segments = entry.segments
+        if segments is None:
+            segments = tokenize(entry.content)
+        elif callable(segments):
+            segments = entry.segments = segments()
+        self.chat_history.insert(index, self.message_header(entry))
+        self.render_segments(segments, index)
+        self.chat_history.insert(index, "\n")
+
+    def render_message_body(self, message, animate=False):
+        with metrics.timer("markdown_parse_seconds"):
+            segments = tokenize(message)
+        with metrics.timer("render_seconds"):
+            self.render_segments(segments, animate=animate)
+        return segments
+
+    def render_segments(self, segments, index="end", animate=False):
+        for segment in segments:
+            if segment.tag == "latex":
+                if animate:
+                    self.typewriter.call(lambda code=segment.text: self.render_latex(code))
                 else:
-                    formatted_segments = self.format_markdown(segment)
-                    for tag, text in formatted_segments:
-                        if tag == 'code':
-                            self.chat_history.insert("end", text + "\n", "code")
-                        elif tag == 'heading1':
-                            self.chat_history.insert("end", text + "\n", "heading1")
-                            self.chat_history.configure(font=("Helvetica", 16))  # 临时改变字体大小
-                        elif tag == 'heading2':
-                            self.chat_history.insert("end", text + "\n", "heading2")
-                            self.chat_history.configure(font=("Helvetica", 14))  # 临时改变字体大小
-                        elif tag == 'heading3':
-                            self.chat_history.insert("end", text + "\n", "heading3")
-                            self.chat_history.configure(font=("Helvetica", 12))  # 临时改变字体大小
-                        elif tag == 'list_item':
-                            self.chat_history.insert("end", text + "\n", "list_item")
-                        else:
-                            for char in text:
-                                self.chat_history.insert("end", char)
-                                self.chat_history.see("end")
-                                self.root.update()
-                                time.sleep(0.01)
-                            
-                        # 恢复默认字体大小
-                        if tag in ['heading1', 'heading2', 'heading3']:
-                            self.chat_history.configure(font=("Helvetica", 12))
-        else:
-            segments = self.split_latex(message)
-            for segment in segments:
-                if any(segment.startswith(delim) for delim in ['$', '\\[']):
-                    self.render_latex(segment)
+                    self.render_latex(segment.text, index)
+            elif segment.tag == "code" and segment.lang:
+                if animate:
+                    self.typewriter.call(lambda segment=segment: self.insert_code(segment))
                 else:
-                    formatted_segments = self.format_markdown(segment)
-                    for tag, text in formatted_segments:
-                        if tag in ['heading1', 'heading2', 'heading3']:
-                            self.chat_history.configure(font=("Helvetica", 16 if tag == 'heading1' else 14 if tag == 'heading2' else 12))
-                        self.chat_history.insert("end", text + "\n", tag)
-                        if tag in ['heading1', 'heading2', 'heading3']:
-                            self.chat_history.configure(font=("Helvetica", 12))
-        
+                    self.insert_code(segment, index)
+            elif animate:
+                # 只有普通文本逐字出现，代码块、标题、列表整段插入
+                self.typewriter.write(segment.text, segment.tag, typed=(segment.tag == "normal"))
+            else:
+                self.chat_history.insert(index, segment.text, segment.tag)
+
+    def insert_code(self, segment, index="end"):
+        # 代码先按普通样式插入，高亮结果到达后在开头的标记处按行列号添加颜色标签
+        self.code_counter += 1
+        mark = f"code_{self.code_counter}"
+        self.chat_history.mark_set(mark, "end-1c" if index == "end" else index)
+        self.chat_history.mark_gravity(mark, "left")
+        self.chat_history.insert(index, segment.text, segment.tag)
+        self.transcript.track(mark)
+        self.highlighter.highlight(
+            self.chat_history,
+            mark,
+            segment.lang,
+            segment.text,
+            alive=lambda: self.transcript.is_tracked(mark),
+            done=lambda: self.transcript.untrack(mark)
+        )
+
+    def finish_message(self, role, message, model, segments):
+        self.transcript.finish(message, segments)
         self.chat_history.insert("end", "\n")
         self.chat_history.see("end")
         
-        # 保存到历史记录
-        self.save_chat_history(self.chat_history.get("1.0", "end"))
+        # 保存到历史记录，分段结果追加到会话快照供下次启动直接显示
+        self.save_chat_history(role, message, model)
+        entry = self.transcript.entries[-1]
+        self.session.append_entry(entry.sender, entry.timestamp, segments)
 
-    def split_latex(self, text):
-        # 分割文本和各种格式的 LaTeX 公式
-        patterns = [
-            r'(\$\$[^$]+\$\$)',  # $$...$$
-            r'(\$[^$]+\$)',      # $...$
-            r'(\\\[[^\]]+\\\])', # \[...\]
-            r'(\\\([^)]+\\\))'   # \(...\)
-        ]
+    def restore_session(self, restored):
+        # 快照中的消息已经分段，只显示最后一页，不经过 Markdown / LaTeX 解析
+        with metrics.timer("session_restore_seconds"):
+            self.transcript.restore(restored.entries)
+            self.chat_history.see("end")
+
+    def poster(self):
+        """返回把回调交给 Tk 线程执行的函数；开始新对话后，之前的请求送来的回调被丢弃"""
+        generation = self.chat_generation
+        def post(func):
+            self.root.after(0, lambda: func() if self.chat_generation == generation else None)
+        return post
+
+    def remember(self, role, content, model=None):
+        """计入对话上下文，同时写入会话快照"""
+        self.conversation.add(role, content, model)
+        self.session.append_context(role, content, model)
+
+    def new_chat(self):
+        # 取消当前会话的全部请求，清空显示和上下文，开始新的会话日志和快照
+        self.chat_generation += 1
+        self.request_queue.cancel_all(self.conversation_id)
+        self.typewriter.cancel(flush=False)
+        self.transcript.reset()
+        self.conversation.clear()
+        self.conversation_id = self.chat_store.new_conversation()
+        self.session.start(self.conversation_id)
+        self.update_queue_view()
+
+    def begin_stream(self, sender):
+        self.stream_tokenizer = MarkdownTokenizer()
+        self.stream_segments = []
+        # 一条回复的解析和渲染时间分散在很多次调用中，累计后在结束时记录
+        self.stream_parse_time = 0.0
+        self.stream_render_time = 0.0
+        def start():
+            self.insert_message_header(sender)
+            # 记住尚未渲染的流式文本的起点，完整的行从这里开始替换为渲染结果
+            self.chat_history.mark_set("stream_start", "end-1c")
+            self.chat_history.mark_gravity("stream_start", "left")
+        self.typewriter.call(start)
+
+    def append_stream_chunk(self, chunk):
+        # 原始文本先逐字出现，每凑满一行就把这部分换成 Markdown/LaTeX 渲染结果
+        started = time.perf_counter()
+        segments = self.stream_tokenizer.feed(chunk)
+        self.stream_parse_time += time.perf_counter() - started
+        if not segments:
+            self.typewriter.write(chunk)
+            return
+        self.stream_segments.extend(segments)
+        # 分段器处理到最后一个换行为止，未完成的行留在 pending 中。先写出已处理的部分再替换，
+        # 这时 stream_start 到末尾恰好是要替换的原始文本，不需要按字符数计算
+        # （Tk 8.6 把 emoji 等字符算作两个，与 Python 的长度不一致）
+        cut = len(chunk) - len(self.stream_tokenizer.pending)
+        self.typewriter.write(chunk[:cut])
+        self.typewriter.call(lambda: self.commit_stream(segments))
+        if cut < len(chunk):
+            self.typewriter.write(chunk[cut:])
+
+    def commit_stream(self, segments):
+        started = time.perf_counter()
+        self.chat_history.delete("stream_start", "end-1c")
+        # 插入期间让标记跟随插入的内容后移
+        self.chat_history.mark_gravity("stream_start", "right")
+        self.render_segments(segments, index="stream_start")
+        self.chat_history.mark_gravity("stream_start", "left")
+        self.stream_render_time += time.perf_counter() - started
+
+    def end_stream(self, sender, message):
+        started = time.perf_counter()
+        segments = self.stream_tokenizer.finish()
+        metrics.observe("markdown_parse_seconds", self.stream_parse_time + time.perf_counter() - started)
+        all_segments = self.stream_segments + segments
+        def finish():
+            role, model = self.message_role(sender)
+            self.commit_stream(segments)
+            metrics.observe("render_seconds", self.stream_render_time)
+            self.chat_history.mark_unset("stream_start")
+            self.finish_message(role, message, model, all_segments)
+        self.typewriter.call(finish)
+
+    def message_role(self, sender):
+        # 根据显示的发送者推断记录中的角色和模型
+        if sender in ("你", "You"):
+            return "user", None
+        if sender in ("错误", "Error"):
+            return "error", None
+        if sender == "系统":
+            return "system", None
+        return "assistant", sender
+
+    def render_latex(self, latex_code, index="end"):
+        expression, is_display_math = strip_delimiters(latex_code)
         
-        segments = [text]
-        for pattern in patterns:
-            new_segments = []
-            for segment in segments:
-                if any(segment.startswith(delim) for delim in ['$', '\\[']):
-                    new_segments.append(segment)
-                else:
-                    parts = re.split(pattern, segment)
-                    for part in parts:
-                        if part and not part.isspace():
-                            new_segments.append(part)
-            segments = new_segments
+        # 先在插入位置放一个标记，图片在后台渲染完成后插入到标记处
+        self.latex_counter += 1
+        mark = f"latex_{self.latex_counter}"
+        self.chat_history.mark_set(mark, "end-1c" if index == "end" else index)
+        self.chat_history.mark_gravity(mark, "left")
+        self.transcript.wait_image(mark)
         
-        return [s for s in segments if s]
-
-    def render_latex(self, latex_code):
-        try:
-            # 移除外部定界符
-            if latex_code.startswith('$$') and latex_code.endswith('$$'):
-                latex_code = latex_code[2:-2]
-            elif latex_code.startswith('$') and latex_code.endswith('$'):
-                latex_code = latex_code[1:-1]
-            elif latex_code.startswith('\\[') and latex_code.endswith('\\]'):
-                latex_code = latex_code[2:-2]
-            elif latex_code.startswith('\\(') and latex_code.endswith('\\)'):
-                latex_code = latex_code[2:-2]
-
-            # 创建图形
-            is_display_math = latex_code.startswith('$$') or latex_code.startswith('\\[')
-            fig = Figure(figsize=(8, 1.2 if is_display_math else 0.7))  # 增加图形大小
-            ax = fig.add_subplot(111)
-            ax.axis('off')
-            
-            # 设置更大的边距
-            fig.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.1)
-            
-            ax.text(0.5, 0.5, f'${latex_code}$', 
-                   size=16 if is_display_math else 14,  # 增加字体大小
-                   ha='center', va='center')
-            
-            # 创建画布
-            canvas = FigureCanvasTkAgg(fig, master=self.chat_frame)
-            widget = canvas.get_tk_widget()
-            
-            # 将 LaTeX 公式插入到文本框
-            self.chat_history.window_create("end", window=widget)
-            canvas.draw()
-            
-        except Exception as e:
-            # 如果渲染失败，直接显示原始文本
-            self.chat_history.insert("end", latex_code)
+        def place(key, photo):
+            # 所在消息已经移出显示窗口时不再插入，图片直接归还给缓存
+            if not self.transcript.place_image(mark, key if photo is not None else None):
+                return
+            if photo is None:
+                # 如果渲染失败，直接显示原始文本
+                self.chat_history.insert(mark, latex_code)
+            else:
+                self.chat_history.image_create(mark, image=photo)
+                if is_display_math:
+                    self.chat_history.tag_add("latex", mark, f"{mark}+1c")
+            self.chat_history.mark_unset(mark)
+        
+        self.latex_renderer.request(
+            expression,
+            is_display_math,
+            ctk.get_appearance_mode().lower(),
+            self.root.winfo_fpixels("1i"),
+            place
+        )
 
     def load_config(self):
         try:
@@ -520,99 +1246,312 @@ class AIChatApp:
         if not message:
             return
             
-        # 立即清除输入框
+        # 立即清除输入框；输入框保持可用，新问题排在当前回答之后
         self.input_box.delete(0, "end")
+        self.update_related()
+        
+        # 模型、对比模式和缓存选项按提问时的设置
+        self.request_queue.enqueue(self.conversation_id, {
+            "message": message,
+            "model": self.model_var.get(),
+            "compare": self.compare_var.get(),
+            "use_cache": not self.bypass_cache_var.get(),
+            "attachments": self.attachments
+        })
+        self.clear_attachments()
+
+    def start_request(self, request):
+        """轮到排队的问题时在 Tk 线程中调用：显示问题、生成上下文，返回要执行的协程"""
+        message = request.payload["message"]
+        selected_model = request.payload["model"]
+        use_cache = request.payload["use_cache"]
         
-        # 禁用输入和发送按钮
-        self.input_box.configure(state="disabled")
-        self.send_button.configure(state="disabled")
+        attachments = request.payload.get("attachments")
+        if attachments:
+            return self.start_attachment_request(message, attachments, selected_model, use_cache)
         
         # 显示用户消息
         self.append_message("你", message, typing_effect=False)
         
-        # 在新线程中处理 AI 响应
-        def process_response():
-            selected_model = self.model_var.get()
-            client = self.ai_clients[selected_model]
-            
+        # 加入对话上下文（此时上一个回答已经记入），按各模型的上下文窗口生成要发送的消息列表
+        self.remember("user", message)
+        
+        if request.payload["compare"]:
+            contexts = {model: self.conversation.build_messages(model) for model in self.COMPARE_MODELS}
+            if selected_model == AUTO_MODEL:
+                # 对比模式下记入上下文的是当前排名第一的服务商的回答
+                ranking = self.router.rank()
+                selected_model = ranking[0] if ranking else None
+            return self.compare_responses(message, contexts, selected_model, use_cache, self.poster())
+        if selected_model == AUTO_MODEL:
+            # 事先不知道会由哪个服务商回答，按各自的上下文预算分别生成
+            messages = {model: self.conversation.build_messages(model) for model in PROVIDERS}
+        else:
+            messages = self.conversation.build_messages(selected_model)
+        return self.process_response(messages, selected_model, use_cache, self.poster())
+
+    def start_attachment_request(self, message, paths, selected_model, use_cache):
+        # 附件问题不使用对比模式，由一个服务商完成全部 map-reduce 请求
+        names = self.attachment_names(paths)
+        attached = self.translations[self.current_language]["attached"].format(names=names)
+        self.append_message("你", f"{message}\n{attached}", typing_effect=False)
+        # 上下文中只记问题和附件名，附件内容不进入后续对话
+        self.remember("user", f"{message}\n[Attached: {names}]")
+        if selected_model == AUTO_MODEL:
+            ranking = self.router.rank()
+            selected_model = ranking[0] if ranking else "DeepSeek"
+        if self.chunk_index is None:
+            self.chunk_index = ChunkIndex()
+        return self.process_attachments(message, paths, selected_model, use_cache, self.poster())
+
+    def stop_generation(self):
+        self.request_queue.cancel(self.conversation_id)
+
+    def update_queue_view(self):
+        running = self.request_queue.running(self.conversation_id) is not None
+        self.stop_button.configure(state="normal" if running else "disabled")
+        self.update_cache_stats()
+        
+        for child in self.queue_frame.winfo_children():
+            child.destroy()
+        pending = self.request_queue.pending(self.conversation_id)
+        if not pending:
+            self.queue_frame.pack_forget()
+            return
+        self.queue_frame.pack(fill="x", padx=100, pady=(0, 10), after=self.queue_anchor)
+        queued = self.translations[self.current_language]["queued"]
+        for position, request in enumerate(pending, 1):
+            row = ctk.CTkFrame(self.queue_frame, fg_color="transparent")
+            row.pack(fill="x")
+            text = request.payload["message"]
+            if len(text) > 60:
+                text = text[:60] + "..."
+            ctk.CTkLabel(
+                row, text=f"{queued} {position}: {text}", font=("Helvetica", 12), text_color="gray60", anchor="w"
+            ).pack(side="left", fill="x", expand=True)
+            for label, command in (("✕", lambda rid=request.id: self.request_queue.remove(rid)),
+                                   ("↓", lambda rid=request.id: self.request_queue.move(rid, 1)),
+                                   ("↑", lambda rid=request.id: self.request_queue.move(rid, -1))):
+                ctk.CTkButton(row, text=label, command=command, width=28, height=24, font=("Helvetica", 12)).pack(side="right", padx=2)
+
+    async def process_response(self, messages, selected_model, use_cache=True, post=None):
+        # 经由路由器请求，同时更新各服务商的延迟记录；自动模式下 messages 为 服务商 -> 消息列表
+        if selected_model == AUTO_MODEL:
+            stream = self.router.stream(messages, use_cache)
+        else:
+            stream = self.router.stream_one(selected_model, messages, use_cache)
+        await self.show_stream(stream, selected_model, post or self.poster())
+
+    async def show_stream(self, stream, model, post):
+        """显示 (服务商, 文本块) 流式回答，完成后记入对话上下文"""
+        chunks = []
+        
+        try:
+            # 收到第一块时才开始显示回复，每收到一块就交给 Tk 线程追加显示
+            async for model, chunk in stream:
+                if not chunks:
+                    post(lambda model=model: self.begin_stream(model))
+                chunks.append(chunk)
+                post(lambda chunk=chunk: self.append_stream_chunk(chunk))
+            response = "".join(chunks)
+            post(lambda: self.remember_reply(model, response))
+            post(lambda: self.end_stream(model, response))
+        except asyncio.CancelledError:
+            # 用户停止生成：关闭流（随之断开连接），已显示的部分保留但不计入对话上下文
+            if chunks:
+                partial = "".join(chunks)
+                post(lambda: self.end_stream(model, partial))
+            raise
+        except Exception as e:
+            if chunks:
+                # 已经显示的部分照常结束，但不计入对话上下文
+                partial = "".join(chunks)
+                post(lambda: self.end_stream(model, partial))
+            post(lambda e=e: self.append_message("错误", str(e), typing_effect=False))
+        finally:
+            # 立即关闭流式生成器，不等垃圾回收，被取消时底层连接能马上断开
+            await stream.aclose()
+
+    async def process_attachments(self, question, paths, model, use_cache=True, post=None):
+        post = post or self.poster()
+        client = self.ai_clients[model]
+        chunk_tokens = self.config.get("attachment_chunk_tokens", DEFAULT_CHUNK_TOKENS)
+        post(lambda: self.show_attachment_progress("chunking"))
+        loop = asyncio.get_running_loop()
+        try:
+            # 哈希和分段是磁盘和 CPU 工作，放到线程池中，不占用事件循环
+            chunks, skipped = await loop.run_in_executor(
+                None, plan_chunks, paths, model, self.chunk_index, chunk_tokens
+            )
+        except (OSError, sqlite3.Error) as e:
+            post(lambda: self.show_attachment_progress(None))
+            post(lambda e=e: self.append_message("错误", str(e), typing_effect=False))
+            return
+        
+        query = AttachmentQuery(
+            client, question, chunks, chunk_tokens,
+            concurrency=self.config.get("attachment_concurrency", DEFAULT_CONCURRENCY),
+            use_cache=use_cache,
+            on_progress=lambda stage, done, total: post(
+                lambda: self.show_attachment_progress(stage, done, total, len(skipped))
+            )
+        )
+        
+        async def tagged():
+            answer = query.stream()
             try:
-                response = client.get_response(message)
-                self.root.after(0, lambda: self.append_message(selected_model, response, typing_effect=True))
-            except Exception as e:
-                self.root.after(0, lambda: self.append_message("错误", str(e), typing_effect=False))
+                async for chunk in answer:
+                    yield model, chunk
             finally:
-                # 重新启用输入和发送按钮
-                self.root.after(0, lambda: self.input_box.configure(state="normal"))
-                self.root.after(0, lambda: self.send_button.configure(state="normal"))
-                self.root.after(0, lambda: self.input_box.focus())
-        
-        threading.Thread(target=process_response, daemon=True).start()
-
-    def format_markdown(self, text):
-        # 处理代码块
-        code_blocks = {}
-        code_block_pattern = r'```(?:\w+)?\n(.*?)```'
-        
-        def replace_code_block(match):
-            code = match.group(1)
-            key = f"CODE_BLOCK_{len(code_blocks)}"
-            code_blocks[key] = code
-            return key
-        
-        text = re.sub(code_block_pattern, replace_code_block, text, flags=re.DOTALL)
-        
-        # 处理行内代码
-        inline_code_blocks = {}
-        inline_code_pattern = r'`([^`]+)`'
-        
-        def replace_inline_code(match):
-            code = match.group(1)
-            key = f"INLINE_CODE_{len(inline_code_blocks)}"
-            inline_code_blocks[key] = code
-            return key
-        
-        text = re.sub(inline_code_pattern, replace_inline_code, text)
-        
-        # 处理其他 Markdown 元素
-        lines = text.split('\n')
-        formatted_lines = []
-        in_list = False
-        
-        for line in lines:
-            # 处理标题
-            if line.startswith('# '):
-                formatted_lines.append(('heading1', line[2:]))
-            elif line.startswith('## '):
-                formatted_lines.append(('heading2', line[3:]))
-            elif line.startswith('### '):
-                formatted_lines.append(('heading3', line[4:]))
-            # 处理列表
-            elif line.startswith('- ') or line.startswith('* '):
-                formatted_lines.append(('list_item', '• ' + line[2:]))
-                in_list = True
-            elif line.startswith('1. '):
-                formatted_lines.append(('list_item', line))
-                in_list = True
-            # 处理普通文本
-            else:
-                if line.strip() == '' and in_list:
-                    in_list = False
-                formatted_lines.append(('normal', line))
-        
-        # 恢复代码块
-        result = []
-        for tag, line in formatted_lines:
-            for key, code in code_blocks.items():
-                if key in line:
-                    result.append(('code', code))
-                    break
-            else:
-                for key, code in inline_code_blocks.items():
-                    if key in line:
-                        line = line.replace(key, f'`{code}`')
-                result.append((tag, line))
+                await answer.aclose()
         
-        return result
+        try:
+            await self.show_stream(tagged(), model, post)
+        finally:
+            post(lambda: self.show_attachment_progress(None))
+
+    def attach_files(self):
+        from tkinter import filedialog
+        self.add_attachments(filedialog.askopenfilenames(parent=self.root))
+
+    def attach_folder(self):
+        from tkinter import filedialog
+        path = filedialog.askdirectory(parent=self.root)
+        if path:
+            self.add_attachments([path])
+
+    def add_attachments(self, paths):
+        for path in paths:
+            if path not in self.attachments:
+                self.attachments.append(path)
+        self.update_attachment_view()
+
+    def clear_attachments(self):
+        # 换成新列表：已排队的问题仍持有原来的列表
+        self.attachments = []
+        self.update_attachment_view()
+
+    @staticmethod
+    def attachment_names(paths):
+        return ", ".join(os.path.basename(os.path.normpath(path)) or path for path in paths)
+
+    def update_attachment_view(self):
+        if not self.attachments:
+            self.attachment_label.configure(text="")
+            self.clear_attachments_button.pack_forget()
+            return
+        names = self.attachment_names(self.attachments)
+        if len(names) > 60:
+            names = names[:60] + "..."
+        self.attachment_label.configure(text=self.translations[self.current_language]["attached"].format(names=names))
+        self.clear_attachments_button.pack(side="left", padx=5, after=self.attachment_label)
+
+    def show_attachment_progress(self, stage, done=0, total=0, skipped=0):
+        t = self.translations[self.current_language]
+        if stage is None:
+            text = ""
+        elif stage == "chunking":
+            text = t["attachment_chunking"]
+        elif stage == "map":
+            text = t["attachment_map"].format(done=done, total=total)
+        else:
+            text = t["attachment_reduce"].format(done=done, total=total)
+        if stage is not None and skipped:
+            text += "  " + t["attachment_skipped"].format(count=skipped)
+        self.attachment_progress_label.configure(text=text)
+
+    def report_storage_error(self, error):
+        # 可能在 ChatStore 的写入线程中调用，回到 Tk 线程再更新界面
+        def show():
+            text = self.translations[self.current_language]["storage_error"].format(error=error)
+            self.storage_error_label.configure(text=text)
+        try:
+            self.root.after(0, show)
+        except RuntimeError:
+            pass  # 主循环已结束
+
+    def remember_reply(self, model, response):
+        if response:
+            self.remember("assistant", response, model)
+
+    def update_cache_stats(self):
+        if self.response_cache is None:
+            return
+        stats = self.response_cache.stats()
+        self.cache_stats_label.configure(
+            text=self.translations[self.current_language]["cache_stats"].format(
+                hits=stats["hits"], misses=stats["misses"], rate=stats["hit_rate"]
+            )
+        )
+
+    def toggle_compare_mode(self):
+        if self.compare_var.get():
+            self.chat_history.pack_forget()
+            self.compare_frame.pack(fill="both", expand=True, padx=20)
+        else:
+            self.compare_frame.pack_forget()
+            self.chat_history.pack(fill="both", expand=True, padx=20)
+
+    async def compare_responses(self, message, contexts, primary_model, use_cache=True, post=None):
+        # 三个模型并发请求，总耗时取决于最慢的一个而不是三者之和
+        post = post or self.poster()
+        post(lambda: self.begin_compare(message))
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(
+                *(self.compare_one(model, contexts[model], model == primary_model, use_cache, post) for model in self.COMPARE_MODELS),
+                return_exceptions=True
+            )
+        finally:
+            # 被停止时也显示已用时间
+            elapsed = time.perf_counter() - started
+            post(lambda: self.finish_compare(elapsed))
+
+    async def compare_one(self, model, messages, is_primary, use_cache=True, post=None):
+        post = post or self.poster()
+        writer = self.compare_views[model]["typewriter"]
+        started = time.perf_counter()
+        chunks = []
+        error = None
+        try:
+            async for _, chunk in self.router.stream_one(model, messages, use_cache):
+                chunks.append(chunk)
+                post(lambda chunk=chunk: writer.write(chunk))
+        except asyncio.CancelledError:
+            response = "".join(chunks)
+            post(lambda: self.finish_compare_column(model, response, time.perf_counter() - started))
+            raise
+        except Exception as e:
+            error = e
+        elapsed = time.perf_counter() - started
+        response = "".join(chunks)
+        if is_primary and error is None:
+            # 只有当前选中模型的回答进入后续轮次的上下文
+            post(lambda: self.remember_reply(model, response))
+        post(lambda: self.finish_compare_column(model, response, elapsed, error))
+
+    def begin_compare(self, message):
+        you = self.translations[self.current_language]["you"]
+        self.compare_status.configure(text="")
+        for view in self.compare_views.values():
+            view["typewriter"].cancel(flush=False)
+            view["textbox"].delete("1.0", "end")
+            view["textbox"].insert("end", f"{you}: {message}\n\n")
+            view["status"].configure(text="...")
+
+    def finish_compare_column(self, model, response, elapsed, error=None):
+        view = self.compare_views[model]
+        view["status"].configure(text=f"{elapsed:.1f}s")
+        # 回答同时记入主对话和历史记录
+        if response:
+            self.append_message(model, response, typing_effect=False)
+        if error is not None:
+            view["typewriter"].write(f"\n{error}")
+            self.append_message("错误", str(error), typing_effect=False)
+
+    def finish_compare(self, elapsed):
+        total = self.translations[self.current_language]["compare_total"]
+        self.compare_status.configure(text=f"{total}: {elapsed:.1f}s")
 
     def toggle_theme(self):
         current_theme = self.theme_var.get()
@@ -629,6 +1568,13 @@ class AIChatApp:
         self.language_button.configure(text=self.translations[self.current_language]["language_switch"])
         self.input_box.configure(placeholder_text=self.translations[self.current_language]["input_placeholder"])
         self.send_button.configure(text=self.translations[self.current_language]["send"])
+        self.stop_button.configure(text=self.translations[self.current_language]["stop"])
+        self.update_queue_view()
+        self.compare_switch.configure(text=self.translations[self.current_language]["compare"])
+        self.bypass_cache_checkbox.configure(text=self.translations[self.current_language]["bypass_cache"])
+        self.update_cache_stats()
+        self.update_attachment_view()
+        self.related_label.configure(text=self.translations[self.current_language]["related"])
         
         # 更新所有按钮文本
         for widget in self.root.winfo_children():
@@ -637,7 +1583,7 @@ class AIChatApp:
     def update_widget_language(self, widget):
         """递归更新所有部件的语言"""
         if isinstance(widget, ctk.CTkButton):
-            for lang_key in ["settings", "history", "theme_switch"]:
+            for lang_key in ["new_chat", "settings", "history", "stats", "theme_switch", "attach_files", "attach_folder"]:
                 if widget.cget("text") in [self.translations["zh"][lang_key], self.translations["en"][lang_key]]:
                     widget.configure(text=self.translations[self.current_language][lang_key])
                     break
@@ -652,6 +1598,17 @@ class AIChatApp:
         webbrowser.open("https://github.com/Travisma2233")
 
 if __name__ == "__main__":
+    # 公式渲染使用工作进程，打包成 exe 后需要这一行
+    multiprocessing.freeze_support()
     root = ctk.CTk()
+    profiler.mark("create window")
     app = AIChatApp(root)
+    
+    if profiler.enabled:
+        # 窗口第一次绘制完成后输出各阶段耗时
+        def report_startup():
+            root.update_idletasks()
+            profiler.mark("first frame")
+            profiler.report()
+        root.after_idle(report_startup)
     root.mainloop() 
\ No newline at end of file
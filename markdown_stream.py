@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import re
+from collections import namedtuple
+
+# 一段渲染结果：tag 为文本框标签名，lang 只对代码块有意义
+Segment = namedtuple("Segment", ["tag", "text", "lang"], defaults=[None])
+
+HEADING_TAGS = {"# ": "heading1", "## ": "heading2", "### ": "heading3"}
+ORDERED_ITEM_PATTERN = re.compile(r"\d+\. ")
+# 行内可能开始特殊格式的字符，其余字符直接跳过
+SPECIAL_CHAR_PATTERN = re.compile(r"[\\$`]")
+
+# 可以跨行的独立公式定界符
+DISPLAY_DELIMITERS = {"$$": "$$", "\\[": "\\]"}
+# 只在同一行内匹配的行内公式定界符
+INLINE_DELIMITERS = {"\\(": "\\)", "$": "$"}
+
+
+class MarkdownTokenizer:
+    """单遍、可增量的 Markdown / LaTeX 分段器
+
+    feed() 每次接收一段流式文本，只处理已经完整的行，返回新产生的段落；
+    未完成的最后一行留到下次。finish() 处理剩余内容和未闭合的代码块 / 公式。
+    每个字符只被扫描一次，总耗时与文本长度成线性关系。
+
+    支持 ```代码块```、`行内代码`、# 标题、- / * / 1. 列表，以及
+    $$...$$、\\[...\\]（可跨行）和 $...$、\\(...\\)（行内）公式。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._fence = None  # 代码块内：(语言, 已收集的行)
+        self._math = None  # 跨行公式内：(结束定界符, 已收集的文本)
+
+    def feed(self, chunk):
+        """追加一段文本，返回其中已完整行产生的新段落"""
+        # 只在新到的文本里找换行，长行分多次到达时不会重复扫描
+        end = chunk.rfind("\n")
+        if end < 0:
+            self._buffer += chunk
+            return []
+        text, self._buffer = self._buffer + chunk[:end + 1], chunk[end + 1:]
+        segments = []
+        for line in text.splitlines(keepends=True):
+            self._line(line, segments)
+        return merge_segments(segments)
+
+    def finish(self):
+        """结束输入，返回剩余的全部段落"""
+        segments = []
+        if self._buffer:
+            self._line(self._buffer, segments)
+            self._buffer = ""
+        if self._fence is not None:
+            # 未闭合的代码块按已有内容输出
+            lang, lines = self._fence
+            segments.append(Segment("code", "".join(lines), lang))
+            self._fence = None
+        if self._math is not None:
+            # 未闭合的公式按原样显示
+            segments.append(Segment("normal", self._math[1]))
+            self._math = None
+        return merge_segments(segments)
+
+    @property
+    def pending(self):
+        """尚未形成段落的文本（最后一个不完整的行）"""
+        return self._buffer
+
+    def _line(self, line, segments):
+        stripped = line.strip()
+        if self._fence is not None:
+            if stripped == "```":
+                lang, lines = self._fence
+                segments.append(Segment("code", "".join(lines), lang))
+                self._fence = None
+            else:
+                self._fence[1].append(line)
+            return
+
+        if self._math is None and stripped.startswith("```"):
+            self._fence = (stripped[3:].strip() or None, [])
+            return
+
+        tag = "normal"
+        body = line
+        if self._math is None:
+            for prefix, heading in HEADING_TAGS.items():
+                if line.startswith(prefix):
+                    tag, body = heading, line[len(prefix):]
+                    break
+            else:
+                if line.startswith("- ") or line.startswith("* "):
+                    tag, body = "list_item", "• " + line[2:]
+                elif ORDERED_ITEM_PATTERN.match(line):
+                    tag = "list_item"
+        self._inline(body, tag, segments)
+
+    def _inline(self, text, tag, segments):
+        # 在一行内依次识别公式和行内代码，其余部分作为 tag 文本
+        pos = 0
+        start = 0
+        length = len(text)
+
+        if self._math is not None:
+            closing, collected = self._math
+            end = text.find(closing)
+            if end < 0:
+                self._math = (closing, collected + text)
+                return
+            end += len(closing)
+            segments.append(Segment("latex", collected + text[:end]))
+            self._math = None
+            pos = start = end
+
+        while pos < length:
+            match = SPECIAL_CHAR_PATTERN.search(text, pos)
+            if match is None:
+                break
+            pos = match.start()
+            char = text[pos]
+            if char == "\\" and pos + 1 < length:
+                pair = text[pos:pos + 2]
+                if pair in ("\\[", "\\("):
+                    consumed = self._delimited(text, pos, pair, tag, segments, start)
+                    if consumed is None:
+                        return
+                    pos = start = consumed
+                    continue
+                if pair == "\\$":
+                    # 转义的美元符号按普通字符显示
+                    if pos > start:
+                        segments.append(Segment(tag, text[start:pos]))
+                    segments.append(Segment(tag, "$"))
+                    pos = start = pos + 2
+                    continue
+                pos += 2
+                continue
+            if char == "$":
+                opening = "$$" if text.startswith("$$", pos) else "$"
+                consumed = self._delimited(text, pos, opening, tag, segments, start)
+                if consumed is None:
+                    return
+                pos = start = consumed
+                continue
+            if char == "`":
+                end = text.find("`", pos + 1)
+                if end > pos + 1:
+                    if pos > start:
+                        segments.append(Segment(tag, text[start:pos]))
+                    segments.append(Segment("inline_code", text[pos + 1:end]))
+                    pos = start = end + 1
+                    continue
+            pos += 1
+
+        if start < length:
+            segments.append(Segment(tag, text[start:]))
+
+    def _delimited(self, text, pos, opening, tag, segments, start):
+        """处理从 pos 开始的公式；返回继续扫描的位置，进入跨行公式时返回 None"""
+        closing = DISPLAY_DELIMITERS.get(opening) or INLINE_DELIMITERS[opening]
+        end = text.find(closing, pos + len(opening))
+        if end == pos + len(opening) and opening == "$":
+            # "$$" 之外的空公式不当作公式
+            end = -1
+        if end < 0 and opening not in DISPLAY_DELIMITERS:
+            # 行内公式没有闭合，开头定界符按普通文本处理
+            segments.append(Segment(tag, text[start:pos + len(opening)]))
+            return pos + len(opening)
+        if pos > start:
+            segments.append(Segment(tag, text[start:pos]))
+        if end < 0:
+            self._math = (closing, text[pos:])
+            return None
+        end += len(closing)
+        segments.append(Segment("latex", text[pos:end]))
+        return end
+
+
+def merge_segments(segments):
+    """合并相邻的同类文本段，减少插入次数"""
+    merged = []
+    for segment in segments:
+        if not segment.text and segment.tag != "code":
+            continue
+        if merged and segment.tag == merged[-1].tag and segment.tag not in ("latex", "code", "inline_code"):
+            merged[-1] = Segment(segment.tag, merged[-1].text + segment.text)
+        else:
+            merged.append(segment)
+    return merged
+
+
+def tokenize(text):
+    """一次性分段完整文本"""
+    tokenizer = MarkdownTokenizer()
+    return tokenizer.feed(text) + tokenizer.finish()
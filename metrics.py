@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# 延迟类指标的桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 输出速度（token/秒）
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# 比例（如提示缓存命中率）
+RATIO_BUCKETS = (0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)
+BUCKETS = {"output_tokens_per_second": RATE_BUCKETS, "prompt_cache_hit_ratio": RATIO_BUCKETS}
+
+# Prometheus 指标名前缀
+PREFIX = "aichat_"
+
+
+class Histogram:
+    """固定桶的直方图，分位数按桶内线性插值估算（与 Prometheus histogram_quantile 相同）"""
+
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                # 用实际的最小 / 最大值收窄首尾桶，样本很少时估计更准
+                lower = max(self.buckets[index - 1] if index else 0.0, self.min)
+                upper = min(self.buckets[index] if index < len(self.buckets) else self.max, self.max)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class RequestTimer:
+    """一次模型请求的计时：首 token、总耗时、输入输出 token 数和结果
+
+    由 ChatClient 创建；close() 时如果既没有成功也没有失败，记为 cancelled。
+    """
+
+    def __init__(self, registry, provider):
+        self.registry = registry
+        self.provider = provider
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.outcome = None
+
+    def chunk(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            self.registry.observe("request_ttft_seconds", self.first_token - self.started, provider=self.provider)
+
+    def finish(self, tokens_in, tokens_out, outcome="ok"):
+        """outcome 为 cache_hit / coalesced 时没有上游请求，不记录延迟"""
+        registry = self.registry
+        registry.inc("tokens_in_total", tokens_in, provider=self.provider)
+        registry.inc("tokens_out_total", tokens_out, provider=self.provider)
+        self.outcome = outcome
+        if outcome != "ok":
+            return
+        finished = time.perf_counter()
+        registry.observe("request_seconds", finished - self.started, provider=self.provider)
+        if self.first_token is not None and tokens_out and finished > self.first_token:
+            registry.observe("output_tokens_per_second", tokens_out / (finished - self.first_token), provider=self.provider)
+
+    def prompt_cache(self, prompt_tokens, read_tokens, write_tokens):
+        """服务商报告的提示缓存用量：读取（命中）和写入的输入 token 数"""
+        registry = self.registry
+        registry.inc("prompt_cache_read_tokens_total", read_tokens, provider=self.provider)
+        registry.inc("prompt_cache_write_tokens_total", write_tokens, provider=self.provider)
+        if prompt_tokens:
+            registry.observe("prompt_cache_hit_ratio", read_tokens / prompt_tokens, provider=self.provider)
+
+    def fail(self, kind):
+        self.outcome = "error"
+        self.registry.inc("request_errors_total", provider=self.provider, kind=kind)
+
+    def close(self):
+        self.registry.inc("requests_total", provider=self.provider, outcome=self.outcome or "cancelled")
+
+
+class MetricsRegistry:
+    """进程内的指标集合：计数器和直方图，按 (名称, 标签) 区分，线程安全
+
+    - observe(name, value, **labels) / inc(name, amount, **labels)
+    - snapshot() 返回可 JSON 序列化的汇总（含 p50/p95/p99）
+    - export(path)：.jsonl 追加一行快照，其他扩展名写 Prometheus 文本格式
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(BUCKETS.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def request(self, provider):
+        return RequestTimer(self, provider)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {"name": name, "labels": dict(labels), **histogram.summary()}
+                for (name, labels), histogram in sorted(self._histograms.items())
+            ]
+        return {"time": time.time(), "counters": counters, "histograms": histograms}
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = [
+                (key, histogram.buckets, list(histogram.counts), histogram.count, histogram.sum)
+                for key, histogram in sorted(self._histograms.items())
+            ]
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+        for (name, labels), buckets, counts, count, total in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith(".jsonl"):
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.snapshot(), ensure_ascii=False) + "\n")
+            return
+        # 先写临时文件再替换，抓取方不会读到写了一半的文件
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_snapshot(snapshot):
+    """把快照排成统计面板显示的文本表格"""
+    lines = [f"{'metric':<34} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}"]
+    for item in snapshot["histograms"]:
+        label = ",".join(str(value) for value in item["labels"].values())
+        name = f"{item['name']}{'{' + label + '}' if label else ''}"
+        seconds = item["name"].endswith("_seconds")
+        values = [_format_value(item[field], seconds) for field in ("p50", "p95", "p99", "max")]
+        lines.append(f"{name:<34} {item['count']:>7} " + " ".join(f"{value:>9}" for value in values))
+    lines.append("")
+    for item in snapshot["counters"]:
+        label = ",".join(f"{key}={value}" for key, value in item["labels"].items())
+        lines.append(f"{item['name']}{'{' + label + '}' if label else ''}: {item['value']}")
+    return "\n".join(lines)
+
+
+def _format_value(value, seconds):
+    if value is None:
+        return "-"
+    if seconds:
+        return f"{value * 1000:.1f}ms"
+    return f"{value:.2f}" if value < 10 else f"{value:.1f}"
+
+
+class FrameMonitor:
+    """检测界面卡顿：每 interval_ms 用 root.after 心跳一次，实际间隔比预期多出的
+    时间就是 Tk 主线程被阻塞的时间；超过 stall_threshold 记一次卡顿"""
+
+    def __init__(self, root, registry, interval_ms=50, stall_threshold=0.1):
+        self.root = root
+        self.registry = registry
+        self.interval = interval_ms / 1000
+        self.interval_ms = interval_ms
+        self.stall_threshold = stall_threshold
+        self._expected = None
+        self._job = None
+
+    def start(self):
+        self._expected = time.perf_counter() + self.interval
+        self._job = self.root.after(self.interval_ms, self._tick)
+
+    def stop(self):
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+
+    def _tick(self):
+        now = time.perf_counter()
+        delay = max(0.0, now - self._expected)
+        self.registry.observe("ui_frame_delay_seconds", delay)
+        if delay >= self.stall_threshold:
+            self.registry.inc("ui_stalls_total")
+        self._expected = now + self.interval
+        self._job = self.root.after(self.interval_ms, self._tick)
+
+
+# 进程内共享的指标集合
+metrics = MetricsRegistry()
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+
+"""本地模拟 LLM 服务器，用于离线测试流式输出
+
+同时提供 OpenAI 兼容的 /v1/chat/completions（DeepSeek 与 OpenAI 客户端使用）
+和 Anthropic 格式的 /v1/messages（Claude 客户端使用），支持 SSE 流式和非流式两种响应。
+
+    python mock_server.py --port 8765 --ttft 0.3 --tokens-per-second 40
+
+故障注入（测试重试、限流和熔断）：
+    python mock_server.py --fault-count 2 --fault-status 429 --retry-after 1   # 前两个请求返回 429
+    python mock_server.py --fault-rate 0.3 --fault-status 503                  # 30% 的请求返回 503
+    python mock_server.py --drop-rate 0.1                                      # 10% 的流在中途断开
+
+提示缓存也会被模拟：/v1/chat/completions 自动缓存见过的消息前缀（usage 中返回
+prompt_cache_hit_tokens，需要 stream_options.include_usage），/v1/messages 只在带
+cache_control 的内容块处写入缓存（usage 中返回 cache_read/cache_creation_input_tokens）。
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    "这是来自本地模拟服务器的回复。This is a reply from the local mock server. "
+    "公式示例：$E = mc^2$。\n\n```python\nprint('hello')\n```\n"
+)
+
+
+def split_tokens(text):
+    """粗略切分为“token”：英文按单词（保留空白），中文按单字"""
+    return re.findall(r'\s*[A-Za-z0-9_]+|\s*[^\sA-Za-z0-9_]|\s+', text)
+
+
+def content_blocks(content):
+    """返回 [(文本, 是否带 cache_control)]"""
+    if isinstance(content, str):
+        return [(content, False)]
+    return [(block.get("text", ""), "cache_control" in block) for block in content if isinstance(block, dict)]
+
+
+class PromptCache:
+    """模拟服务商的前缀缓存：记住写入过的前缀（按内容块边界的累计哈希）"""
+
+    def __init__(self):
+        self.prefixes = set()
+        self.lock = threading.Lock()
+
+    def lookup(self, blocks, automatic):
+        """blocks 为 [(文本, 是否为断点)]；返回 (总 token, 命中 token, 写入 token)
+
+        automatic=True 时每个边界都可命中和写入（OpenAI / DeepSeek），
+        否则只在断点处写入，命中检查断点及其之前的边界（Anthropic）。
+        """
+        digest = hashlib.sha256()
+        boundaries = []  # (累计哈希, 累计 token, 是否为断点)
+        total = 0
+        for text, breakpoint in blocks:
+            digest.update(text.encode("utf-8") + b"\0")
+            total += len(split_tokens(text))
+            boundaries.append((digest.hexdigest(), total, breakpoint))
+        last_breakpoint = max((i for i, item in enumerate(boundaries) if item[2]), default=-1)
+        searchable = boundaries if automatic else boundaries[:last_breakpoint + 1]
+        with self.lock:
+            read = max((tokens for key, tokens, _ in searchable if key in self.prefixes), default=0)
+            written = 0
+            for key, tokens, breakpoint in boundaries:
+                if (automatic or breakpoint) and key not in self.prefixes:
+                    self.prefixes.add(key)
+                    written = max(written, tokens)
+        write = 0 if automatic else max(0, written - read)
+        return total, read, write
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # SSE 由许多小块组成，关闭 Nagle 算法避免每块都等待延迟确认
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # 每个新连接先等待 connect_delay，模拟真实网络中的 TCP + TLS 握手开销
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+        super().setup()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b"{}"
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {}
+
+    def reply_text(self, request):
+        if self.server.echo:
+            messages = request.get("messages") or []
+            last = messages[-1]["content"] if messages else ""
+            if isinstance(last, list):
+                last = "".join(block.get("text", "") for block in last)
+            return f"Echo: {last}"
+        return self.server.reply
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fault(self, status):
+        # 同时带有 OpenAI 和 Anthropic 两种错误格式需要的字段
+        body = json.dumps({
+            "type": "error",
+            "error": {"type": "mock_fault", "message": f"injected fault {status}"}
+        }).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.retry_after is not None:
+            self.send_header("Retry-After", f"{self.server.retry_after:g}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_sse(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_event(self, data, event=None):
+        text = f"event: {event}\n" if event else ""
+        text += f"data: {data}\n\n"
+        self.write_chunk(text.encode("utf-8"))
+
+    def end_sse(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def stream_tokens(self, tokens, emit):
+        # 首个 token 前等待 ttft，之后按 tokens_per_second 匀速输出
+        time.sleep(self.server.ttft)
+        interval = 1.0 / self.server.tokens_per_second if self.server.tokens_per_second else 0
+        # 按 drop_rate 在输出一半时断开连接，模拟网络中断
+        drop_at = len(tokens) // 2 if random.random() < self.server.drop_rate else None
+        for index, token in enumerate(tokens):
+            if index == drop_at:
+                self.close_connection = True
+                raise ConnectionAbortedError("injected stream drop")
+            emit(token)
+            if interval:
+                time.sleep(interval)
+
+    def do_POST(self):
+        request = self.read_json()
+        status = self.server.pick_fault()
+        if status:
+            self.send_fault(status)
+            return
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self.handle_chat_completions(request)
+        elif self.path.rstrip("/").endswith("/messages"):
+            self.handle_messages(request)
+        else:
+            self.send_json({"error": {"message": "not found"}}, status=404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def handle_chat_completions(self, request):
+        text = self.reply_text(request)
+        tokens = split_tokens(text)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "mock")
+        blocks = [block for m in request.get("messages") or [] for block in content_blocks(m.get("content", ""))]
+        prompt_tokens, cached, _ = self.server.prompt_cache.lookup(blocks, automatic=True)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "prompt_cache_hit_tokens": cached,
+            "prompt_cache_miss_tokens": prompt_tokens - cached,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+        if not request.get("stream"):
+            time.sleep(self.server.ttft)
+            self.send_json({
+                "id": completion_id,
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+            return
+
+        self.start_sse()
+
+        def emit(token):
+            self.send_event(json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+            }, ensure_ascii=False))
+
+        self.stream_tokens(tokens, emit)
+        self.send_event(json.dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        }))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self.send_event(json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [],
+                "usage": usage
+            }))
+        self.send_event("[DONE]")
+        self.end_sse()
+
+    def handle_messages(self, request):
+        text = self.reply_text(request)
+        tokens = split_tokens(text)
+        message_id = f"msg_{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "mock")
+        blocks = content_blocks(request.get("system") or "")
+        for message in request.get("messages") or []:
+            blocks.extend(content_blocks(message.get("content", "")))
+        total, read, write = self.server.prompt_cache.lookup(blocks, automatic=False)
+        usage = {
+            "input_tokens": total - read - write,
+            "output_tokens": len(tokens),
+            "cache_read_input_tokens": read,
+            "cache_creation_input_tokens": write,
+        }
+
+        if not request.get("stream"):
+            time.sleep(self.server.ttft)
+            self.send_json({
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [{"type": "text", "text": text}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": usage
+            })
+            return
+
+        self.start_sse()
+        self.send_event(json.dumps({
+            "type": "message_start",
+            "message": {
+                "id": message_id, "type": "message", "role": "assistant", "model": model,
+                "content": [], "stop_reason": None, "stop_sequence": None,
+                "usage": dict(usage, output_tokens=0)
+            }
+        }), event="message_start")
+        self.send_event(json.dumps({
+            "type": "content_block_start", "index": 0,
+            "content_block": {"type": "text", "text": ""}
+        }), event="content_block_start")
+
+        def emit(token):
+            self.send_event(json.dumps({
+                "type": "content_block_delta", "index": 0,
+                "delta": {"type": "text_delta", "text": token}
+            }, ensure_ascii=False), event="content_block_delta")
+
+        self.stream_tokens(tokens, emit)
+        self.send_event(json.dumps({"type": "content_block_stop", "index": 0}), event="content_block_stop")
+        self.send_event(json.dumps({
+            "type": "message_delta",
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": len(tokens)}
+        }), event="message_delta")
+        self.send_event(json.dumps({"type": "message_stop"}), event="message_stop")
+        self.end_sse()
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端断开连接是正常情况（取消请求、关闭连接池），不打印堆栈
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError, ConnectionAbortedError)):
+            return
+        super().handle_error(request, client_address)
+
+    def pick_fault(self):
+        """返回本次请求要注入的错误状态码，不注入时返回 None"""
+        with self.fault_lock:
+            self.request_count += 1
+            if self.request_count <= self.fault_count:
+                return self.fault_status
+        if self.fault_rate and random.random() < self.fault_rate:
+            return self.fault_status
+        return None
+
+
+class MockLLMServer:
+    """在后台线程运行的模拟服务器，可作为上下文管理器使用"""
+
+    def __init__(self, host="127.0.0.1", port=0, ttft=0.2, tokens_per_second=50.0,
+                 reply=DEFAULT_REPLY, echo=False, connect_delay=0.0, verbose=False,
+                 fault_rate=0.0, fault_status=503, fault_count=0, retry_after=None, drop_rate=0.0):
+        self.httpd = MockHTTPServer((host, port), MockLLMHandler)
+        self.httpd.ttft = ttft
+        self.httpd.tokens_per_second = tokens_per_second
+        self.httpd.reply = reply
+        self.httpd.echo = echo
+        self.httpd.connect_delay = connect_delay
+        self.httpd.verbose = verbose
+        self.httpd.fault_rate = fault_rate
+        self.httpd.fault_status = fault_status
+        self.httpd.fault_count = fault_count
+        self.httpd.retry_after = retry_after
+        self.httpd.drop_rate = drop_rate
+        self.httpd.request_count = 0
+        self.httpd.fault_lock = threading.Lock()
+        self.httpd.prompt_cache = PromptCache()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def chat_completions_url(self):
+        return self.base_url + "/v1/chat/completions"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地模拟 LLM 服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.2, help="首个 token 前的延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="0 表示不限速")
+    parser.add_argument("--reply", default=DEFAULT_REPLY, help="固定回复内容")
+    parser.add_argument("--echo", action="store_true", help="回显最后一条用户消息")
+    parser.add_argument("--connect-delay", type=float, default=0.0, help="每个新连接的额外延迟（秒），模拟握手")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="随机返回错误的请求比例")
+    parser.add_argument("--fault-status", type=int, default=503, help="注入错误时的状态码，如 429、500、503")
+    parser.add_argument("--fault-count", type=int, default=0, help="前 N 个请求固定返回错误")
+    parser.add_argument("--retry-after", type=float, default=None, help="错误响应附带的 Retry-After（秒）")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="流式输出中途断开的比例")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    server = MockLLMServer(
+        args.host, args.port, ttft=args.ttft, tokens_per_second=args.tokens_per_second,
+        reply=args.reply, echo=args.echo, connect_delay=args.connect_delay, verbose=args.verbose,
+        fault_rate=args.fault_rate, fault_status=args.fault_status, fault_count=args.fault_count,
+        retry_after=args.retry_after, drop_rate=args.drop_rate
+    )
+    print(f"模拟服务器运行在 {server.base_url}")
+    print(f"  DeepSeek/OpenAI: {server.chat_completions_url}")
+    print(f"  Claude:          {server.base_url}/v1/messages")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
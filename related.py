@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+
+"""相关对话推荐：按字符 n-gram 的 TF-IDF 向量计算输入内容与历史会话的余弦相似度
+
+    python related.py "快速排序的时间复杂度"      # 查询
+    python related.py --rebuild                    # 从聊天记录重建
+
+每个会话的文本切成字符二元组和三元组，哈希到 2^20 维；向量按 TF-IDF 加权、
+L2 归一化后只保留权重最大的若干维。倒排表（维度 -> 会话行号、权重）存成排序的
+NumPy 数组，查询是一次稀疏矩阵乘向量：取出查询各维的倒排区间，用 bincount 按行
+累加得分，再用 argpartition 取前 k 个，5 万个会话时也只需几毫秒。
+
+索引随 ChatStore 写入增量更新：新写入的消息并入该会话的词频，旧行标记为删除，
+新行进入待合并区；待合并区攒满后成为一个段，段多了再合并。文档频率始终是精确的，
+已建好的向量使用建立时的 IDF，重建时统一刷新。
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+FEATURE_BITS = 20
+# 每个会话保留的维度数，决定内存占用：5 万个会话约 60 MB
+DOC_FEATURES = 128
+# 待合并区的会话数，超过后固化为一个段；每次写入都要重建待合并区，所以不宜太大
+PENDING_LIMIT = 64
+MAX_SEGMENTS = 8
+# 最近更新过的会话保留完整词频，追加消息时不必重读日志
+TF_CACHE_SIZE = 16
+INDEXED_ROLES = ("user", "assistant")
+
+NON_WORD = re.compile(r"[\W_]+")
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+PRIME = np.uint64(0x100000001B3)
+BIGRAM_SALT = np.uint64(0x51ED27)
+SHIFT = np.uint64(64 - FEATURE_BITS)
+
+
+def ngram_counts(texts):
+    """若干段文本的字符二元组和三元组，返回 (排序后的特征号, 出现次数)
+
+    各段之间用 NUL 隔开，跨段的 n-gram 不计入，所以分批计算再合并的结果与一次计算相同。
+    """
+    parts = [NON_WORD.sub(" ", text.lower()).strip() for text in texts]
+    joined = "\0".join(f" {part} " for part in parts if part)
+    if not joined:
+        return np.empty(0, np.int32), np.empty(0, np.int32)
+    codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    present = codes != 0
+    # 整数运算按 2^64 回绕，乘黄金比例常数后取高位作为特征号
+    bigrams = ((codes[:-1] * PRIME + codes[1:]) ^ BIGRAM_SALT)[present[:-1] & present[1:]]
+    trigrams = ((codes[:-2] * PRIME + codes[1:-1]) * PRIME + codes[2:])[present[:-2] & present[1:-1] & present[2:]]
+    hashes = (np.concatenate((bigrams, trigrams)) * GOLDEN) >> SHIFT
+    features, counts = np.unique(hashes.astype(np.int32), return_counts=True)
+    return features, counts.astype(np.int32)
+
+
+def merge_counts(features, counts, more_features, more_counts):
+    merged, inverse = np.unique(np.concatenate((features, more_features)), return_inverse=True)
+    total = np.bincount(inverse, weights=np.concatenate((counts, more_counts)), minlength=len(merged))
+    return merged, total.astype(np.int32)
+
+
+def record_texts(records):
+    return [record.get("content") or "" for record in records if record.get("role") in INDEXED_ROLES]
+
+
+class Postings:
+    """不可变的倒排段：features 排序去重，第 i 维的行号和权重在 offsets[i]:offsets[i+1]"""
+
+    __slots__ = ("features", "offsets", "rows", "weights")
+
+    def __init__(self, features, offsets, rows, weights):
+        self.features = features
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+
+    @property
+    def size(self):
+        return len(self.rows)
+
+    @classmethod
+    def build(cls, features, rows, weights):
+        order = np.argsort(features)
+        features = features[order]
+        unique, starts = np.unique(features, return_index=True)
+        offsets = np.append(starts, len(features)).astype(np.int64)
+        return cls(unique, offsets, rows[order], weights[order])
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, np.int32), np.zeros(1, np.int64), np.empty(0, np.int32), np.empty(0, np.float32))
+
+    @classmethod
+    def from_docs(cls, docs):
+        """docs 是 (行号, 特征号, 权重) 列表"""
+        if not docs:
+            return None
+        return cls.build(
+            np.concatenate([features for _, features, _ in docs]),
+            np.concatenate([np.full(len(features), row, np.int32) for row, features, _ in docs]),
+            np.concatenate([weights for _, _, weights in docs])
+        )
+
+    @classmethod
+    def merge(cls, segments, alive):
+        """合并多个段，丢弃已删除的行"""
+        features = np.concatenate([np.repeat(s.features, np.diff(s.offsets)) for s in segments])
+        rows = np.concatenate([s.rows for s in segments])
+        weights = np.concatenate([s.weights for s in segments])
+        keep = alive[rows]
+        return cls.build(features[keep], rows[keep], weights[keep])
+
+    def gather(self, features, weights):
+        """查询向量与本段的乘积：返回 (行号, 得分贡献)"""
+        if not len(self.features):
+            return None
+        pos = np.minimum(np.searchsorted(self.features, features), len(self.features) - 1)
+        hit = self.features[pos] == features
+        pos = pos[hit]
+        starts = self.offsets[pos]
+        lengths = self.offsets[pos + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            return None
+        # 把各维的倒排区间拼成一个下标数组，不逐维循环
+        index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        return self.rows[index], self.weights[index] * np.repeat(weights[hit], lengths)
+
+
+class RelatedIndex:
+    """历史会话的相似度索引，保存在 chat_history/related.npz
+
+    接口与 HistoryIndex 一致（add_records / sync / remove），由 ChatStore 的写线程调用；
+    query() 在 Tk 线程中调用。写操作由 _write_lock 串行化，耗时的段合并在锁外完成，
+    查询只在读取当前段列表时短暂持有 _lock。
+    """
+
+    def __init__(self, history_dir, filename="related.npz"):
+        self.history_dir = history_dir
+        self.path = os.path.join(history_dir, filename)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+        self._reset()
+
+    def _reset(self):
+        with self._lock:
+            self.df = np.zeros(1 << FEATURE_BITS, np.int32)
+            self.doc_count = 0
+            self.sizes = {}  # 会话 -> 已索引的日志字节数
+            self.row_of = {}  # 会话 -> 当前行号
+            self.row_ids = []  # 行号 -> 会话（包括已删除的行）
+            self.alive = np.zeros(1024, bool)
+            self.segments = ()
+            self.pending_docs = []
+            self.pending = None
+            self.tf_cache = OrderedDict()
+
+    # ---- 持久化 ----
+
+    def load(self):
+        """读取保存的索引；文件不存在或版本不符时从空索引开始"""
+        with self._write_lock:
+            self._load()
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if int(data["version"]) != INDEX_VERSION:
+                    return
+                ids = [str(conversation_id) for conversation_id in data["ids"]]
+                segment = Postings(data["features"], data["offsets"], data["rows"], data["weights"])
+                df = data["df"]
+                sizes = data["sizes"].tolist()
+                doc_count = int(data["doc_count"])
+        except (OSError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning("读取相关对话索引失败，将重新建立: %s", e)
+            return
+        alive = np.ones(max(1024, len(ids)), bool)
+        alive[len(ids):] = False
+        with self._lock:
+            self.df = df
+            self.doc_count = doc_count
+            self.sizes = dict(zip(ids, sizes))
+            self.row_of = {conversation_id: row for row, conversation_id in enumerate(ids)}
+            self.row_ids = ids
+            self.alive = alive
+            self.segments = (segment,) if segment.size else ()
+
+    def save(self):
+        """把所有段合并、去掉已删除的行后写入文件（关闭时调用），失败时返回 False"""
+        with self._write_lock:
+            if not self._dirty:
+                return True
+            self._flush_pending()
+            self._compact()
+            segment = self.segments[0] if self.segments else Postings.empty()
+            tmp_path = self.path + ".tmp.npz"
+            try:
+                np.savez(
+                    tmp_path,
+                    version=INDEX_VERSION,
+                    df=self.df,
+                    doc_count=self.doc_count,
+                    ids=np.array(self.row_ids, dtype=str),
+                    sizes=np.array([self.sizes.get(cid, 0) for cid in self.row_ids], np.int64),
+                    features=segment.features,
+                    offsets=segment.offsets,
+                    rows=segment.rows,
+                    weights=segment.weights
+                )
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+            except OSError as e:
+                logger.error("保存相关对话索引失败: %s", e)
+                return False
+            return True
+
+    def _compact(self):
+        """重新编号，只留下存活的行"""
+        n_rows = len(self.row_ids)
+        alive = self.alive[:n_rows]
+        new_row = np.cumsum(alive, dtype=np.int64) - 1
+        if self.segments:
+            merged = Postings.merge(self.segments, self.alive)
+            merged.rows = new_row[merged.rows].astype(np.int32)
+            segments = (merged,)
+        else:
+            segments = ()
+        row_ids = [conversation_id for conversation_id, live in zip(self.row_ids, alive) if live]
+        alive = np.ones(max(1024, len(row_ids)), bool)
+        alive[len(row_ids):] = False
+        with self._lock:
+            self.segments = segments
+            self.row_ids = row_ids
+            self.row_of = {conversation_id: row for row, conversation_id in enumerate(row_ids)}
+            self.alive = alive
+
+    # ---- 写入 ----
+
+    def add_records(self, conversation_id, entries, size):
+        """登记新追加的记录，entries 是 (offset, length, record) 列表（与 HistoryIndex 相同）"""
+        if not entries:
+            return
+        with self._write_lock:
+            self._load()
+            start = self.sizes.get(conversation_id, 0)
+            if size <= start:
+                return  # sync 已经读到了这些记录
+            if entries[0][0] == start:
+                records = [record for _, _, record in entries]
+            else:
+                # 与已索引部分不衔接（注册到 ChatStore 之前写入的内容），从日志补读
+                records = read_records(self.log_path(conversation_id), start, size)
+            features, counts = ngram_counts(record_texts(records))
+            self._update(conversation_id, features, counts, size)
+
+    def _update(self, conversation_id, features, counts, size):
+        old = self._term_counts(conversation_id)
+        if old is None:
+            self.doc_count += 1
+            new_features = features
+        else:
+            # 只有这个会话中第一次出现的特征才增加文档频率
+            new_features = np.setdiff1d(features, old[0], assume_unique=True)
+            features, counts = merge_counts(old[0], old[1], features, counts)
+        self.df[new_features] += 1
+        self.tf_cache[conversation_id] = (features, counts)
+        self.tf_cache.move_to_end(conversation_id)
+        while len(self.tf_cache) > TF_CACHE_SIZE:
+            self.tf_cache.popitem(last=False)
+        self.sizes[conversation_id] = size
+        self._add_row(conversation_id, *self._doc_vector(features, counts))
+
+    def _term_counts(self, conversation_id):
+        """会话已索引部分的完整词频；不在缓存中时重读日志的已索引部分"""
+        if conversation_id in self.tf_cache:
+            return self.tf_cache[conversation_id]
+        if conversation_id not in self.row_of:
+            return None
+        records = read_records(self.log_path(conversation_id), 0, self.sizes.get(conversation_id, 0))
+        return ngram_counts(record_texts(records))
+
+    def _idf(self, features):
+        return np.log((1.0 + self.doc_count) / (1.0 + self.df[features])) + 1.0
+
+    def _doc_vector(self, features, counts):
+        weights = (1.0 + np.log(counts)) * self._idf(features)
+        norm = np.sqrt(np.dot(weights, weights)) or 1.0
+        if len(weights) > DOC_FEATURES:
+            keep = np.argpartition(weights, -DOC_FEATURES)[-DOC_FEATURES:]
+            features, weights = features[keep], weights[keep]
+        # 按完整向量的长度归一化，丢掉的维度只会让得分略低
+        return features, (weights / norm).astype(np.float32)
+
+    def _add_row(self, conversation_id, features, weights, publish=True):
+        row = len(self.row_ids)
+        alive = self.alive
+        if row >= len(alive):
+            alive = np.concatenate((alive, np.zeros(len(alive), bool)))
+        alive[row] = True
+        self.pending_docs.append((row, features, weights))
+        # 批量建立时最后一次性生成段，不必每行都重建待合并区
+        pending = Postings.from_docs(self.pending_docs) if publish else self.pending
+        with self._lock:
+            old_row = self.row_of.get(conversation_id)
+            if old_row is not None:
+                alive[old_row] = False
+            self.alive = alive
+            self.row_ids.append(conversation_id)
+            self.row_of[conversation_id] = row
+            self.pending = pending
+        self._dirty = True
+        if publish and len(self.pending_docs) >= PENDING_LIMIT:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        if not self.pending_docs:
+            return
+        segments = self.segments + (self.pending,)
+        if len(segments) > MAX_SEGMENTS:
+            # 先合并较新的小段；小段总量超过最大段的一半时全部合并
+            tail = Postings.merge(segments[1:], self.alive)
+            if tail.size * 2 > segments[0].size:
+                segments = (Postings.merge(segments, self.alive),)
+            else:
+                segments = (segments[0], tail)
+        self.pending_docs = []
+        with self._lock:
+            self.segments = segments
+            self.pending = None
+
+    def remove(self, conversation_id):
+        with self._write_lock:
+            self._load()
+            self._remove(conversation_id)
+
+    def _remove(self, conversation_id):
+        old = self._term_counts(conversation_id)
+        if old is None:
+            return
+        self.df[old[0]] -= 1
+        self.doc_count -= 1
+        self.tf_cache.pop(conversation_id, None)
+        self.sizes.pop(conversation_id, None)
+        with self._lock:
+            self.alive[self.row_of.pop(conversation_id)] = False
+        self._dirty = True
+
+    def log_path(self, conversation_id):
+        return os.path.join(self.history_dir, f"{conversation_id}.jsonl")
+
+    def sync(self, conversation_ids):
+        """把索引之外新增的日志内容补录进索引
+
+        索引为空时（第一次使用或重建）分两遍：先统计所有会话的文档频率，
+        再用最终的 IDF 生成向量，避免先建立的会话使用样本很少时的 IDF。
+        """
+        with self._write_lock:
+            self._load()
+            if not self.row_of:
+                self._build(conversation_ids)
+                return
+            for conversation_id in conversation_ids:
+                path = self.log_path(conversation_id)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                start = self.sizes.get(conversation_id, 0)
+                if size == start:
+                    continue
+                if size < start:
+                    # 文件被压缩或替换过，整体重建
+                    self._remove(conversation_id)
+                    start = 0
+                end = complete_size(path, start, size)
+                if end > start:
+                    features, counts = ngram_counts(record_texts(read_records(path, start, end)))
+                    self._update(conversation_id, features, counts, end)
+
+    def _build(self, conversation_ids):
+        self._reset()
+        self._loaded = True
+        sizes = {}
+        for conversation_id in conversation_ids:
+            path = self.log_path(conversation_id)
+            try:
+                end = complete_size(path, 0, os.path.getsize(path))
+            except OSError:
+                continue
+            features, _ = ngram_counts(record_texts(read_records(path, 0, end)))
+            self.df[features] += 1
+            self.doc_count += 1
+            sizes[conversation_id] = end
+        for conversation_id, end in sizes.items():
+            features, counts = ngram_counts(record_texts(read_records(self.log_path(conversation_id), 0, end)))
+            self.sizes[conversation_id] = end
+            self._add_row(conversation_id, *self._doc_vector(features, counts), publish=False)
+        if self.pending_docs:
+            segment = Postings.from_docs(self.pending_docs)
+            self.pending_docs = []
+            with self._lock:
+                self.segments = (segment,)
+        self._dirty = True
+
+    def rebuild(self, conversation_ids):
+        """丢弃现有索引，按当前的文档频率重新生成所有向量"""
+        with self._write_lock:
+            self._build(conversation_ids)
+
+    # ---- 查询 ----
+
+    def query(self, text, limit=5, exclude=(), min_score=0.0):
+        """返回与 text 最相似的会话 [(会话 ID, 余弦相似度)]，按相似度降序"""
+        with metrics.timer("related_query_seconds"):
+            features, counts = ngram_counts([text])
+            if not len(features):
+                return []
+            with self._lock:
+                parts = self.segments + ((self.pending,) if self.pending is not None else ())
+                alive = self.alive
+                row_ids = self.row_ids
+                row_of = self.row_of
+                n_rows = len(row_ids)
+                doc_count = self.doc_count
+            if not parts or not n_rows:
+                return []
+            weights = (1.0 + np.log(counts)) * (np.log((1.0 + doc_count) / (1.0 + self.df[features])) + 1.0)
+            weights /= np.sqrt(np.dot(weights, weights))
+
+            scores = np.zeros(n_rows)
+            for part in parts:
+                gathered = part.gather(features, weights)
+                if gathered is not None:
+                    rows, contributions = gathered
+                    keep = rows < n_rows  # 读取快照之后新加的行
+                    scores += np.bincount(rows[keep], weights=contributions[keep], minlength=n_rows)
+            scores[~alive[:n_rows]] = 0.0
+            for conversation_id in exclude:
+                row = row_of.get(conversation_id)
+                if row is not None and row < n_rows:
+                    scores[row] = 0.0
+
+            # 大多数行得分为 0，只在命中的行中选前 k 个（大量相等的值会让 argpartition 变慢）
+            candidates = np.flatnonzero(scores > min_score)
+            if len(candidates) > limit:
+                candidates = candidates[np.argpartition(scores[candidates], -limit)[-limit:]]
+            top = candidates[np.argsort(-scores[candidates])]
+            return [(row_ids[row], float(scores[row])) for row in top]
+
+
+def complete_size(path, start, end):
+    """[start, end) 中最后一个完整行之后的位置（写了一半的行等下次再补）"""
+    if end <= start:
+        return start
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return start + data.rfind(b"\n") + 1
+
+
+def read_records(path, start, end):
+    records = []
+    try:
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+    except OSError:
+        return records
+    for line in data.splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def main(argv=None):
+    from history_index import HistoryIndex
+    from chat_store import ChatStore
+
+    parser = argparse.ArgumentParser(description="查找与输入内容相关的历史会话")
+    parser.add_argument("text", nargs="?", help="查询内容")
+    parser.add_argument("--history-dir", default="chat_history")
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--rebuild", action="store_true", help="从聊天记录重建索引")
+    args = parser.parse_args(argv)
+
+    store = ChatStore(args.history_dir)
+    index = RelatedIndex(args.history_dir)
+    try:
+        conversation_ids = store.list_conversations()
+        if args.rebuild:
+            index.rebuild(conversation_ids)
+        else:
+            index.sync(conversation_ids)
+        index.save()
+        print(f"{len(index.row_of)} 个会话", file=sys.stderr)
+        if args.text:
+            titles = HistoryIndex(args.history_dir)
+            for conversation_id, score in index.query(args.text, args.limit):
+                conversation = titles.get_conversation(conversation_id) or {}
+                print(f"{score:.3f}  {conversation_id}  {conversation.get('title', '')}")
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
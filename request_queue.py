@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import itertools
+from collections import OrderedDict, deque
+
+
+class QueuedRequest:
+    """排队中的一次提问；payload 由应用决定（问题文本、模型、是否用缓存等）"""
+
+    __slots__ = ("id", "conversation_id", "payload", "future", "task", "cancelled")
+
+    def __init__(self, request_id, conversation_id, payload):
+        self.id = request_id
+        self.conversation_id = conversation_id
+        self.payload = payload
+        self.future = None  # 开始执行后为 AsyncRunner.submit 返回的 Future
+        self.task = None  # 事件循环中执行它的任务，只在事件循环线程中读写
+        self.cancelled = False
+
+
+class RequestQueue:
+    """按会话排队的请求调度器（只在 Tk 线程中使用）
+
+    - 同一会话的请求严格按顺序执行，后一个问题开始时才生成上下文，能带上前一个回答
+    - 不同会话之间并行，同时执行的请求数不超过 max_concurrency；
+      有空位时按会话轮流取下一个请求，某个会话排了很多问题也不会占满所有名额
+    - cancel() 取消正在执行的请求：协程收到 CancelledError，流式响应随之关闭，
+      底层连接断开后服务商也会停止生成
+    - 未开始的请求可以 remove() 或 move() 调整顺序
+
+    start(request) 在请求轮到时被调用，返回要执行的协程；on_change() 在队列变化后调用。
+    """
+
+    def __init__(self, root, runner, start, max_concurrency=2, on_change=None):
+        self.root = root
+        self.runner = runner
+        self.start = start
+        self.max_concurrency = max(1, max_concurrency)
+        self.on_change = on_change
+        self._pending = OrderedDict()  # 会话 -> 等待中的请求队列，按轮转顺序排列
+        self._running = {}  # 会话 -> 执行中的请求
+        self._ids = itertools.count(1)
+
+    def enqueue(self, conversation_id, payload):
+        request = QueuedRequest(next(self._ids), conversation_id, payload)
+        self._pending.setdefault(conversation_id, deque()).append(request)
+        self._pump()
+        self._changed()
+        return request
+
+    def running(self, conversation_id):
+        return self._running.get(conversation_id)
+
+    def pending(self, conversation_id):
+        return list(self._pending.get(conversation_id, ()))
+
+    def cancel(self, conversation_id):
+        """取消该会话正在执行的请求，返回是否有请求被取消"""
+        request = self._running.get(conversation_id)
+        if request is None or request.future is None or request.future.done():
+            return False
+        # 不直接取消 Future：那样完成回调会在协程处理完取消之前触发，下一个请求随即开始，
+        # 与被取消请求收尾时送回 Tk 线程的回调交错
+        self.runner.loop.call_soon_threadsafe(self._cancel_task, request)
+        return True
+
+    def cancel_all(self, conversation_id):
+        """清空该会话的等待队列并取消正在执行的请求"""
+        self._pending.pop(conversation_id, None)
+        self.cancel(conversation_id)
+        self._changed()
+
+    def remove(self, request_id):
+        for conversation_id, queue in self._pending.items():
+            for request in queue:
+                if request.id == request_id:
+                    queue.remove(request)
+                    if not queue:
+                        del self._pending[conversation_id]
+                    self._changed()
+                    return True
+        return False
+
+    def move(self, request_id, offset):
+        """在所属会话的等待队列中前移（offset < 0）或后移"""
+        for queue in self._pending.values():
+            for position, request in enumerate(queue):
+                if request.id == request_id:
+                    target = max(0, min(len(queue) - 1, position + offset))
+                    if target != position:
+                        del queue[position]
+                        queue.insert(target, request)
+                        self._changed()
+                    return True
+        return False
+
+    def _pump(self):
+        while len(self._running) < self.max_concurrency:
+            conversation_id = next(
+                (cid for cid in self._pending if cid not in self._running), None
+            )
+            if conversation_id is None:
+                return
+            queue = self._pending.pop(conversation_id)
+            request = queue.popleft()
+            if queue:
+                # 放到轮转顺序的末尾
+                self._pending[conversation_id] = queue
+            self._running[conversation_id] = request
+            try:
+                request.future = self.runner.submit(self._run(request, self.start(request)))
+            except Exception:
+                del self._running[conversation_id]
+                raise
+
+    async def _run(self, request, coro):
+        # 在协程内部的 finally 中通知完成：被取消的请求送回 Tk 线程的收尾回调
+        # （如结束流式输出）一定排在 _finish 之前
+        request.task = asyncio.current_task()
+        try:
+            if request.cancelled:
+                coro.close()
+                return None
+            return await coro
+        finally:
+            self._schedule_finish(request)
+
+    @staticmethod
+    def _cancel_task(request):
+        # 在事件循环线程中执行；任务还没开始时由 _run 在开始时检查
+        request.cancelled = True
+        if request.task is not None:
+            request.task.cancel()
+
+    def _schedule_finish(self, request):
+        # 在事件循环线程中执行，回到 Tk 线程再修改队列
+        try:
+            self.root.after(0, lambda: self._finish(request))
+        except RuntimeError:
+            pass  # 主循环已结束
+
+    def _finish(self, request):
+        if self._running.get(request.conversation_id) is request:
+            del self._running[request.conversation_id]
+        self._pump()
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# 错误类别及显示给用户的说明
+ERROR_MESSAGES = {
+    "missing_key": "未设置 API 密钥",
+    "auth": "API 密钥无效或没有权限",
+    "bad_request": "请求被拒绝",
+    "rate_limit": "请求过于频繁",
+    "server": "服务暂时不可用",
+    "timeout": "请求超时",
+    "connection": "无法连接到服务器",
+    "circuit_open": "服务连续出错，暂停请求",
+    "unknown": "请求失败",
+}
+
+# 可以重试的错误类别
+RETRYABLE_KINDS = {"rate_limit", "server", "timeout", "connection"}
+# 计入熔断器的错误类别；限流由退避处理，不代表服务故障
+BREAKER_KINDS = {"server", "timeout", "connection"}
+
+
+class ProviderError(Exception):
+    """结构化的请求错误：provider、kind（见 ERROR_MESSAGES）、HTTP 状态码、建议的重试等待时间"""
+
+    def __init__(self, provider, kind, detail="", status=None, retry_after=None, attempts=1):
+        self.provider = provider
+        self.kind = kind
+        self.detail = detail
+        self.status = status
+        self.retry_after = retry_after
+        self.attempts = attempts
+        super().__init__(str(self))
+
+    @property
+    def retryable(self):
+        return self.kind in RETRYABLE_KINDS
+
+    def __str__(self):
+        text = f"{self.provider} {ERROR_MESSAGES.get(self.kind, ERROR_MESSAGES['unknown'])}"
+        if self.status:
+            text += f" (HTTP {self.status})"
+        if self.attempts > 1:
+            text += f"，已尝试 {self.attempts} 次"
+        if self.kind == "circuit_open" and self.retry_after:
+            text += f"，{self.retry_after:.0f} 秒后恢复"
+        if self.detail:
+            text += f": {self.detail}"
+        return text
+
+    def to_dict(self):
+        return {
+            "provider": self.provider,
+            "kind": self.kind,
+            "status": self.status,
+            "retry_after": self.retry_after,
+            "attempts": self.attempts,
+            "detail": self.detail,
+        }
+
+
+def parse_retry_after(headers):
+    """解析 Retry-After（秒数或 HTTP 日期）以及 retry-after-ms 响应头，返回秒数"""
+    if not headers:
+        return None
+    try:
+        headers = {str(key).lower(): value for key, value in headers.items()}
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            return max(0.0, float(value) / 1000)
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def classify_error(provider, error):
+    """把 requests / httpx / openai / anthropic 的异常统一转换为 ProviderError
+
+    按属性和类名判断，不需要导入各家 SDK。
+    """
+    if isinstance(error, ProviderError):
+        return error
+    response = getattr(error, "response", None)
+    status = (
+        getattr(error, "status_code", None)
+        or getattr(error, "http_status", None)
+        or getattr(response, "status_code", None)
+    )
+    headers = getattr(error, "headers", None) or getattr(response, "headers", None)
+    name = type(error).__name__
+
+    if isinstance(status, int):
+        if status == 429:
+            kind = "rate_limit"
+        elif status in (401, 403):
+            kind = "auth"
+        elif status in (408, 409) or status >= 500:
+            kind = "server"
+        elif 400 <= status < 500:
+            kind = "bad_request"
+        else:
+            kind = "unknown"
+    elif isinstance(error, TimeoutError) or "Timeout" in name:
+        kind = "timeout"
+    elif isinstance(error, ConnectionError) or any(part in name for part in ("Connection", "Protocol", "Chunked", "IncompleteRead")):
+        kind = "connection"
+    else:
+        kind = "unknown"
+        status = None
+
+    detail = str(error).strip()
+    if len(detail) > 300:
+        detail = detail[:300] + "..."
+    return ProviderError(
+        provider, kind, detail,
+        status=status if isinstance(status, int) else None,
+        retry_after=parse_retry_after(headers)
+    )
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的额度，按时间匀速补充
+
+    reserve() 立即扣除额度并返回调用方需要等待的秒数（额度可以暂时透支），
+    所以同步线程和 asyncio 协程可以共用同一个桶。
+    """
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst or per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 单次请求超过桶容量时按容量计，否则永远等不到
+            self.tokens -= min(amount, self.capacity)
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def consume(self, amount):
+        """事后补扣（如回复实际用掉的 token），不需要等待"""
+        with self._lock:
+            self.tokens -= amount
+
+
+class CircuitBreaker:
+    """熔断器：连续 failure_threshold 次故障后断开 reset_timeout 秒，
+    期间直接失败；之后放行一个试探请求，成功则恢复
+
+    试探请求的每种结局都要结束半开状态：成功或服务端有响应时恢复，故障时重新断开，
+    被取消时由调用方 release_probe() 归还，让下一个请求重新试探。
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe = None  # 正在进行的试探请求的凭据
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allows_request(self):
+        """当前是否会放行请求（不占用试探名额），供排序等只读场合使用"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            return self._probe is None
+
+    def check(self):
+        """返回 (还需等待的秒数, 试探凭据)；允许请求时等待秒数为 None
+
+        放行的是半开状态下的试探请求时返回凭据，请求被取消时用它调用 release_probe()。
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return None, None
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                return remaining, None
+            if self._probe is not None:
+                return self.reset_timeout, None
+            self._probe = object()
+            return None, self._probe
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probe = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probe is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probe = None
+
+    def resolve_probe(self, recovered):
+        """不计入熔断的错误（如 429、401）：试探中时，服务端有响应就恢复，否则重新断开"""
+        with self._lock:
+            if self._probe is None:
+                return
+            self._probe = None
+            if recovered:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.opened_at = time.monotonic()
+
+    def release_probe(self, probe):
+        """试探请求没有结果就结束（被取消）时归还名额，状态仍为半开"""
+        with self._lock:
+            if probe is not None and self._probe is probe:
+                self._probe = None
+
+
+class RetryPolicy:
+    """带抖动的指数退避；服务端给出 Retry-After 时按它等待"""
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=30.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """第 attempt 次（从 1 开始）失败后的等待秒数；不应再重试时返回 None"""
+        if attempt >= self.max_attempts:
+            return None
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        # full jitter：在 [0, base * 2^n] 内随机，避免大量请求同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class ProviderGuard:
+    """一个服务商共享的限流、重试和熔断状态，供该服务商的所有客户端使用"""
+
+    def __init__(self, provider, requests_per_minute=None, tokens_per_minute=None,
+                 retry=None, breaker=None):
+        self.provider = provider
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+
+    @classmethod
+    def from_config(cls, provider, config):
+        """读取 config.json 中的 rate_limits.<服务商> 和 retry 设置"""
+        limits = (config.get("rate_limits") or {}).get(provider, {})
+        retry = config.get("retry") or {}
+        return cls(
+            provider,
+            requests_per_minute=limits.get("rpm"),
+            tokens_per_minute=limits.get("tpm"),
+            retry=RetryPolicy(
+                max_attempts=retry.get("max_attempts", 3),
+                base_delay=retry.get("base_delay", 0.5),
+                max_delay=retry.get("max_delay", 30.0)
+            ),
+            breaker=CircuitBreaker(
+                failure_threshold=retry.get("breaker_threshold", 5),
+                reset_timeout=retry.get("breaker_reset", 30.0)
+            )
+        )
+
+    def before_request(self, tokens):
+        """熔断时抛出 ProviderError；否则返回 (为遵守限流需要等待的秒数, 试探凭据)
+
+        试探凭据不为 None 时，调用方要在请求结束后（包括被取消）调用 release_probe()。
+        """
+        remaining, probe = self.breaker.check()
+        if remaining is not None:
+            raise ProviderError(self.provider, "circuit_open", retry_after=remaining)
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        return wait, probe
+
+    def release_probe(self, probe):
+        self.breaker.release_probe(probe)
+
+    def on_success(self, output_tokens=0):
+        self.breaker.record_success()
+        if self.token_bucket is not None and output_tokens:
+            self.token_bucket.consume(output_tokens)
+
+    def on_failure(self, error, attempt, streamed=False):
+        """返回 (ProviderError, 重试前等待的秒数或 None)
+
+        已经输出过内容的流不再重试，否则用户会看到重复的文本。
+        """
+        error = classify_error(self.provider, error)
+        error.attempts = attempt
+        if error.kind in BREAKER_KINDS:
+            self.breaker.record_failure()
+        else:
+            # 有 HTTP 状态码说明服务端已经响应，试探请求算作恢复
+            self.breaker.resolve_probe(recovered=error.status is not None)
+        if streamed or not error.retryable:
+            return error, None
+        return error, self.retry.delay(attempt, error.retry_after)
+
+
+_default_guards = {}
+_default_lock = threading.Lock()
+
+
+def default_guard(provider):
+    """进程内每个服务商共享的默认 ProviderGuard（只重试和熔断，不限流）"""
+    with _default_lock:
+        if provider not in _default_guards:
+            _default_guards[provider] = ProviderGuard(provider)
+        return _default_guards[provider]
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_content(content):
+    """统一换行与首尾空白，使仅有格式差异的相同问题命中同一条缓存"""
+    if not isinstance(content, str):
+        return content
+    lines = content.replace("\r\n", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+class ResponseCache:
+    """AI 回复缓存：内存 LRU + 磁盘 SQLite 两级
+
+    键由 (服务商, 模型, 规范化后的消息列表, 采样参数) 计算得出。
+    磁盘层按 TTL 过期，并在总大小超过上限时淘汰最久未访问的条目。
+    """
+
+    def __init__(self, path="cache/responses.db", memory_entries=256, ttl=7 * 24 * 3600,
+                 max_disk_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, "
+            "accessed REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+        self.purge_expired()
+        self._disk_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(provider, model, messages, params=None, endpoint=None):
+        # 地址也参与计算（与 singleflight.make_key 一致）：指向模拟服务器或代理时的回复
+        # 不会被当作真实服务商的回复返回
+        normalized = [
+            {"role": message["role"], "content": normalize_content(message["content"])}
+            for message in messages
+        ]
+        payload = json.dumps(
+            [provider, endpoint, model, normalized, params or {}],
+            ensure_ascii=False, sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            value, created = row
+            if now - created > self.ttl:
+                self._delete(key)
+                self._conn.commit()
+                self.counters["misses"] += 1
+                return None
+
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self._remember(key, value, created)
+            self.counters["disk_hits"] += 1
+            return value
+
+    def put(self, key, value):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._remember(key, value, now)
+            self._delete(key)
+            self._conn.execute(
+                "INSERT INTO responses (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+                (key, value, now, now, size)
+            )
+            self._disk_bytes += size
+            self.counters["stores"] += 1
+            self._evict_disk()
+            self._conn.commit()
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _delete(self, key):
+        row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._disk_bytes -= row[0]
+
+    def _evict_disk(self):
+        # 超出容量时按最久未访问的顺序淘汰
+        while self._disk_bytes > self.max_disk_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._memory.pop(key, None)
+                self._disk_bytes -= size
+                self.counters["evictions"] += 1
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+            return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+from collections import deque
+
+from resilience import ProviderError, classify_error, default_guard
+
+# 界面上“自动选择”对应的模型名
+AUTO_MODEL = "Auto"
+
+
+class LatencyProfile:
+    """一个服务商最近的延迟与错误情况（滚动窗口）"""
+
+    def __init__(self, window=50, error_decay=0.8):
+        self.ttfts = deque(maxlen=window)
+        self.totals = deque(maxlen=window)
+        self.error_rate = 0.0
+        self.error_decay = error_decay
+        self._lock = threading.Lock()
+
+    def record_success(self, ttft, total):
+        with self._lock:
+            self.ttfts.append(ttft)
+            self.totals.append(total)
+            self.error_rate *= self.error_decay
+
+    def record_slow(self, elapsed):
+        """对冲中输掉并被取消的请求：首 token 时间至少为 elapsed"""
+        with self._lock:
+            self.ttfts.append(elapsed)
+
+    def record_failure(self):
+        with self._lock:
+            self.error_rate = self.error_rate * self.error_decay + (1 - self.error_decay)
+
+    def percentile(self, fraction, values=None):
+        with self._lock:
+            ordered = sorted(self.ttfts if values is None else values)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    @property
+    def samples(self):
+        return len(self.ttfts)
+
+
+class Router:
+    """按延迟和错误率自动选择服务商，并对慢请求发起对冲
+
+    - rank()：按首 token 时间中位数 × (1 + 错误率惩罚) 排序，熔断中的服务商排除；
+      样本不足的服务商按 prior_ttft 估计，保证每个服务商都会被尝试到
+    - stream()：先请求排名第一的服务商；如果在其首 token 时间 p95 之内没有任何输出，
+      再向第二名发出对冲请求，谁先产出首个 token 就用谁，另一个立即取消。
+      请求失败且尚未输出时依次切换到后面的服务商。
+    """
+
+    def __init__(self, clients, prior_ttft=1.0, error_penalty=4.0, min_samples=3,
+                 default_hedge_delay=2.0, min_hedge_delay=0.3):
+        self.clients = clients  # 服务商 -> 客户端，应用重建客户端时原地更新
+        self.prior_ttft = prior_ttft
+        self.error_penalty = error_penalty
+        self.min_samples = min_samples
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.profiles = {}
+        self.counters = {"requests": 0, "hedged": 0, "hedge_wins": 0, "failovers": 0}
+
+    def profile(self, provider):
+        if provider not in self.profiles:
+            self.profiles[provider] = LatencyProfile()
+        return self.profiles[provider]
+
+    def score(self, provider):
+        profile = self.profile(provider)
+        expected = profile.percentile(0.5) if profile.samples >= self.min_samples else None
+        if expected is None:
+            expected = self.prior_ttft
+        return expected * (1 + self.error_penalty * profile.error_rate)
+
+    def rank(self, candidates=None):
+        available = []
+        for provider in candidates or self.clients:
+            client = self.clients.get(provider)
+            if client is None or not client.api_key:
+                continue
+            # 断开或正在试探的服务商会直接以 circuit_open 失败，不参与排序
+            guard = client.guard or default_guard(client.provider)
+            if not guard.breaker.allows_request():
+                continue
+            available.append(provider)
+        return sorted(available, key=self.score)
+
+    def hedge_delay(self, provider):
+        profile = self.profile(provider)
+        if profile.samples < self.min_samples:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, profile.percentile(0.95))
+
+    async def stream_one(self, provider, messages, use_cache=True):
+        """请求指定的服务商，产出 (服务商, 文本块)，同时记录延迟"""
+        started = time.perf_counter()
+        ttft = None
+        try:
+            async for chunk in self.clients[provider].astream_response(messages, use_cache):
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                yield provider, chunk
+        except ProviderError:
+            self.profile(provider).record_failure()
+            raise
+        total = time.perf_counter() - started
+        self.profile(provider).record_success(total if ttft is None else ttft, total)
+
+    async def stream(self, contexts, use_cache=True):
+        """自动选择服务商；contexts 为 服务商 -> 按其上下文预算生成的消息列表
+
+        产出 (服务商, 文本块)；所有候选都失败时抛出最后一个 ProviderError。
+        """
+        ranking = self.rank(list(contexts))
+        if not ranking:
+            raise ProviderError(AUTO_MODEL, "missing_key", "没有可用的服务商")
+        self.counters["requests"] += 1
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        tasks = {}
+        started = {}
+        pending = list(ranking)
+        hedged = False
+        error = None
+
+        def launch():
+            provider = pending.pop(0)
+            started[provider] = loop.time()
+            tasks[provider] = asyncio.create_task(self._pump(provider, contexts[provider], use_cache, events))
+            return provider
+
+        primary = launch()
+        winner = None
+        first = None
+        try:
+            # 阶段一：等待任意一个请求产出首个 token
+            while winner is None:
+                timeout = None
+                if not hedged and pending:
+                    timeout = max(0.0, started[primary] + self.hedge_delay(primary) - loop.time())
+                try:
+                    provider, kind, value = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedged = True
+                    self.counters["hedged"] += 1
+                    launch()
+                    continue
+
+                if kind == "error":
+                    tasks.pop(provider, None)
+                    self.profile(provider).record_failure()
+                    error = value
+                    if pending and (not tasks or not hedged):
+                        # 尚未对冲时失败：直接切换到下一名，并对它重新计时
+                        self.counters["failovers"] += 1
+                        primary = launch()
+                    elif not tasks:
+                        raise error
+                    continue
+                winner, first = provider, value
+
+            if winner != primary:
+                self.counters["hedge_wins"] += 1
+            ttft = loop.time() - started[winner]
+            for provider, task in tasks.items():
+                if provider != winner:
+                    task.cancel()
+                    self.profile(provider).record_slow(loop.time() - started[provider])
+
+            # 阶段二：只转发胜出者的输出
+            if first is not None:
+                yield winner, first
+                while True:
+                    provider, kind, value = await events.get()
+                    if provider != winner:
+                        continue
+                    if kind == "chunk":
+                        yield winner, value
+                    elif kind == "done":
+                        break
+                    else:
+                        self.profile(winner).record_failure()
+                        raise value
+            total = loop.time() - started[winner]
+            self.profile(winner).record_success(ttft, total)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+    async def _pump(self, provider, messages, use_cache, events):
+        try:
+            async for chunk in self.clients[provider].astream_response(messages, use_cache):
+                await events.put((provider, "chunk", chunk))
+            await events.put((provider, "done", None))
+        except Exception as e:
+            # 缓存读写等其他异常也要报告，否则 stream() 会一直等待这个服务商的事件
+            await events.put((provider, "error", classify_error(provider, e)))
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from markdown_stream import Segment
+from transcript import TranscriptEntry
+
+logger = logging.getLogger(__name__)
+
+# 文件头：魔数、格式版本、会话 ID 字节数，随后是会话 ID
+MAGIC = b"AICS"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+# 每条记录：负载长度、负载的 CRC32；负载第一个字节是记录类型
+RECORD = struct.Struct("<II")
+LENGTH = struct.Struct("<I")
+SEGMENT = struct.Struct("<BBI")  # 标签序号、语言字节数、文本字节数
+
+KIND_ENTRY = 1  # 一条已显示的消息（发送者、时间、分段结果）
+KIND_CONTEXT = 2  # 一条计入对话上下文的消息（角色、模型、原文）
+
+# 段落标签按序号保存；增删标签时需要提升 VERSION
+TAGS = ("normal", "heading1", "heading2", "heading3", "list_item", "code", "inline_code", "latex")
+TAG_INDEX = {tag: index for index, tag in enumerate(TAGS)}
+
+
+def _pack_text(text):
+    data = (text or "").encode("utf-8")
+    return LENGTH.pack(len(data)) + data
+
+
+def _unpack_text(buffer, pos):
+    (size,) = LENGTH.unpack_from(buffer, pos)
+    pos += LENGTH.size
+    return str(buffer[pos:pos + size], "utf-8"), pos + size
+
+
+def encode_entry(sender, timestamp, segments):
+    parts = [bytes((KIND_ENTRY,)), _pack_text(sender), _pack_text(timestamp), LENGTH.pack(len(segments))]
+    for segment in segments:
+        lang = (segment.lang or "").encode("utf-8")[:255]
+        text = segment.text.encode("utf-8")
+        parts.append(SEGMENT.pack(TAG_INDEX.get(segment.tag, 0), len(lang), len(text)))
+        parts.append(lang)
+        parts.append(text)
+    return b"".join(parts)
+
+
+def decode_segments(buffer, pos):
+    (count,) = LENGTH.unpack_from(buffer, pos)
+    pos += LENGTH.size
+    segments = []
+    for _ in range(count):
+        tag, lang_size, text_size = SEGMENT.unpack_from(buffer, pos)
+        pos += SEGMENT.size
+        lang = str(buffer[pos:pos + lang_size], "utf-8") or None
+        pos += lang_size
+        segments.append(Segment(TAGS[tag], str(buffer[pos:pos + text_size], "utf-8"), lang))
+        pos += text_size
+    return segments
+
+
+def encode_context(role, content, model):
+    return bytes((KIND_CONTEXT,)) + _pack_text(role) + _pack_text(model) + _pack_text(content)
+
+
+class RestoredSession:
+    """从快照恢复的会话：entries 是聊天记录中的消息，context 是 (角色, 原文, 模型) 列表"""
+
+    def __init__(self, conversation_id, entries, context):
+        self.conversation_id = conversation_id
+        self.entries = entries
+        self.context = context
+
+
+class SessionSnapshot:
+    """当前会话的二进制快照，启动时不经过 Markdown / LaTeX 解析直接恢复显示
+
+    每条消息显示完成后把它的分段结果追加为一条记录（写入很小，不需要后台线程），
+    文件随会话增量增长，不会整体重写。启动时 load() 用 mmap 映射文件，只扫描记录头和
+    校验和；消息的分段在真正显示时才从映射中解码，而 TranscriptView 只显示最后一页，
+    所以恢复耗时与会话的渲染成本无关。
+
+    末尾写了一半的记录（程序崩溃或断电）在加载时被截掉；格式不符的文件直接忽略。
+    追加失败时记录日志并调用 on_error(消息)。
+    """
+
+    def __init__(self, path, on_error=None):
+        self.path = path
+        self.on_error = on_error
+        self._file = None
+        self._map = None
+
+    def load(self):
+        """读取快照，返回 RestoredSession；没有可用快照时返回 None"""
+        self._close_map()
+        try:
+            f = open(self.path, "r+b")
+        except OSError:
+            return None
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                f.close()
+                return None
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            f.close()
+            return None
+
+        magic, version, id_size = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION or HEADER.size + id_size > size:
+            buffer.close()
+            f.close()
+            return None
+        conversation_id = str(buffer[HEADER.size:HEADER.size + id_size], "utf-8")
+
+        entries = []
+        context = []
+        pos = HEADER.size + id_size
+        view = memoryview(buffer)
+        try:
+            while pos + RECORD.size <= size:
+                length, checksum = RECORD.unpack_from(buffer, pos)
+                start = pos + RECORD.size
+                end = start + length
+                if length == 0 or end > size or zlib.crc32(view[start:end]) != checksum:
+                    break
+                if buffer[start] == KIND_ENTRY:
+                    sender, cursor = _unpack_text(buffer, start + 1)
+                    timestamp, cursor = _unpack_text(buffer, cursor)
+                    entry = TranscriptEntry(sender, timestamp, content="")
+                    # 分段结果在显示时才解码
+                    entry.segments = lambda cursor=cursor: decode_segments(buffer, cursor)
+                    entries.append(entry)
+                elif buffer[start] == KIND_CONTEXT:
+                    role, cursor = _unpack_text(buffer, start + 1)
+                    model, cursor = _unpack_text(buffer, cursor)
+                    content, cursor = _unpack_text(buffer, cursor)
+                    context.append((role, content, model or None))
+                pos = end
+        finally:
+            view.release()
+
+        if pos < size:
+            # 末尾不完整：先把所有分段读出来再截断（映射存在时部分系统不允许截断）
+            for entry in entries:
+                entry.segments = entry.segments()
+            buffer.close()
+            f.truncate(pos)
+        else:
+            self._map = buffer
+        f.seek(pos)
+        self._file = f
+        return RestoredSession(conversation_id, entries, context)
+
+    def start(self, conversation_id):
+        """开始新的会话快照，覆盖旧文件"""
+        self._close_map()
+        if self._file is not None:
+            self._file.close()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "w+b")
+        data = conversation_id.encode("utf-8")
+        self._file.write(HEADER.pack(MAGIC, VERSION, len(data)) + data)
+        self._file.flush()
+
+    def append_entry(self, sender, timestamp, segments):
+        self._append(encode_entry(sender, timestamp, segments))
+
+    def append_context(self, role, content, model=None):
+        self._append(encode_context(role, content, model))
+
+    def _append(self, payload):
+        if self._file is None:
+            return
+        try:
+            self._file.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._file.flush()
+        except OSError as e:
+            logger.error("写入会话快照失败: %s", e)
+            if self.on_error is not None:
+                self.on_error(str(e))
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        self._close_map()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
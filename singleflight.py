@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import hashlib
+import json
+import threading
+
+
+class FlightAbandoned(Exception):
+    """发起请求的一方被取消或中途退出，共享的输出不会再继续"""
+
+
+def make_key(provider, model, messages, params=None, endpoint=None):
+    """完全相同的请求（服务商、地址、模型、消息列表、采样参数）得到相同的键"""
+    payload = json.dumps(
+        [provider, endpoint, model, messages, params or {}],
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """一次正在进行的上游请求，输出保存在共享缓冲区中供其他等待方重放
+
+    生产方（发起请求的一方）可以在任意线程中 publish()/finish()；
+    同步等待方用 replay()，协程用 areplay()，都会从第一块开始完整重放。
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.followers = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # (事件循环, asyncio.Event)
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # 等待方的事件循环已关闭
+
+    def replay(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                new_chunks = self.chunks[index:]
+                done, error = self.done, self.error
+            index += len(new_chunks)
+            yield from new_chunks
+            if done and index >= len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+    async def areplay(self):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        event = waiter[1]
+        with self._cond:
+            self._async_waiters.append(waiter)
+        try:
+            index = 0
+            while True:
+                # 先清除再读取：读取之后到达的新内容一定会再次触发事件
+                event.clear()
+                with self._cond:
+                    new_chunks = self.chunks[index:]
+                    done, error = self.done, self.error
+                index += len(new_chunks)
+                for chunk in new_chunks:
+                    yield chunk
+                if done and index >= len(self.chunks):
+                    if error is not None:
+                        raise error
+                    return
+                if not new_chunks:
+                    await event.wait()
+        finally:
+            with self._cond:
+                self._async_waiters.remove(waiter)
+
+
+class SingleFlight:
+    """合并同时进行的相同请求：第一个请求成为发起方，其余请求等待并重放它的输出
+
+    发起方结束（完成或失败）后即从表中移除，之后的相同请求会重新发起，
+    不会拿到过期的结果（那是响应缓存的职责）。等待方的速度受发起方消费速度的影响。
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.counters = {"upstream": 0, "coalesced": 0}
+
+    def join(self, key):
+        """返回 (flight, 是否为发起方)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.counters["coalesced"] += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.counters["upstream"] += 1
+            return flight, True
+
+    def leave(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+
+_default_flights = SingleFlight()
+
+
+def default_flights():
+    """进程内共享的 SingleFlight，所有客户端默认使用"""
+    return _default_flights
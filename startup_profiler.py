@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+# 尽量早地记录起点：main.py 第一个导入的就是本模块
+_PROCESS_START = time.perf_counter()
+
+# 报告中只列出第三方包和本项目模块
+STDLIB_MODULES = getattr(sys, "stdlib_module_names", frozenset())
+
+
+class StartupProfiler:
+    """记录启动各阶段耗时（python main.py --profile-startup）
+
+    mark(name) 记录从上一个标记到现在的耗时；窗口第一次绘制完成后调用 report() 输出。
+    未启用时 mark() 也会记录，开销可以忽略。
+    """
+
+    def __init__(self, start=None):
+        self.start = start if start is not None else time.perf_counter()
+        self.enabled = "--profile-startup" in sys.argv
+        self.phases = []
+        self._last = self.start
+        self._modules = set(sys.modules)
+
+    def mark(self, name):
+        now = time.perf_counter()
+        # 同时记下这一阶段新导入的顶层包，便于找出拖慢启动的依赖
+        modules = set(sys.modules)
+        packages = sorted({
+            module.split(".")[0] for module in modules - self._modules
+            if not module.startswith("_") and module.split(".")[0] not in STDLIB_MODULES
+        })
+        self._modules = modules
+        self.phases.append((name, now - self._last, packages))
+        self._last = now
+
+    def report(self, stream=None):
+        stream = stream or sys.stderr
+        total = self._last - self.start
+        print("启动耗时 / startup profile", file=stream)
+        for name, elapsed, packages in self.phases:
+            share = elapsed / total * 100 if total else 0.0
+            print(f"  {name:<24} {elapsed * 1000:8.1f} ms {share:5.1f}%", file=stream)
+            if packages:
+                print(f"  {'':<24} + {', '.join(packages[:12])}{' ...' if len(packages) > 12 else ''}", file=stream)
+        print(f"  {'total':<24} {total * 1000:8.1f} ms", file=stream)
+        stream.flush()
+
+
+profiler = StartupProfiler(_PROCESS_START)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_clients import ChatClient
+from resilience import CircuitBreaker, ProviderError, ProviderGuard
+from singleflight import SingleFlight
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class FakeClient(ChatClient):
+    """_astream 的行为由测试指定：返回文本、抛出异常或一直等待"""
+
+    provider = "Fake"
+    model = "fake"
+
+    def __init__(self, guard, behavior):
+        self.api_key = "key"
+        self.guard = guard
+        self.flights = SingleFlight()
+        self.behavior = behavior
+
+    async def _astream(self, messages):
+        if isinstance(self.behavior, Exception):
+            raise self.behavior
+        if self.behavior == "hang":
+            await asyncio.sleep(3600)
+        yield self.behavior
+
+
+def half_open_guard():
+    """只允许一次尝试、已经断开并且等待时间已过的 ProviderGuard"""
+    guard = ProviderGuard("Fake", breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+    guard.retry.max_attempts = 1
+    guard.breaker.record_failure()
+    time.sleep(0.06)
+    assert guard.breaker.state == "half_open"
+    return guard
+
+
+async def collect(client):
+    return [chunk async for chunk in client.astream_response("hi", use_cache=False)]
+
+
+class CircuitBreakerProbeTest(unittest.TestCase):
+    def test_rate_limited_probe_closes_breaker(self):
+        guard = half_open_guard()
+        with self.assertRaises(ProviderError) as context:
+            asyncio.run(collect(FakeClient(guard, HttpError(429))))
+        self.assertEqual(context.exception.kind, "rate_limit")
+        self.assertEqual(guard.breaker.state, "closed")
+        guard.before_request(1)  # 不再因熔断失败
+
+    def test_unanswered_probe_reopens_breaker(self):
+        guard = half_open_guard()
+        with self.assertRaises(ProviderError):
+            asyncio.run(collect(FakeClient(guard, ValueError("no response"))))
+        self.assertEqual(guard.breaker.state, "open")
+        with self.assertRaises(ProviderError) as context:
+            guard.before_request(1)
+        self.assertEqual(context.exception.kind, "circuit_open")
+
+    def test_cancelled_probe_is_released(self):
+        guard = half_open_guard()
+
+        async def cancel_probe():
+            task = asyncio.create_task(collect(FakeClient(guard, "hang")))
+            await asyncio.sleep(0.01)
+            self.assertFalse(guard.breaker.allows_request())  # 试探进行中
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_probe())
+        self.assertEqual(guard.breaker.state, "half_open")
+        self.assertTrue(guard.breaker.allows_request())
+        self.assertEqual(asyncio.run(collect(FakeClient(guard, "ok"))), ["ok"])
+        self.assertEqual(guard.breaker.state, "closed")
+
+    def test_stale_probe_release_is_ignored(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+        breaker.record_failure()
+        _, first = breaker.check()
+        breaker.record_failure()
+        _, second = breaker.check()
+        breaker.release_probe(first)
+        self.assertFalse(breaker.allows_request())
+        breaker.release_probe(second)
+        self.assertTrue(breaker.allows_request())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from resilience import CircuitBreaker, ProviderGuard
+from router import Router
+from tests.test_resilience import FakeClient
+
+
+class DelayedClient(FakeClient):
+    """等待 delay 秒后输出一段文本"""
+
+    def __init__(self, guard, text, delay):
+        super().__init__(guard, text)
+        self.delay = delay
+
+    async def _astream(self, messages):
+        await asyncio.sleep(self.delay)
+        yield self.behavior
+
+
+class HedgedProbeTest(unittest.TestCase):
+    def test_cancelled_hedge_loser_probe_is_ranked_again(self):
+        slow_guard = ProviderGuard("Slow", breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+        slow_guard.breaker.record_failure()
+        time.sleep(0.06)
+        fast_guard = ProviderGuard("Fast")
+        clients = {
+            "Slow": DelayedClient(slow_guard, "slow", 10),
+            "Fast": DelayedClient(fast_guard, "fast", 0.01),
+        }
+        clients["Slow"].provider = "Slow"
+        clients["Fast"].provider = "Fast"
+        router = Router(clients, default_hedge_delay=0.01)
+        # 让半开的服务商排在第一位，它的试探请求成为对冲中落败并被取消的一方
+        router.score = lambda provider: 0 if provider == "Slow" else 1
+        self.assertEqual(router.rank(), ["Slow", "Fast"])
+
+        async def run():
+            contexts = {"Slow": "hi", "Fast": "hi"}
+            return [item async for item in router.stream(contexts, use_cache=False)]
+
+        self.assertEqual(asyncio.run(run()), [("Fast", "fast")])
+        self.assertEqual(router.counters["hedge_wins"], 1)
+        self.assertEqual(slow_guard.breaker.state, "half_open")
+        self.assertTrue(slow_guard.breaker.allows_request())
+        self.assertEqual(router.rank(), ["Slow", "Fast"])
+
+    def test_breaker_with_probe_in_flight_is_not_ranked(self):
+        guard = ProviderGuard("Fake", breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.0))
+        guard.breaker.record_failure()
+        router = Router({"Fake": FakeClient(guard, "ok")})
+        self.assertEqual(router.rank(), ["Fake"])
+        guard.before_request(1)  # 占用试探名额
+        self.assertEqual(router.rank(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+
+class TranscriptEntry:
+    """模型侧保存的一条消息；content 为 None 表示还在输出中
+
+    segments 是已分段的渲染结果，重新显示时不必再解析；也可以是按需解码的函数
+    （从会话快照恢复的消息），为 None 时按 content 重新分段。
+    """
+
+    __slots__ = ("sender", "timestamp", "content", "segments")
+
+    def __init__(self, sender, timestamp=None, content=None, segments=None):
+        self.sender = sender
+        self.timestamp = timestamp or datetime.now().strftime("%H:%M:%S")
+        self.content = content
+        self.segments = segments
+
+
+class TranscriptView:
+    """虚拟化的聊天记录视图
+
+    全部消息保存在 entries 中，文本框里只显示 [first, last) 范围内的消息。
+    滚动到已显示内容的顶部或底部附近时再按页插入相邻消息，同时把超出 window_size
+    的另一端删掉；被删掉的消息所引用的公式图片通过 release() 归还给缓存，
+    所以无论对话多长，文本框中的文本和图片数量都保持在固定范围内。
+
+    每条已显示消息的开头有一个 msg_<序号> 标记，用来定位和删除。
+    """
+
+    def __init__(self, root, textbox, render, release, window_size=60, page_size=20, margin=0.1):
+        self.root = root
+        self.textbox = textbox
+        self.render = render  # render(entry, index)：在 index 处插入一条完整消息
+        self.release = release  # release(key)：归还公式图片
+        self.window_size = window_size
+        self.page_size = page_size
+        self.margin = margin
+
+        self.entries = []
+        self.first = 0
+        self.last = 0
+        self.rendering = None  # 正在重新插入的消息序号
+        self._images = {}  # 消息序号 -> 已插入的公式缓存键
+        self._waiting = {}  # 等待图片的标记 -> 消息序号
+        self._check_job = None
+
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>", "<KeyRelease>", "<Configure>"):
+            self.textbox.bind(sequence, lambda event: self.schedule_check(), add="+")
+
+    def begin(self, sender):
+        """在末尾开始一条新消息，返回它的序号"""
+        if self.entries and self.entries[-1].content is None:
+            # 上一条消息中途出错没有正常结束，重新显示时只保留标题
+            self.entries[-1].content = ""
+        self.show_tail()
+        number = len(self.entries)
+        self.entries.append(TranscriptEntry(sender))
+        self.textbox.mark_set(self._mark(number), "end-1c")
+        self.textbox.mark_gravity(self._mark(number), "left")
+        self.last = number + 1
+        self._trim_top()
+        return number
+
+    def finish(self, content, segments=None):
+        """末尾消息输出完毕"""
+        self.entries[-1].content = content
+        self.entries[-1].segments = segments
+
+    def restore(self, entries):
+        """载入已完成的消息（如从会话快照恢复），只显示最后一页"""
+        self.entries.extend(entries)
+        self.show_tail()
+
+    def reset(self):
+        """清空全部消息，开始新的会话"""
+        self._discard(self.first, self.last)
+        self.textbox.delete("1.0", "end")
+        self.entries = []
+        self.first = self.last = 0
+
+    def owner(self):
+        """当前插入的内容属于哪条消息"""
+        return self.rendering if self.rendering is not None else len(self.entries) - 1
+
+    def wait_image(self, mark):
+        self._waiting[mark] = self.owner()
+
+    def place_image(self, mark, key):
+        """图片渲染完成；消息已被移出窗口时返回 False，调用方不应再插入"""
+        number = self._waiting.pop(mark, None)
+        if number is None:
+            if key is not None:
+                self.release(key)
+            return False
+        if key is not None:
+            self._images.setdefault(number, []).append(key)
+        return True
+
+    def track(self, mark):
+        """登记一个后台任务还会用到的标记（如代码高亮），所在消息移出窗口时自动作废"""
+        self._waiting[mark] = self.owner()
+
+    def is_tracked(self, mark):
+        return mark in self._waiting
+
+    def untrack(self, mark):
+        if self._waiting.pop(mark, None) is not None:
+            self.textbox.mark_unset(mark)
+
+    def schedule_check(self):
+        if self._check_job is None:
+            self._check_job = self.root.after(50, self.check_scroll)
+
+    def check_scroll(self):
+        self._check_job = None
+        top, bottom = self.textbox.yview()
+        if top <= self.margin and self.first > 0:
+            self._show_previous()
+        elif bottom >= 1 - self.margin and self.last < len(self.entries):
+            self._show_next()
+
+    def show_tail(self):
+        """确保显示的是最新的消息（开始新消息前调用）"""
+        if self.last == len(self.entries):
+            return
+        self._discard(self.first, self.last)
+        self.textbox.delete("1.0", "end")
+        self.first = self.last = max(0, len(self.entries) - self.page_size)
+        self._append(len(self.entries))
+
+    def _mark(self, number):
+        return f"msg_{number}"
+
+    def _show_previous(self):
+        self.textbox.mark_set("transcript_anchor", "@0,0")
+        start = max(0, self.first - self.page_size)
+        self.textbox.mark_set("transcript_insert", "1.0")
+        self.textbox.mark_gravity("transcript_insert", "right")
+        # 在原第一条消息之前插入时，它的标记要跟着后移
+        self.textbox.mark_gravity(self._mark(self.first), "right")
+        for number in range(start, self.first):
+            self.textbox.mark_set(self._mark(number), "transcript_insert")
+            self.textbox.mark_gravity(self._mark(number), "left")
+            self._render(number, "transcript_insert")
+        self.textbox.mark_gravity(self._mark(self.first), "left")
+        self.textbox.mark_unset("transcript_insert")
+        self.first = start
+        self._trim_bottom()
+        self.textbox.yview("transcript_anchor")
+        self.textbox.mark_unset("transcript_anchor")
+
+    def _show_next(self):
+        self.textbox.mark_set("transcript_anchor", "@0,0")
+        self._append(min(len(self.entries), self.last + self.page_size))
+        self._trim_top()
+        self.textbox.yview("transcript_anchor")
+        self.textbox.mark_unset("transcript_anchor")
+
+    def _append(self, end):
+        for number in range(self.last, end):
+            self.textbox.mark_set(self._mark(number), "end-1c")
+            self.textbox.mark_gravity(self._mark(number), "left")
+            self._render(number, "end")
+        self.last = end
+
+    def _render(self, number, index):
+        self.rendering = number
+        try:
+            self.render(self.entries[number], index)
+        finally:
+            self.rendering = None
+
+    def _trim_top(self):
+        start = self.last - self.window_size
+        if start <= self.first:
+            return
+        self.textbox.delete("1.0", self._mark(start))
+        self._discard(self.first, start)
+        self.first = start
+
+    def _trim_bottom(self):
+        end = self.first + self.window_size
+        if end >= self.last:
+            return
+        # 还在输出中的消息不能删除
+        if any(entry.content is None for entry in self.entries[end:self.last]):
+            return
+        self.textbox.delete(self._mark(end), "end")
+        self._discard(end, self.last)
+        self.last = end
+
+    def _discard(self, start, end):
+        for number in range(start, end):
+            self.textbox.mark_unset(self._mark(number))
+            for key in self._images.pop(number, ()):
+                self.release(key)
+        # 还没等到图片的标记作废，图片到达后直接归还
+        for mark, number in list(self._waiting.items()):
+            if start <= number < end:
+                del self._waiting[mark]
+                self.textbox.mark_unset(mark)
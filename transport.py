@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import HTTPError
+
+from metrics import metrics
+
+
+def import_httpx():
+    """按需导入 httpx（可选依赖，缺失时不支持 HTTP/2），不使用 HTTP/2 时不必承担导入开销"""
+    try:
+        import httpx
+        return httpx
+    except ImportError:
+        return None
+
+
+class TimedConnectionMixin:
+    """新建连接时分别记录 DNS 解析、TCP 连接和 TLS 握手耗时（复用的连接不经过这里）"""
+
+    def _new_conn(self):
+        host = getattr(self, "_dns_host", None)
+        if host is None:
+            return super()._new_conn()
+        started = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, type=socket.SOCK_STREAM)
+        except OSError:
+            return super()._new_conn()  # 交给 urllib3 按原方式报错
+        resolved = time.perf_counter()
+        metrics.observe("http_dns_seconds", resolved - started, host=self.host)
+
+        # 用解析结果直接连接，避免再解析一次；证书校验和 SNI 仍使用原主机名
+        error = None
+        try:
+            for address in dict.fromkeys(info[4][0] for info in addresses):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except (OSError, HTTPError) as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = host
+        self._tcp_connected = time.perf_counter()
+        metrics.observe("http_connect_seconds", self._tcp_connected - resolved, host=self.host)
+        return sock
+
+    def connect(self):
+        self._tcp_connected = None
+        super().connect()
+        metrics.inc("http_connections_total", host=self.host)
+        if self._tcp_connected is not None and isinstance(self, HTTPSConnection):
+            metrics.observe("http_tls_seconds", time.perf_counter() - self._tcp_connected, host=self.host)
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+class HttpTransport:
+    """所有 AI 客户端共享的 HTTP 传输层
+
+    - 连接池与 keep-alive：同一主机的请求复用已建立的 TCP/TLS 连接
+    - 可配置的连接 / 读取超时
+    - 可选 HTTP/2（需要 httpx 和 h2）
+    - 启动时预热连接，第一条消息不必再等握手
+    - 新建连接的 DNS / TCP / TLS 耗时记录到 metrics（HTTP/2 路径除外）
+    """
+
+    def __init__(self, connect_timeout=5.0, read_timeout=120.0, pool_connections=8,
+                 pool_maxsize=16, http2=False):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.http2 = http2 and self._h2_available()
+        self._httpx_client = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _h2_available():
+        if import_httpx() is None:
+            return False
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    @property
+    def httpx_client(self):
+        """HTTP/2 请求使用的共享 httpx 客户端"""
+        httpx = import_httpx()
+        if httpx is None:
+            return None
+        with self._lock:
+            if self._httpx_client is None:
+                self._httpx_client = httpx.Client(
+                    http2=self.http2,
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                    limits=httpx.Limits(
+                        max_connections=self.pool_maxsize,
+                        max_keepalive_connections=self.pool_connections
+                    )
+                )
+            return self._httpx_client
+
+    @contextmanager
+    def stream_post(self, url, headers=None, json=None):
+        """发送流式 POST 请求；返回的响应对象支持 iter_lines() 和 raise_for_status()"""
+        if self.http2:
+            with self.httpx_client.stream("POST", url, headers=headers, json=json) as response:
+                yield response
+        else:
+            with self.session.post(url, headers=headers, json=json, stream=True, timeout=self.timeout) as response:
+                yield response
+
+    def post(self, url, headers=None, json=None):
+        if self.http2:
+            return self.httpx_client.post(url, headers=headers, json=json)
+        return self.session.post(url, headers=headers, json=json, timeout=self.timeout)
+
+    def prewarm(self, urls):
+        """在后台线程中向各个主机发送 HEAD 请求，提前建立连接放入连接池"""
+        origins = []
+        for url in urls:
+            if not url:
+                continue
+            parts = urlsplit(url)
+            origin = f"{parts.scheme}://{parts.netloc}/"
+            if origin not in origins:
+                origins.append(origin)
+
+        def warm(origin):
+            try:
+                if self.http2:
+                    self.httpx_client.head(origin)
+                else:
+                    self.session.head(origin, timeout=self.timeout)
+            except Exception:
+                pass  # 预热失败不影响正常请求
+
+        threads = [threading.Thread(target=warm, args=(origin,), daemon=True) for origin in origins]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def close(self):
+        self.session.close()
+        if self._httpx_client is not None:
+            self._httpx_client.close()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+
+def default_transport():
+    """进程内共享的默认传输层"""
+    global _default_transport
+    with _default_lock:
+        if _default_transport is None:
+            _default_transport = HttpTransport()
+        return _default_transport